@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2015, The PICRUSt Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.1.4"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+__status__ = "Development"
+
+from hashlib import sha256
+from json import dump, load
+from os import close, remove
+from os.path import dirname, exists, splitext
+from tempfile import mkstemp
+from numpy import argsort, around, asarray, float64, iinfo, load as numpy_load,\
+    memmap, minimum, save, searchsorted, uint16, unique, zeros
+from numpy.lib.format import open_memmap
+from biom import Table
+from picrust.util import determine_metadata_type, parse_metadata_field
+
+# A binary precalculated table is made of three files that share a common
+# base name (e.g. ko_13_5_precalculated):
+#   <base>.npy           -- OTU x trait matrix, rows sorted by OTU id
+#   <base>.ids.npy       -- sorted OTU ids, one per matrix row
+#   <base>.metadata.json -- trait ids, trait metadata and OTU metadata
+BINARY_PRECALC_EXT = '.npy'
+BINARY_PRECALC_IDS_EXT = '.ids.npy'
+BINARY_PRECALC_METADATA_EXT = '.metadata.json'
+BINARY_PRECALC_FORMAT = 'PICRUSt binary precalculated table'
+BINARY_PRECALC_FORMAT_VERSION = 1
+BINARY_PRECALC_DTYPES = ['uint16', 'float32', 'float64']
+
+# number of OTU rows to copy (or hash) at a time when writing a matrix
+WRITE_CHUNK_SIZE = 1000
+
+
+def binary_precalc_fps(matrix_fp):
+    """Return the (matrix, ids, metadata) filepaths of a binary precalc table
+
+    matrix_fp -- path to the matrix file, or the shared base name of the files
+    """
+    if matrix_fp.endswith(BINARY_PRECALC_EXT):
+        base = matrix_fp[:-len(BINARY_PRECALC_EXT)]
+    else:
+        base = matrix_fp
+    return base + BINARY_PRECALC_EXT, base + BINARY_PRECALC_IDS_EXT,\
+        base + BINARY_PRECALC_METADATA_EXT
+
+
+def binary_precalc_fp_for(precalc_fp):
+    """Return the binary precalc matrix path for a tab-delimited/BIOM table
+
+    e.g. ko_13_5_precalculated.tab.gz -> ko_13_5_precalculated.npy
+    """
+    base = precalc_fp
+    if base.endswith('.gz'):
+        base = base[:-len('.gz')]
+    root, ext = splitext(base)
+    if ext in ['.tab', '.txt', '.tsv', '.biom']:
+        base = root
+    return base + BINARY_PRECALC_EXT
+
+
+def is_binary_precalc(fp):
+    """Return True if fp is the matrix file of a binary precalc table"""
+    if not fp.endswith(BINARY_PRECALC_EXT) or \
+       fp.endswith(BINARY_PRECALC_IDS_EXT):
+        return False
+    return all(map(exists, binary_precalc_fps(fp)))
+
+
+def choose_precalc_dtype(data):
+    """Return the smallest supported dtype that can hold data without loss
+
+    Whole, non-negative counts that fit in 16 bits (the usual case for gene
+    copy numbers) are stored as uint16, everything else as float32.
+    """
+    data = asarray(data)
+    if data.size == 0:
+        return 'uint16'
+    if data.min() >= 0 and data.max() <= iinfo(uint16).max and \
+       (around(data) == data).all():
+        return 'uint16'
+    return 'float32'
+
+
+def write_binary_precalc(genome_table, matrix_fp, dtype=None,
+                         gg_version=None, type_of_prediction=None):
+    """Write a gene table to disk in the binary precalc format
+
+    genome_table -- a BIOM Table with traits as observations and OTUs as
+      samples (as returned by convert_precalc_to_biom with transpose=True)
+    matrix_fp -- path to the output matrix file. The id index and metadata
+      files are written next to it.
+    dtype -- one of BINARY_PRECALC_DTYPES. If None, the smallest lossless
+      dtype is chosen from the data.
+    gg_version, type_of_prediction -- recorded in the metadata file
+
+    Returns the metadata dict written to the metadata file.
+    """
+    otu_ids = asarray(map(str, genome_table.ids()))
+    trait_ids = map(str, genome_table.ids(axis='observation'))
+    order = argsort(otu_ids, kind='mergesort')
+
+    # traits x OTUs in BIOM, OTUs x traits on disk
+    data = genome_table.matrix_data.tocsc()
+    if dtype is None:
+        dtype = choose_precalc_dtype(data.data)
+
+    otu_metadata = {}
+    otu_md = genome_table.metadata()
+    if otu_md:
+        for key in otu_md[0].keys():
+            otu_metadata[key] = [otu_md[i][key] for i in order]
+
+    trait_md = genome_table.metadata(axis='observation')
+    trait_md = list(trait_md) if trait_md else None
+
+    def get_rows(idxs):
+        return data[:, idxs].T.toarray()
+
+    return _write_binary_precalc(matrix_fp, get_rows, otu_ids, order,
+                                 trait_ids, trait_md, otu_metadata, dtype,
+                                 gg_version, type_of_prediction)
+
+
+def convert_precalc_to_binary(precalc_in, matrix_fp, dtype=None,
+                              gg_version=None, type_of_prediction=None,
+                              md_prefix='metadata_'):
+    """Convert a tab-delimited precalc file to the binary precalc format
+
+    precalc_in -- an open file (e.g. from gzip.open) of a tab-delimited
+      precalculated table, as read by convert_precalc_to_biom
+    matrix_fp -- path to the output matrix file
+    dtype -- one of BINARY_PRECALC_DTYPES. If None, the smallest lossless
+      dtype is chosen from the data.
+    gg_version, type_of_prediction -- recorded in the metadata file
+
+    The input is read in a single pass. Rows are streamed to a temporary
+    file next to matrix_fp and then copied into the output in sorted OTU id
+    order, so memory use does not depend on the size of the table.
+
+    Returns the metadata dict written to the metadata file.
+    """
+    if dtype is not None and dtype not in BINARY_PRECALC_DTYPES:
+        raise ValueError("Unsupported dtype '%s'. Valid choices are: %s"
+                         % (dtype, ', '.join(BINARY_PRECALC_DTYPES)))
+    # float32 holds every uint16 value exactly
+    tmp_dtype = 'float64' if dtype == 'float64' else 'float32'
+
+    #first line has to be header
+    header_ids = precalc_in.readline().strip().split('\t')
+    col_meta_locs = {}
+    for idx, col_id in enumerate(header_ids):
+        if col_id.startswith(md_prefix):
+            col_meta_locs[col_id[len(md_prefix):]] = idx
+    end_of_data = len(header_ids) - len(col_meta_locs)
+    trait_ids = header_ids[1:end_of_data]
+    trait_md = [{} for i in trait_ids]
+    otu_metadata = dict((name, []) for name in col_meta_locs)
+
+    otu_ids = []
+    fits_uint16 = True
+    tmp_fd, tmp_fp = mkstemp(dir=dirname(matrix_fp) or '.',
+                             suffix='.tmp')
+    close(tmp_fd)
+    try:
+        with open(tmp_fp, 'wb') as tmp_fh:
+            for line in precalc_in:
+                fields = line.strip().split('\t')
+                row_id = fields[0]
+                if row_id.startswith(md_prefix):
+                    metadata_type = determine_metadata_type(line)
+                    for idx in range(len(trait_ids)):
+                        trait_md[idx][row_id[len(md_prefix):]] = \
+                            parse_metadata_field(fields[idx+1], metadata_type)
+                    continue
+
+                row = asarray(fields[1:end_of_data], dtype=float64)
+                if len(row) != len(trait_ids):
+                    raise ValueError("Row for OTU %s has %i values, expected"
+                                     " %i" % (row_id, len(row), len(trait_ids)))
+                if fits_uint16 and dtype is None:
+                    fits_uint16 = choose_precalc_dtype(row) == 'uint16'
+                row.astype(tmp_dtype).tofile(tmp_fh)
+
+                otu_ids.append(row_id)
+                for name, loc in col_meta_locs.items():
+                    otu_metadata[name].append(fields[loc])
+
+        if dtype is None:
+            dtype = 'uint16' if fits_uint16 else 'float32'
+
+        otu_ids = asarray(otu_ids)
+        order = argsort(otu_ids, kind='mergesort')
+        for name in otu_metadata:
+            otu_metadata[name] = [otu_metadata[name][i] for i in order]
+
+        if len(otu_ids):
+            tmp_matrix = memmap(tmp_fp, dtype=tmp_dtype, mode='r',
+                                shape=(len(otu_ids), len(trait_ids)))
+        else:
+            tmp_matrix = zeros((0, len(trait_ids)), dtype=tmp_dtype)
+
+        header = _write_binary_precalc(matrix_fp, tmp_matrix.__getitem__,
+                                       otu_ids, order, trait_ids, trait_md,
+                                       otu_metadata, dtype, gg_version,
+                                       type_of_prediction)
+        # release the memory map before removing the file
+        del tmp_matrix
+    finally:
+        remove(tmp_fp)
+
+    return header
+
+
+def _write_binary_precalc(matrix_fp, get_rows, otu_ids, order, trait_ids,
+                          trait_md, otu_metadata, dtype, gg_version,
+                          type_of_prediction):
+    """Write the matrix, id index and metadata files of a binary precalc table
+
+    get_rows -- function returning the OTU x trait values for an array of
+      (input order) row indices
+    order -- the permutation that sorts otu_ids
+    """
+    if dtype not in BINARY_PRECALC_DTYPES:
+        raise ValueError("Unsupported dtype '%s'. Valid choices are: %s"
+                         % (dtype, ', '.join(BINARY_PRECALC_DTYPES)))
+    matrix_fp, ids_fp, metadata_fp = binary_precalc_fps(matrix_fp)
+
+    sorted_otu_ids = otu_ids[order]
+    if len(unique(sorted_otu_ids)) != len(sorted_otu_ids):
+        raise ValueError("OTU ids in the precalculated table must be unique")
+
+    shape = (len(sorted_otu_ids), len(trait_ids))
+    matrix = open_memmap(matrix_fp, mode='w+', dtype=dtype, shape=shape)
+    for start in range(0, shape[0], WRITE_CHUNK_SIZE):
+        chunk = order[start:start + WRITE_CHUNK_SIZE]
+        matrix[start:start + len(chunk)] = get_rows(chunk)
+    matrix.flush()
+    del matrix
+
+    save(ids_fp, sorted_otu_ids)
+
+    header = {'format': BINARY_PRECALC_FORMAT,
+              'format_version': BINARY_PRECALC_FORMAT_VERSION,
+              'gg_version': gg_version,
+              'type_of_prediction': type_of_prediction,
+              'dtype': dtype,
+              'shape': list(shape),
+              'sha256': compute_binary_precalc_checksum(matrix_fp),
+              'trait_ids': trait_ids,
+              'trait_metadata': trait_md,
+              'otu_metadata': otu_metadata}
+
+    with open(metadata_fp, 'w') as metadata_fh:
+        dump(header, metadata_fh)
+    return header
+
+
+def compute_binary_precalc_checksum(matrix_fp):
+    """Return the sha256 hex digest of the id index and matrix contents
+
+    The matrix is hashed one chunk of rows at a time, so this is safe to run
+    on tables larger than memory.
+    """
+    matrix_fp, ids_fp, metadata_fp = binary_precalc_fps(matrix_fp)
+    sorted_ids = numpy_load(ids_fp, mmap_mode='r')
+    matrix = numpy_load(matrix_fp, mmap_mode='r')
+
+    checksum = sha256()
+    checksum.update(str(matrix.dtype))
+    checksum.update(str(matrix.shape))
+    checksum.update(asarray(sorted_ids).tostring())
+    for start in range(0, matrix.shape[0], WRITE_CHUNK_SIZE):
+        checksum.update(asarray(matrix[start:start + WRITE_CHUNK_SIZE]).tostring())
+    return checksum.hexdigest()
+
+
+def verify_binary_precalc(matrix_fp):
+    """Check a binary precalc table against its metadata
+
+    Returns a list of human-readable problems, which is empty if the table
+    is intact (i.e. the dtype, shape and checksum recorded at conversion time
+    match the files on disk, and the id index is sorted and unique).
+    """
+    matrix_fp, ids_fp, metadata_fp = binary_precalc_fps(matrix_fp)
+    for fp in (matrix_fp, ids_fp, metadata_fp):
+        if not exists(fp):
+            return ["Missing file: %s" % fp]
+
+    try:
+        header = load_binary_precalc_header(matrix_fp)
+    except ValueError, e:
+        return [str(e)]
+
+    problems = []
+    sorted_ids = numpy_load(ids_fp, mmap_mode='r')
+    matrix = numpy_load(matrix_fp, mmap_mode='r')
+    if str(matrix.dtype) != header['dtype']:
+        problems.append("Matrix dtype is %s, metadata records %s"
+                        % (matrix.dtype, header['dtype']))
+    if list(matrix.shape) != header['shape']:
+        problems.append("Matrix shape is %s, metadata records %s"
+                        % (list(matrix.shape), header['shape']))
+    if len(sorted_ids) != matrix.shape[0]:
+        problems.append("Id index has %i entries, matrix has %i rows"
+                        % (len(sorted_ids), matrix.shape[0]))
+    if len(header['trait_ids']) != matrix.shape[1]:
+        problems.append("Metadata lists %i trait ids, matrix has %i columns"
+                        % (len(header['trait_ids']), matrix.shape[1]))
+    if len(sorted_ids) > 1 and not (sorted_ids[1:] > sorted_ids[:-1]).all():
+        problems.append("Id index is not sorted and unique")
+
+    if header.get('sha256') is None:
+        problems.append("Metadata does not record a checksum")
+    elif compute_binary_precalc_checksum(matrix_fp) != header['sha256']:
+        problems.append("Checksum does not match the one recorded at"
+                        " conversion time")
+    return problems
+
+
+def load_binary_precalc_header(matrix_fp):
+    """Return the metadata dict of a binary precalc table"""
+    metadata_fp = binary_precalc_fps(matrix_fp)[2]
+    with open(metadata_fp, 'U') as metadata_fh:
+        header = load(metadata_fh)
+    if header.get('format') != BINARY_PRECALC_FORMAT:
+        raise ValueError("%s is not a PICRUSt binary precalculated table"
+                         % metadata_fp)
+    if header.get('format_version') > BINARY_PRECALC_FORMAT_VERSION:
+        raise ValueError("%s was written by a newer version of PICRUSt"
+                         " (format version %s)"
+                         % (metadata_fp, header.get('format_version')))
+    return header
+
+
+def find_precalc_rows(sorted_ids, ids_to_load):
+    """Return (row indices, ids) for ids_to_load in the sorted id index
+
+    sorted_ids -- the (memory-mapped) sorted array of OTU ids
+    ids_to_load -- OTU ids to look up. Duplicates are ignored.
+
+    Rows are returned in ascending order so that reads from the matrix
+    file are sequential. Raises ValueError if any id is not in the index.
+    """
+    requested = unique(asarray(map(str, ids_to_load)))
+    positions = searchsorted(sorted_ids, requested)
+    if len(sorted_ids):
+        found = sorted_ids[minimum(positions, len(sorted_ids) - 1)] == requested
+    else:
+        found = zeros(len(requested), dtype=bool)
+
+    if not found.any():
+        raise ValueError("No OTUs match identifiers in precalculated file."
+                         " PICRUSt requires an OTU table reference/closed"
+                         " picked against GreenGenes.\nExample of the first 5"
+                         " OTU ids from your table: {0}".format(
+                             ', '.join(list(requested)[:5])))
+
+    missing = requested[~found]
+    if len(missing):
+        raise ValueError("One or more OTU ids were not found in the"
+                         " precalculated file!\nAre you using the correct"
+                         " --gg_version?\nExample of (the {0}) unknown OTU"
+                         " ids: {1}".format(len(missing),
+                                            ', '.join(list(missing)[:5])))
+
+    return positions, requested
+
+
+def load_binary_precalc(matrix_fp, ids_to_load=None, transpose=True):
+    """Load a binary precalc table (or a subset of its OTUs) as a BIOM Table
+
+    matrix_fp -- path to the matrix file written by write_binary_precalc
+    ids_to_load -- OTU ids to load. If None or empty, all OTUs are loaded.
+    transpose -- if True, traits are observations and OTUs are samples
+      (matching convert_precalc_to_biom)
+
+    The matrix and id index are memory-mapped, so only the pages holding
+    the requested rows are read from disk, and those pages are shared
+    between concurrent processes loading the same table.
+    """
+    matrix_fp, ids_fp, metadata_fp = binary_precalc_fps(matrix_fp)
+    header = load_binary_precalc_header(matrix_fp)
+
+    sorted_ids = numpy_load(ids_fp, mmap_mode='r')
+    matrix = numpy_load(matrix_fp, mmap_mode='r')
+    if list(matrix.shape) != header['shape'] or \
+       len(sorted_ids) != matrix.shape[0]:
+        raise ValueError("Binary precalculated table %s is inconsistent with"
+                         " its metadata (shape %s, expected %s)"
+                         % (matrix_fp, list(matrix.shape), header['shape']))
+
+    if ids_to_load is not None and len(ids_to_load) > 0:
+        rows, otu_ids = find_precalc_rows(sorted_ids, ids_to_load)
+        data = asarray(matrix[rows], dtype=float64)
+    else:
+        rows = range(len(sorted_ids))
+        otu_ids = asarray(sorted_ids)
+        data = asarray(matrix, dtype=float64)
+    otu_ids = map(str, otu_ids)
+
+    trait_ids = map(str, header['trait_ids'])
+    trait_md = header['trait_metadata']
+    if trait_md is None:
+        trait_md = [{} for i in trait_ids]
+
+    otu_metadata = header['otu_metadata']
+    otu_md = [dict((key, values[i]) for key, values in otu_metadata.items())
+              for i in rows]
+
+    if transpose:
+        return Table(data.T, trait_ids, otu_ids, trait_md, otu_md,
+                     type='Gene table')
+    else:
+        return Table(data, otu_ids, trait_ids, otu_md, trait_md,
+                     type='Gene table')
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2011-2013, The PICRUSt Project"
+__credits__ = ["agent", "Daniel McDonald", "Morgan Langille", "Jesse Zaneveld"]
+__license__ = "GPL"
+__version__ = "1.1.4"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+__status__ = "Development"
+
+import json
+from hashlib import md5
+from numpy import array, asarray, load as numpy_load, savez
+from scipy.sparse import coo_matrix, csr_matrix
+from biom.table import Table
+from picrust.util import atomic_write
+
+# version of the on-disk category membership format
+CATEGORY_MEMBERSHIP_FORMAT_VERSION = 2
+
+
+def make_collapse_f(category, level, ignore):
+    """produce a collapsing function for one-to-many relationships"""
+    # adjust level such that, for instance, level 1 corresponds to index 0
+    if level > 0:
+        level -= 1
+
+    if ignore is not None:
+        ignore_labels = set(ignore.split(','))
+    else:
+        ignore_labels = None
+
+    def collapse(id_, md):
+        is_single_level = False
+
+        for path in md[category]:
+
+            # need to convert strings to lists (if needed) before checking
+            #if they are in the ignore list
+            if isinstance(path,basestring):
+                # If we have a list of strings, we want the whole thing (only)
+                path = md[category]
+                is_single_level = True
+
+            if ignore_labels is not None and path[level].lower() in ignore_labels:
+                continue
+
+            yield (path[:(level+1)],path[level])
+
+            #If we only have one list of strings, we're done - bail.
+            if is_single_level:
+                break
+    return collapse
+
+
+def category_md_digest(md, category):
+    """Return a short digest of the category metadata of one function"""
+    value = md.get(category) if md is not None else None
+    return md5(json.dumps(value, sort_keys=True)).hexdigest()[:16]
+
+
+def functions_md_digest(function_ids, metadata, category):
+    """Return a digest of the function ids and category metadata of a table
+
+    The (function id, category metadata) pairs are serialized in a single
+    call, so checking a whole table costs one pass over its metadata.
+    """
+    pairs = [[str(function_id), md.get(category) if md is not None else None]
+             for function_id, md in zip(function_ids, metadata)]
+    return md5(json.dumps(pairs, sort_keys=True)).hexdigest()
+
+
+class CategoryMembership(object):
+    """Sparse membership matrix of functions in the categories of one level
+
+    membership is a categories x functions CSR matrix, where entry (i,j) is
+    the number of times function_ids[j] is assigned to category_ids[i] (as
+    with Table.collapse, a function listed under a category twice is counted
+    twice). category_md[i] is the observation metadata of category i in a
+    collapsed table, i.e. {category: path to category i}.
+
+    The matrix only depends on the function metadata of the reference the
+    table was predicted from, so it can be built once per reference release
+    and level, saved with save(), and reused with load().
+    functions_md_digest is the digest of the function ids and category
+    metadata the matrix was built from, and function_md_digests[j] the
+    category_md_digest of function_ids[j]'s metadata, so that matches_table
+    can tell whether a table was predicted from the same reference.
+    """
+
+    def __init__(self, membership, function_ids, category_ids, category_md,
+                 category, level, ignore=None, function_md_digests=None,
+                 functions_md_digest=None):
+        self.membership = csr_matrix(membership)
+        self.function_ids = list(function_ids)
+        self.category_ids = list(category_ids)
+        self.category_md = list(category_md)
+        self.category = category
+        self.level = level
+        self.ignore = ignore
+        if function_md_digests is not None:
+            function_md_digests = list(function_md_digests)
+        self.function_md_digests = function_md_digests
+        self.functions_md_digest = functions_md_digest
+
+    @classmethod
+    def from_table(cls, table, category, level, ignore=None):
+        """Build the membership matrix from the observation metadata of table"""
+        collapse_f = make_collapse_f(category, level, ignore)
+        function_ids = table.ids(axis='observation')
+
+        metadata = table.metadata(axis='observation')
+
+        category_paths = {}
+        function_idxs = []
+        category_names = []
+        function_md_digests = []
+        for j, (function_id, md) in enumerate(zip(function_ids, metadata)):
+            function_md_digests.append(category_md_digest(md, category))
+            for path, category_id in collapse_f(function_id, md):
+                if category_id not in category_paths:
+                    category_paths[category_id] = path
+                category_names.append(category_id)
+                function_idxs.append(j)
+
+        # categories are ordered as in Table.collapse
+        category_ids = sorted(category_paths)
+        category_lookup = dict((c, i) for i, c in enumerate(category_ids))
+        category_idxs = [category_lookup[c] for c in category_names]
+
+        # duplicate (category, function) entries are summed
+        membership = coo_matrix(([1] * len(function_idxs),
+                                 (category_idxs, function_idxs)),
+                                shape=(len(category_ids), len(function_ids)))
+        category_md = [{category: category_paths[c]} for c in category_ids]
+        return cls(membership.tocsr(), function_ids, category_ids,
+                   category_md, category, level, ignore, function_md_digests,
+                   functions_md_digest(function_ids, metadata, category))
+
+    def matches(self, category, level, ignore=None):
+        """Return True if this matrix was built for category, level and ignore"""
+        return (self.category, self.level, self.ignore) == \
+            (category, level, ignore)
+
+    def matches_table(self, table):
+        """Return True if the functions of table are those this was built for
+
+        Every function of table must be in the matrix and, if table has
+        observation metadata, its metadata for self.category must be those
+        the matrix was built from. A cached matrix that fails this check was
+        built for a different reference (or an older release of it) and
+        should be rebuilt from table.
+
+        A table with the same functions as the matrix (the usual case) is
+        checked against functions_md_digest with a single digest. Only
+        tables with a subset of the functions are checked function by
+        function.
+        """
+        function_ids = table.ids(axis='observation')
+        metadata = table.metadata(axis='observation')
+        if metadata is not None and self.functions_md_digest is not None \
+                and list(function_ids) == self.function_ids:
+            return functions_md_digest(function_ids, metadata,
+                                       self.category) == \
+                self.functions_md_digest
+
+        function_lookup = dict((f, j) for j, f in enumerate(self.function_ids))
+        if metadata is None or self.function_md_digests is None:
+            return all(f in function_lookup for f in function_ids)
+
+        for function_id, md in zip(function_ids, metadata):
+            j = function_lookup.get(function_id)
+            if j is None or self.function_md_digests[j] != \
+                    category_md_digest(md, self.category):
+                return False
+        return True
+
+    def collapse(self, table):
+        """Return table collapsed to categories with a sparse matrix product
+
+        The result matches Table.collapse with one_to_many=True and
+        norm=False: each category holds the summed counts of its functions,
+        and only categories of functions in table are kept.
+        """
+        function_lookup = dict((f, j) for j, f in enumerate(self.function_ids))
+        function_ids = table.ids(axis='observation')
+        missing = [f for f in function_ids if f not in function_lookup]
+        if missing:
+            raise ValueError("%i functions in the table (e.g. %s) are not in"
+                             " the category membership matrix. Was it built"
+                             " for a different reference?"
+                             % (len(missing), missing[0]))
+
+        membership = self.membership[:, [function_lookup[f]
+                                         for f in function_ids]]
+        category_idxs = (membership.getnnz(axis=1) > 0).nonzero()[0]
+        membership = membership[category_idxs]
+
+        data = membership * table.matrix_data.tocsr()
+        return Table(data, [self.category_ids[i] for i in category_idxs],
+                     table.ids(),
+                     [self.category_md[i] for i in category_idxs],
+                     table.metadata(), type=table.type)
+
+    def save(self, output_fp):
+        """Save the membership matrix to output_fp (an .npz file)"""
+        header = {'format_version': CATEGORY_MEMBERSHIP_FORMAT_VERSION,
+                  'category': self.category,
+                  'level': self.level,
+                  'ignore': self.ignore,
+                  'function_ids': map(str, self.function_ids),
+                  'category_ids': map(str, self.category_ids),
+                  'category_md': self.category_md,
+                  'function_md_digests': self.function_md_digests,
+                  'functions_md_digest': self.functions_md_digest,
+                  'shape': list(self.membership.shape)}
+        with atomic_write(output_fp) as out_fh:
+            savez(out_fh, header=array(json.dumps(header)),
+                  data=self.membership.data,
+                  indices=self.membership.indices,
+                  indptr=self.membership.indptr)
+
+    @classmethod
+    def load(cls, input_fp):
+        """Load a membership matrix written by save()"""
+        arrays = numpy_load(input_fp, allow_pickle=False)
+        try:
+            header = json.loads(str(arrays['header']))
+            if header.get('format_version') != \
+                    CATEGORY_MEMBERSHIP_FORMAT_VERSION:
+                raise ValueError("%s is not a category membership file of"
+                                 " format version %s"
+                                 % (input_fp,
+                                    CATEGORY_MEMBERSHIP_FORMAT_VERSION))
+            membership = csr_matrix((asarray(arrays['data']),
+                                     asarray(arrays['indices']),
+                                     asarray(arrays['indptr'])),
+                                    shape=tuple(header['shape']))
+        finally:
+            arrays.close()
+        return cls(membership, map(str, header['function_ids']),
+                   map(str, header['category_ids']), header['category_md'],
+                   str(header['category']), header['level'], header['ignore'],
+                   header['function_md_digests'],
+                   header['functions_md_digest'])
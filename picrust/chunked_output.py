@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2015, The PICRUSt Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.1.4"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+__status__ = "Development"
+
+from os import remove, rename
+from os.path import exists, join, split
+from shutil import rmtree
+from tempfile import mkdtemp
+from numpy import asarray, int32, float64, load as numpy_load, save, zeros
+from scipy.sparse import csr_matrix, hstack
+from biom.table import Table
+from biom.util import biom_open
+from picrust.util import atomic_write
+
+# number of observations assembled at a time when the observation-major
+# matrix of a chunked BIOM file is written
+OBSERVATION_BLOCK_SIZE = 1000
+
+
+def iter_sample_chunks(table, chunk_size):
+    """Yield BIOM tables of at most chunk_size consecutive samples of table
+
+    Observations (and their metadata) are shared by every chunk. Only the
+    data of the samples in each chunk is copied, so that the chunks can be
+    processed one at a time without densifying the whole table.
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1, not %s" % chunk_size)
+
+    data = table.matrix_data.tocsc()
+    sample_ids = table.ids()
+    sample_md = table.metadata()
+    observation_ids = table.ids(axis='observation')
+    observation_md = table.metadata(axis='observation')
+    for start in range(0, len(sample_ids), chunk_size):
+        end = start + chunk_size
+        chunk_md = None
+        if sample_md is not None:
+            chunk_md = sample_md[start:end]
+        yield Table(data[:, start:end], observation_ids, sample_ids[start:end],
+                    observation_md, chunk_md, type=table.type)
+
+
+class ChunkedTableWriter(object):
+    """Write a BIOM table passed in by consecutive chunks of samples
+
+    Each chunk passed to write_chunk is spilled to a temporary directory as
+    sparse CSR arrays, so only one chunk needs to be held in memory at a
+    time. close() then assembles the output file from the spilled chunks:
+
+     - tab-delimited output (as written by Table.to_tsv) one observation
+       row at a time
+     - BIOM (HDF5) output by writing the sample-major matrix one chunk at a
+       time and the observation-major matrix OBSERVATION_BLOCK_SIZE
+       observations at a time into resizable datasets
+
+    Every chunk must have the same observations in the same order, as is the
+    case for predictions made against a single genome table.
+    """
+
+    def __init__(self, output_fp, tab_delimited=False, header_key=None,
+                 metadata_formatter=str, format_fs=None, compress=True,
+                 generated_by="PICRUSt " + __version__):
+        self.output_fp = output_fp
+        self.tab_delimited = tab_delimited
+        self.header_key = header_key
+        self.metadata_formatter = metadata_formatter
+        self.format_fs = format_fs
+        self.compress = compress
+        self.generated_by = generated_by
+
+        self.observation_ids = None
+        self.observation_md = None
+        self.table_type = None
+        self.sample_ids = []
+        self.sample_md = []
+        self._chunk_fps = []
+        self._tmp_dir = mkdtemp(prefix='picrust_chunks_')
+
+    def write_chunk(self, table):
+        """Spill the samples of table to disk"""
+        observation_ids = table.ids(axis='observation')
+        if self.observation_ids is None:
+            self.observation_ids = observation_ids
+            self.observation_md = table.metadata(axis='observation')
+            self.table_type = table.type
+        elif len(observation_ids) != len(self.observation_ids) or \
+             (observation_ids != self.observation_ids).any():
+            raise ValueError("All chunks must have the same observation ids"
+                             " in the same order")
+
+        sample_md = table.metadata()
+        if sample_md is None:
+            sample_md = [None] * len(table.ids())
+        self.sample_ids.extend(table.ids())
+        self.sample_md.extend(sample_md)
+
+        data = table.matrix_data.tocsr()
+        chunk_fp = join(self._tmp_dir, str(len(self._chunk_fps)))
+        for name in ['data', 'indices', 'indptr']:
+            save('%s.%s.npy' % (chunk_fp, name), getattr(data, name))
+        self._chunk_fps.append((chunk_fp, data.shape[1]))
+
+    def _load_chunk(self, chunk_fp, mmap_mode=None):
+        """Return the (data, indices, indptr) CSR arrays of a spilled chunk"""
+        return [numpy_load('%s.%s.npy' % (chunk_fp, name), mmap_mode=mmap_mode)
+                for name in ['data', 'indices', 'indptr']]
+
+    def _iter_observation_blocks(self, block_size):
+        """Yield CSR matrices of block_size observations across all samples"""
+        chunks = [(self._load_chunk(chunk_fp, mmap_mode='r'),
+                   n_samples) for chunk_fp, n_samples in self._chunk_fps]
+        n_observations = len(self.observation_ids)
+        for start in range(0, n_observations, block_size):
+            end = min(start + block_size, n_observations)
+            blocks = []
+            for (data, indices, indptr), n_samples in chunks:
+                first, last = indptr[start], indptr[end]
+                blocks.append(csr_matrix(
+                    (asarray(data[first:last]), asarray(indices[first:last]),
+                     asarray(indptr[start:end + 1]) - first),
+                    shape=(end - start, n_samples)))
+            yield hstack(blocks, format='csr')
+
+    def close(self):
+        """Write the output file and remove the spilled chunks"""
+        if self.observation_ids is None:
+            rmtree(self._tmp_dir)
+            raise ValueError("No chunks were written to %s" % self.output_fp)
+        try:
+            if self.tab_delimited:
+                self._write_tsv()
+            else:
+                self._write_hdf5()
+        finally:
+            rmtree(self._tmp_dir)
+
+    def _write_tsv(self):
+        header = ['#OTU ID'] + [str(s) for s in self.sample_ids]
+        if self.header_key:
+            header.append(self.header_key)
+        with atomic_write(self.output_fp) as out_fh:
+            out_fh.write('# Constructed from biom file\n')
+            out_fh.write('\t'.join(header))
+            # rows are made dense one at a time, so memory does not grow
+            # with the number of samples times the block size
+            row = zeros(len(self.sample_ids), dtype=float64)
+            i = 0
+            for block in self._iter_observation_blocks(OBSERVATION_BLOCK_SIZE):
+                for k in range(block.shape[0]):
+                    first, last = block.indptr[k], block.indptr[k + 1]
+                    row[:] = 0.0
+                    row[block.indices[first:last]] = block.data[first:last]
+                    fields = [str(self.observation_ids[i])] + map(str, row)
+                    if self.header_key:
+                        fields.append(self.metadata_formatter(
+                            self.observation_md[i][self.header_key]))
+                    out_fh.write('\n' + '\t'.join(fields))
+                    i += 1
+
+    def _write_hdf5(self):
+        # as with atomic_write, the file is written to a temporary path and
+        # only renamed to output_fp once it is complete
+        dir_name, basename = split(self.output_fp)
+        tmp_fp = join(dir_name, '~%s' % basename)
+        try:
+            self._write_hdf5_to(tmp_fp)
+        except:
+            if exists(tmp_fp):
+                remove(tmp_fp)
+            raise
+        rename(tmp_fp, self.output_fp)
+
+    def _write_hdf5_to(self, output_fp):
+        sample_md = self.sample_md
+        if all(md is None for md in sample_md):
+            sample_md = None
+        # write ids, metadata and attributes from an empty template table,
+        # then replace its (empty) matrices with the spilled data
+        template = Table(csr_matrix((len(self.observation_ids),
+                                     len(self.sample_ids))),
+                         self.observation_ids, self.sample_ids,
+                         self.observation_md, sample_md,
+                         type=self.table_type)
+        compression = 'gzip' if self.compress else None
+        with biom_open(output_fp, 'w') as h5_file:
+            template.to_hdf5(h5_file, self.generated_by, compress=False,
+                             format_fs=self.format_fs)
+
+            nnz = 0
+            matrix = self._create_matrix_datasets(h5_file['sample'], compression)
+            for chunk_fp, n_samples in self._chunk_fps:
+                data, indices, indptr = self._load_chunk(chunk_fp)
+                chunk = csr_matrix((data, indices, indptr),
+                                   shape=(len(self.observation_ids),
+                                          n_samples)).tocsc()
+                self._append_matrix(matrix, chunk, nnz)
+                nnz += chunk.nnz
+
+            matrix = self._create_matrix_datasets(h5_file['observation'],
+                                                  compression)
+            offset = 0
+            for block in self._iter_observation_blocks(OBSERVATION_BLOCK_SIZE):
+                self._append_matrix(matrix, block, offset)
+                offset += block.nnz
+            h5_file.attrs['nnz'] = nnz
+
+    def _create_matrix_datasets(self, axis_group, compression):
+        del axis_group['matrix']
+        matrix = axis_group.create_group('matrix')
+        for name, dtype in [('data', float64), ('indices', int32)]:
+            matrix.create_dataset(name, shape=(0,), maxshape=(None,),
+                                  dtype=dtype, chunks=True,
+                                  compression=compression)
+        matrix.create_dataset('indptr', shape=(1,), maxshape=(None,),
+                              dtype=int32, chunks=True,
+                              compression=compression, data=zeros(1))
+        return matrix
+
+    def _append_matrix(self, matrix, sparse_block, offset):
+        """Append a CSR or CSC block to the data/indices/indptr of matrix"""
+        for name, values in [('data', sparse_block.data),
+                             ('indices', sparse_block.indices),
+                             ('indptr', sparse_block.indptr[1:] + offset)]:
+            dataset = matrix[name]
+            start = dataset.shape[0]
+            dataset.resize((start + len(values),))
+            if len(values):
+                dataset[start:] = values
@@ -12,9 +12,34 @@ __email__ = "zaneveld@gmail.com"
 __status__ = "Development"
 
 
-from numpy import dot, array, around
-from biom.table import Table
-from picrust.predict_metagenomes import get_overlapping_ids,extract_otu_and_genome_data
+from gzip import GzipFile
+from itertools import izip
+from math import ceil
+from multiprocessing import Pool
+from os.path import abspath, dirname, join
+from shutil import copyfileobj, rmtree
+from tempfile import mkdtemp
+from numpy import arange, argpartition, array, indices, int32, int64, maximum,\
+  newaxis, zeros
+from picrust.predict_metagenomes import extract_otu_and_genome_matrices
+from picrust.util import atomic_write
+
+CONTRIBUTION_HEADER = ["Gene","Sample","OTU","GeneCountPerGenome",\
+  "OTUAbundanceInSample","CountContributedByOTU",\
+  "ContributionPercentOfSample","ContributionPercentOfAllSamples",\
+  "Kingdom","Phylum","Class","Order","Family","Genus","Species"]
+
+#Zero-valued total counts will be set to epsilon
+EPSILON = 1e-5
+
+#Columns of the HDF5 contributions output, and their data types
+CONTRIBUTION_HDF5_FORMAT = 'PICRUSt metagenome contributions'
+CONTRIBUTION_HDF5_FORMAT_VERSION = 1
+CONTRIBUTION_HDF5_COLUMNS = [('gene_idx','int32'),('sample_idx','int32'),\
+  ('otu_idx','int32'),('gene_count_per_genome','float32'),\
+  ('otu_abundance_in_sample','float32'),('count_contributed_by_otu','float32'),\
+  ('contribution_percent_of_sample','float32'),\
+  ('contribution_percent_of_all_samples','float32')]
 
 
 def make_pathway_filter_fn(ok_values,metadata_key='KEGG_Pathways',\
@@ -89,7 +114,8 @@ def make_pathway_filter_fn(ok_values,metadata_key='KEGG_Pathways',\
     return filter_observation_by_pathway
 
 def partition_metagenome_contributions(otu_table,genome_table, limit_to_functions=[],
-        limit_to_functional_categories=[], metadata_key = 'KEGG_Pathways',remove_zero_rows=True,verbose=True):
+        limit_to_functional_categories=[], metadata_key = 'KEGG_Pathways',remove_zero_rows=True,verbose=True,
+        top_k=None,min_percent=None):
     """Return a list of the contribution of each organism to each function, per sample
     (rewritten version using numpy)
     otu_table -- the BIOM Table object for the OTU table
@@ -100,10 +126,51 @@ def partition_metagenome_contributions(otu_table,genome_table, limit_to_function
     limit_by_function_categories -- if provided limit by functional category.
       For example, this can be used to limit output by KEGG functional categories
 
+    top_k -- if provided, only output the top_k contributing OTUs for each
+      function in each sample
+    min_percent -- if provided, only output OTUs contributing at least this
+      percentage (0-100) of a function's counts in a sample
+
     Output table as a list of lists with header
     Function\tOrganism\tSample\tCounts\tpercent_of_sample
     """
 
+    result = [list(CONTRIBUTION_HEADER)]
+    for gene_rows in iter_metagenome_contributions(otu_table,genome_table,\
+      limit_to_functions=limit_to_functions,\
+      limit_to_functional_categories=limit_to_functional_categories,\
+      metadata_key=metadata_key,remove_zero_rows=remove_zero_rows,\
+      verbose=verbose,top_k=top_k,min_percent=min_percent):
+        result.extend(gene_rows)
+
+    return result
+
+
+def iter_metagenome_contributions(otu_table,genome_table,limit_to_functions=[],
+        limit_to_functional_categories=[],metadata_key='KEGG_Pathways',\
+        remove_zero_rows=True,verbose=True,top_k=None,min_percent=None):
+    """Return a generator of the contribution rows of each function in turn
+
+    Takes the same arguments as partition_metagenome_contributions, but
+    rather than one list of all rows (which for all KOs can be far larger
+    than memory), yields one list of rows per function. Pass the result to
+    write_metagenome_contributions to write them out as they are made.
+
+    The genome table is filtered straight away, so invalid filters raise
+    before any rows are generated.
+    """
+    genome_table = filter_genome_table_by_function(genome_table,\
+      limit_to_functions=limit_to_functions,\
+      limit_to_functional_categories=limit_to_functional_categories,\
+      metadata_key=metadata_key,verbose=verbose)
+    return iter_gene_contributions(otu_table,genome_table,\
+      remove_zero_rows=remove_zero_rows,top_k=top_k,min_percent=min_percent)
+
+
+def filter_genome_table_by_function(genome_table,limit_to_functions=[],
+        limit_to_functional_categories=[],metadata_key='KEGG_Pathways',\
+        verbose=True):
+    """Return genome_table limited to the given functions and functional categories"""
     if limit_to_functions:
         if verbose:
             print "Filtering the genome table to include only user-specified functions:",limit_to_functions
@@ -122,54 +189,361 @@ def partition_metagenome_contributions(otu_table,genome_table, limit_to_function
         if genome_table.is_empty():
             raise ValueError("User filtering by functional categories (%s) removed all results from the genome table"%(str(limit_to_functional_categories)))
 
-    otu_data,genome_data,overlapping_ids = extract_otu_and_genome_data(otu_table,genome_table)
-    #We have a list of data with abundances and gene copy numbers
-    lines=[]
-    result = [["Gene","Sample","OTU","GeneCountPerGenome",\
-            "OTUAbundanceInSample","CountContributedByOTU",\
-            "ContributionPercentOfSample","ContributionPercentOfAllSamples",
-                   "Kingdom","Phylum","Class","Order","Family","Genus","Species"]]
-
-
-    #Zero-valued total counts will be set to epsilon
-    epsilon = 1e-5
-
-    for j,gene_id in enumerate(genome_table.ids(axis='observation')):
-        all_gene_rows = []
-        for k,sample_id in enumerate(otu_table.ids()):
-            #Add raw counts for the gene in this sample to a list
-            sample_gene_rows = []
-            for i,otu_id in enumerate(overlapping_ids):
-                otu_gene_count = genome_data[i][j]
-                otu_abundance = otu_data[i][k]
-                contribution =  otu_gene_count * otu_abundance
-                if remove_zero_rows and contribution == 0.0:
-                    #skip zero contributions
+    return genome_table
+
+
+def write_metagenome_contributions(row_batches,output_fp,\
+        header=CONTRIBUTION_HEADER):
+    """Write batches of contribution rows to output_fp as they are generated
+
+    row_batches -- an iterable of lists of rows, e.g. as returned by
+      iter_metagenome_contributions
+    output_fp -- the output filepath. Output is gzipped if it ends in .gz
+    header -- the header row, or None to write rows only
+
+    Rows are formatted and written one batch at a time, so memory use does
+    not grow with the size of the output. The output is only moved to
+    output_fp once all rows have been written. Returns the number of rows
+    written (excluding the header).
+    """
+    n_rows = 0
+    with atomic_write(output_fp) as out_fh:
+        if output_fp.endswith('.gz'):
+            out_fh = GzipFile(fileobj=out_fh,mode='wb')
+        try:
+            if header is not None:
+                out_fh.write("\t".join(header))
+            for rows in row_batches:
+                if not rows:
                     continue
-                sample_gene_rows.append([gene_id,sample_id,otu_id,otu_gene_count,otu_abundance,contribution])
-            #Now get the percentage of each genes contribution to the sample overall
-            total_counts =max(epsilon,sum([float(row[-1]) for row in sample_gene_rows]))
+                if n_rows or header is not None:
+                    out_fh.write("\n")
+                out_fh.write("\n".join(["\t".join(map(str,row)) for row in rows]))
+                n_rows += len(rows)
+        finally:
+            if isinstance(out_fh,GzipFile):
+                out_fh.close()
+    return n_rows
+
+
+# Data used by the worker processes of write_metagenome_contributions_parallel.
+# It is set before the worker pool is created, so that forked workers share
+# the parent's copy of the aligned OTU and genome matrices.
+_shared_contributions = {}
+
+
+def _write_contributions_shard(shard):
+    """Write the contribution rows of one range of genes to a partition file"""
+    start,end,partition_fp = shard
+    data = _shared_contributions
+    arrays = iter_gene_contribution_arrays(data['otu_data'],\
+      data['genome_data'][:,start:end],data['remove_zero_rows'],\
+      top_k=data['top_k'],min_percent=data['min_percent'])
+    row_batches = (contribution_rows(gene_id,gene_arrays,data['sample_ids'],\
+      data['otu_ids'],data['taxonomy']) for gene_id,gene_arrays in \
+      izip(data['gene_ids'][start:end],arrays))
+    return write_metagenome_contributions(row_batches,partition_fp,header=None)
+
+
+def write_metagenome_contributions_parallel(otu_table,genome_table,output_fp,\
+        n_procs,remove_zero_rows=True,top_k=None,min_percent=None):
+    """Write contribution rows with the genes split across n_procs processes
+
+    otu_table -- the BIOM Table object for the OTU table
+    genome_table -- the BIOM Table object for the predicted genomes, already
+      filtered (e.g. with filter_genome_table_by_function) if needed
+    output_fp -- the output filepath. Output is gzipped if it ends in .gz
+    n_procs -- number of worker processes
+
+    Contributions to each gene are independent, so the genes are split into
+    one contiguous range per process. Each worker writes its rows to its own
+    partition file, and the partitions are then concatenated in order, so
+    the output is identical to write_metagenome_contributions. Returns the
+    number of rows written (excluding the header).
+    """
+    otu_data,genome_data,otu_ids = \
+      extract_otu_and_genome_matrices(otu_table,genome_table)
+    gene_ids = list(genome_table.ids(axis='observation'))
+    n_procs = max(1,min(n_procs,len(gene_ids)))
+    shard_size = max(1,int(ceil(len(gene_ids)/n_procs)))
+
+    partition_dir = mkdtemp(dir=dirname(abspath(output_fp)),\
+      prefix='contribution_partitions_')
+    shards = [(start,min(start+shard_size,len(gene_ids)),\
+      join(partition_dir,'%i.tab' %i)) for i,start in \
+      enumerate(range(0,len(gene_ids),shard_size))]
+
+    _shared_contributions.update(otu_data=otu_data.tocsr(),\
+      genome_data=genome_data.tocsc(),gene_ids=gene_ids,\
+      sample_ids=list(otu_table.ids()),otu_ids=otu_ids,\
+      taxonomy=taxonomy_by_otu(otu_table,otu_ids),\
+      remove_zero_rows=remove_zero_rows,top_k=top_k,min_percent=min_percent)
+    try:
+        pool = Pool(n_procs)
+        try:
+            shard_rows = pool.map(_write_contributions_shard,shards)
+        finally:
+            pool.close()
+            pool.join()
+            _shared_contributions.clear()
+
+        with atomic_write(output_fp) as out_fh:
+            if output_fp.endswith('.gz'):
+                out_fh = GzipFile(fileobj=out_fh,mode='wb')
+            try:
+                out_fh.write("\t".join(CONTRIBUTION_HEADER))
+                for (start,end,partition_fp),n_rows in zip(shards,shard_rows):
+                    if not n_rows:
+                        continue
+                    out_fh.write("\n")
+                    with open(partition_fp,'rb') as partition_fh:
+                        copyfileobj(partition_fh,out_fh)
+            finally:
+                if isinstance(out_fh,GzipFile):
+                    out_fh.close()
+    finally:
+        rmtree(partition_dir)
+    return sum(shard_rows)
+
+
+def taxonomy_by_otu(otu_table,otu_ids):
+    """Return the taxonomy (as a list, or [] if missing) of each of otu_ids"""
+    o_md = otu_table.metadata(axis='observation')
+    if o_md is None:
+        return [[] for otu_id in otu_ids]
+
+    result = []
+    for otu_id in otu_ids:
+        md = o_md[otu_table.index(otu_id, 'observation')]
+        if md is not None and 'taxonomy' in md:
+            result.append(list(md['taxonomy']))
+        else:
+            result.append([])
+    return result
 
-            for row in sample_gene_rows:
-                percent_of_sample = float(row[-1])/total_counts
-                row.append(percent_of_sample)
-            all_gene_rows.extend(sample_gene_rows)
 
-        count_idx = -2 #Counts are now in the next to last position in each row
-        total_counts =max(epsilon,sum([float(row[count_idx]) for row in all_gene_rows]))
-        otu_index=2 #position of otu ids in the table
+def iter_gene_contributions(otu_table,genome_table,remove_zero_rows=True,\
+        top_k=None,min_percent=None):
+    """Yield, for each gene of genome_table in turn, its list of contribution rows
 
-        o_md = otu_table.metadata(axis='observation')
-        for row in all_gene_rows:
-            percent_of_sample = float(row[count_idx])/total_counts
-            row.append(percent_of_sample)
+    Rows are ordered by sample, then OTU, and have the columns of
+    CONTRIBUTION_HEADER (followed by the taxonomy of the OTU, if any).
+    top_k and min_percent limit the OTUs reported per gene and sample, as
+    in iter_gene_contribution_arrays.
+    """
+    otu_data,genome_data,otu_ids = \
+      extract_otu_and_genome_matrices(otu_table,genome_table)
+    sample_ids = list(otu_table.ids())
+    taxonomy = taxonomy_by_otu(otu_table,otu_ids)
 
-            #add taxonomy information for each OTU
-            obs_index = otu_table.index(row[otu_index], 'observation')
-            if o_md is not None and 'taxonomy' in o_md[obs_index]:
-                row.extend(o_md[obs_index]['taxonomy'])
+    for gene_id,arrays in izip(genome_table.ids(axis='observation'),\
+      iter_gene_contribution_arrays(otu_data,genome_data,remove_zero_rows,\
+      top_k=top_k,min_percent=min_percent)):
+        yield contribution_rows(gene_id,arrays,sample_ids,otu_ids,taxonomy)
 
-        lines.extend(all_gene_rows)
-    result.extend(lines)
 
-    return result
+def contribution_rows(gene_id,arrays,sample_ids,otu_ids,taxonomy):
+    """Return output rows for the contribution arrays of one gene
+
+    arrays -- a tuple of arrays as yielded by iter_gene_contribution_arrays
+    sample_ids, otu_ids, taxonomy -- the sample ids, OTU ids and OTU
+      taxonomies that the sample and OTU indices of arrays refer to
+
+    Gene counts, OTU abundances and contributed counts are kept as numpy
+    scalars, which str() formats at full precision. tolist() would turn
+    them into Python floats, which str() rounds to 12 significant digits.
+    """
+    sample_idxs,otu_idxs,gene_counts,abundances,counts,percents,\
+      percents_all = arrays
+    rows = []
+    for k,i,gene_count,abundance,count,percent,percent_all in \
+      izip(sample_idxs.tolist(),otu_idxs.tolist(),gene_counts,abundances,\
+      counts,percents.tolist(),percents_all.tolist()):
+        rows.append([gene_id,sample_ids[k],otu_ids[i],gene_count,\
+          abundance,count,percent,percent_all] + taxonomy[i])
+    return rows
+
+
+def iter_gene_contribution_arrays(otu_data,genome_data,remove_zero_rows=True,\
+        top_k=None,min_percent=None):
+    """Yield the contributions to each gene as arrays, one gene at a time
+
+    otu_data -- OTUs x samples sparse matrix of OTU abundances
+    genome_data -- OTUs x genes sparse matrix of gene copy numbers, with
+      the same OTUs as otu_data (see extract_otu_and_genome_matrices)
+
+    top_k -- if given, only keep the top_k contributing OTUs for each gene
+      in each sample (ties at the cut-off are broken arbitrarily)
+    min_percent -- if given, only keep OTUs contributing at least this
+      percentage (0-100) of the gene's counts in a sample
+
+    For each gene (column of genome_data), yields a tuple of arrays
+    (sample_idxs, otu_idxs, gene_counts, otu_abundances, counts,
+    percent_of_sample, percent_of_all_samples) with one element per
+    contributing OTU and sample, ordered by sample, then OTU. Percentages
+    are always relative to the contributions of all OTUs, including any
+    left out by top_k or min_percent.
+
+    The contribution of each OTU to a gene in each sample is the outer
+    product of the gene's copy numbers in the OTUs that have it and those
+    OTUs' abundances. Percentages of the sample and of all samples are then
+    calculated from the column and total sums of that block.
+    """
+    #OTUs x samples, with rows selected per gene
+    otu_data = otu_data.tocsr()
+    #OTUs x genes, with one column per gene
+    genome_data = genome_data.tocsc()
+    genome_data.sort_indices()
+    n_otus = otu_data.shape[0]
+
+    for j in range(genome_data.shape[1]):
+        start,end = genome_data.indptr[j],genome_data.indptr[j+1]
+        if remove_zero_rows:
+            #only OTUs with the gene can contribute to it
+            gene_otus = genome_data.indices[start:end]
+            gene_counts = genome_data.data[start:end]
+        else:
+            gene_otus = arange(n_otus)
+            gene_counts = zeros(n_otus)
+            gene_counts[genome_data.indices[start:end]] = genome_data.data[start:end]
+
+        #OTUs x samples block of abundances and contributions, transposed
+        #so that nonzero() returns pairs ordered by sample, then OTU
+        abundances = otu_data[gene_otus].toarray().T
+        contributions = abundances * gene_counts
+        sample_totals = maximum(EPSILON,contributions.sum(axis=1))
+        gene_total = max(EPSILON,contributions.sum())
+
+        keep = None
+        if remove_zero_rows:
+            keep = contributions != 0
+        if top_k is not None and top_k < contributions.shape[1]:
+            #partial sort of each sample's contributions to find the top k
+            top = argpartition(-contributions,top_k-1,axis=1)[:,:top_k]
+            in_top = zeros(contributions.shape,dtype=bool)
+            in_top[arange(contributions.shape[0])[:,newaxis],top] = True
+            keep = in_top if keep is None else keep & in_top
+        if min_percent:
+            above = contributions >= \
+              sample_totals[:,newaxis] * (min_percent/100.0)
+            keep = above if keep is None else keep & above
+
+        if keep is None:
+            sample_idxs,pair_idxs = indices(contributions.shape).reshape(2,-1)
+        else:
+            sample_idxs,pair_idxs = keep.nonzero()
+
+        counts = contributions[sample_idxs,pair_idxs]
+        yield (sample_idxs,gene_otus[pair_idxs],gene_counts[pair_idxs],\
+          abundances[sample_idxs,pair_idxs],counts,\
+          counts/sample_totals[sample_idxs],counts/gene_total)
+
+
+def _encode_strings(values):
+    """Return values as a list of utf-8 encoded strings for h5py"""
+    return [v.encode('utf-8') if isinstance(v,unicode) else str(v)\
+      for v in values]
+
+
+def write_metagenome_contributions_hdf5(otu_table,genome_table,output_fp,\
+        remove_zero_rows=True,compress=True,top_k=None,min_percent=None):
+    """Write contributions to an HDF5 file of integer-coded columns
+
+    otu_table -- the BIOM Table object for the OTU table
+    genome_table -- the BIOM Table object for the predicted genomes, already
+      filtered (e.g. with filter_genome_table_by_function) if needed
+    output_fp -- the HDF5 file to write
+    top_k, min_percent -- limit the OTUs reported per gene and sample, as
+      in iter_gene_contribution_arrays
+
+    Rather than repeating the gene, sample, OTU and taxonomy strings on
+    every row, the file holds:
+
+     - genes/ids, samples/ids, otus/ids and otus/taxonomy (';' separated):
+       the dictionaries the integer columns index into
+     - contributions/<column>: one dataset per column of
+       CONTRIBUTION_HDF5_COLUMNS. Index columns are int32, values float32.
+     - genes/offsets: rows offsets[i] to offsets[i+1] of the contribution
+       columns hold the contributions to gene i, ordered by sample and then
+       OTU, so that the contributions to one gene can be read without
+       scanning the whole file.
+
+    Returns the number of contribution rows written.
+    """
+    import h5py
+
+    otu_data,genome_data,otu_ids = \
+      extract_otu_and_genome_matrices(otu_table,genome_table)
+    gene_ids = genome_table.ids(axis='observation')
+    string_dtype = h5py.special_dtype(vlen=str)
+    compression = 'gzip' if compress else None
+
+    n_rows = 0
+    offsets = [0]
+    with h5py.File(output_fp,'w') as h5_file:
+        h5_file.attrs['format'] = CONTRIBUTION_HDF5_FORMAT
+        h5_file.attrs['format_version'] = CONTRIBUTION_HDF5_FORMAT_VERSION
+        for group,values in [('genes',gene_ids),('samples',otu_table.ids()),\
+          ('otus',otu_ids)]:
+            h5_file.create_dataset('%s/ids' %group,\
+              data=_encode_strings(values),dtype=string_dtype)
+        h5_file.create_dataset('otus/taxonomy',dtype=string_dtype,\
+          data=_encode_strings([';'.join(t) for t in \
+          taxonomy_by_otu(otu_table,otu_ids)]))
+
+        columns = []
+        for name,dtype in CONTRIBUTION_HDF5_COLUMNS:
+            columns.append(h5_file.create_dataset('contributions/%s' %name,\
+              shape=(0,),maxshape=(None,),dtype=dtype,chunks=(65536,),\
+              compression=compression))
+
+        for j,arrays in enumerate(iter_gene_contribution_arrays(otu_data,\
+          genome_data,remove_zero_rows,top_k=top_k,min_percent=min_percent)):
+            n_gene_rows = len(arrays[0])
+            if n_gene_rows:
+                gene_idxs = zeros(n_gene_rows,dtype=int32) + j
+                for dataset,values in zip(columns,(gene_idxs,)+arrays):
+                    dataset.resize((n_rows+n_gene_rows,))
+                    dataset[n_rows:] = values
+                n_rows += n_gene_rows
+            offsets.append(n_rows)
+
+        h5_file.create_dataset('genes/offsets',data=array(offsets,dtype=int64))
+    return n_rows
+
+
+def load_metagenome_contributions_hdf5(input_fp,gene_id,sample_ids=None):
+    """Return contribution rows for gene_id from an HDF5 contributions file
+
+    input_fp -- a file written by write_metagenome_contributions_hdf5
+    gene_id -- the gene to load contributions for
+    sample_ids -- if given, only rows for these samples are returned
+
+    Rows have the same columns as partition_metagenome_contributions. Only
+    the rows for gene_id are read from disk.
+    """
+    import h5py
+
+    with h5py.File(input_fp,'r') as h5_file:
+        gene_ids = list(h5_file['genes/ids'][:])
+        if gene_id not in gene_ids:
+            raise KeyError("Gene %s is not in %s" %(gene_id,input_fp))
+        j = gene_ids.index(gene_id)
+        start,end = h5_file['genes/offsets'][j:j+2]
+        columns = [h5_file['contributions/%s' %name][start:end] \
+          for name,dtype in CONTRIBUTION_HDF5_COLUMNS]
+        all_sample_ids = h5_file['samples/ids'][:]
+        otu_ids = h5_file['otus/ids'][:]
+        taxonomy = h5_file['otus/taxonomy'][:]
+
+    if sample_ids is not None:
+        sample_ids = set(sample_ids)
+    rows = []
+    for row in zip(*[c.tolist() for c in columns]):
+        sample_id = all_sample_ids[row[1]]
+        if sample_ids is not None and sample_id not in sample_ids:
+            continue
+        otu_taxonomy = taxonomy[row[2]]
+        rows.append([gene_id,sample_id,otu_ids[row[2]]] + list(row[3:]) +\
+          (otu_taxonomy.split(';') if otu_taxonomy else []))
+    return rows
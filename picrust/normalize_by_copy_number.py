@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2015, The PICRUSt Project"
+__credits__ = ["agent", "Greg Caporaso", "Morgan Langille"]
+__license__ = "GPL"
+__version__ = "1.1.4"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+__status__ = "Development"
+
+from numpy import array, diff, floor, isfinite, repeat
+from biom.table import Table
+
+
+def align_copy_numbers(otu_ids, count_table):
+    """Return the copy numbers of otu_ids found in count_table
+
+    otu_ids -- the OTU ids of the OTU table, in order
+    count_table -- a BIOM Table object of copy numbers with OTUs as samples
+      and the marker gene as its (first) observation, as loaded by
+      load_data_table with transpose=True
+
+    Returns (otu_idxs, copy_numbers): the indices into otu_ids of the OTUs
+    that have a copy number, in their original order, and an int array of
+    their copy numbers (rounded to the nearest integer). OTUs without a copy
+    number are dropped.
+    """
+    count_otu_ids = count_table.ids()
+    count_idx_lookup = dict((str(otu_id), i)
+                            for i, otu_id in enumerate(count_otu_ids))
+
+    otu_idxs = []
+    count_idxs = []
+    for i, otu_id in enumerate(otu_ids):
+        count_idx = count_idx_lookup.get(str(otu_id))
+        if count_idx is not None:
+            otu_idxs.append(i)
+            count_idxs.append(count_idx)
+
+    if not otu_idxs:
+        raise ValueError("No common OTUs between the otu table and the"
+                         " copy number table!")
+
+    #copy numbers of the marker gene are the first observation
+    values = count_table.matrix_data.getrow(0).toarray().ravel()[count_idxs]
+
+    invalid = ~isfinite(values)
+    if invalid.any():
+        raise ValueError("Invalid type passed as copy number for OTU ID %s."
+                         " Must be int-able."
+                         % otu_ids[otu_idxs[invalid.nonzero()[0][0]]])
+
+    #data can be floats so round them (halves away from zero, as round
+    #does) and make them integers
+    copy_numbers = floor(values + 0.5).astype(int)
+    if (copy_numbers < 1).any():
+        raise ValueError("Copy numbers must be greater than or equal to 1.")
+
+    return array(otu_idxs, dtype=int), copy_numbers
+
+
+def normalize_by_copy_number(otu_table, count_table,
+                             metadata_identifier='CopyNumber'):
+    """Return otu_table with each OTU's counts divided by its copy number
+
+    otu_table -- a BIOM Table object of OTUs (observations) by samples
+    count_table -- a BIOM Table object of copy numbers, as passed to
+      align_copy_numbers
+    metadata_identifier -- the observation metadata key under which each
+      OTU's copy number is recorded in the output
+
+    OTUs without a copy number are dropped. Observation metadata of the
+    remaining OTUs is kept. The OTU ids are aligned to the copy number table
+    once, and the non-zero counts are divided by the copy number of their
+    row in a single sparse operation, so the table is never densified.
+    """
+    otu_ids = otu_table.ids(axis='observation')
+    otu_idxs, copy_numbers = align_copy_numbers(otu_ids, count_table)
+
+    data = otu_table.matrix_data.tocsr()[otu_idxs].astype(float)
+    data.data /= repeat(copy_numbers, diff(data.indptr))
+
+    observation_md = otu_table.metadata(axis='observation')
+    normalized_md = []
+    for i, copy_number in zip(otu_idxs, copy_numbers):
+        md = {}
+        if observation_md is not None and observation_md[i] is not None:
+            md.update(observation_md[i])
+        md[metadata_identifier] = int(copy_number)
+        normalized_md.append(md)
+
+    return Table(data, [otu_ids[i] for i in otu_idxs], otu_table.ids(),
+                 normalized_md)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2015, The PICRUSt Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.1.4"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+__status__ = "Development"
+
+from os.path import basename, join
+from picrust.normalize_by_copy_number import normalize_by_copy_number
+from picrust.predict_metagenomes import predict_metagenomes
+from picrust.categorize_by_function import CategoryMembership
+
+# metadata category that predictions of each type are categorized by
+DEFAULT_METADATA_CATEGORIES = {'ko': 'KEGG_Pathways',
+                               'cog': 'COG_Category'}
+
+
+def membership_cache_fp(cache_dir, genome_table_fp, category, level,
+                        ignore=None):
+    """Return the cached category membership filepath for a reference
+
+    The cache file is named after the precalculated table the functions
+    were predicted from (e.g. ko_13_5_precalculated.tab.gz gives
+    ko_13_5_precalculated.KEGG_Pathways.L3.npz), so each reference release
+    has its own cache file per metadata category, level and ignore list.
+    """
+    reference = basename(genome_table_fp).split('.')[0]
+    fields = [reference, category, 'L%i' % level]
+    if ignore:
+        fields.append('ignore-%s' % ignore.replace(',', '-'))
+    return join(cache_dir, '.'.join(fields) + '.npz')
+
+
+def normalize_predict_categorize(otu_table, copy_number_table, genome_table,
+                                 category=None, levels=(), ignore=None,
+                                 memberships=None, whole_round=True,
+                                 metadata_identifier='CopyNumber'):
+    """Normalize, predict and categorize an OTU table without leaving memory
+
+    otu_table -- a BIOM Table object of OTU counts
+    copy_number_table -- a BIOM Table object of marker gene copy numbers,
+      as loaded for normalize_by_copy_number
+    genome_table -- a BIOM Table object of function counts per OTU, as
+      loaded for predict_metagenomes
+    category -- the function metadata category to collapse to (e.g.
+      KEGG_Pathways), or None to skip categorization
+    levels -- the levels of category to collapse to
+    ignore -- comma-separated category names to ignore, as passed to
+      make_collapse_f
+    memberships -- a dict of {level: CategoryMembership} to reuse (e.g.
+      loaded from a cache). Memberships built here are added to it, and
+      replace any whose function metadata do not match the predicted
+      metagenome (e.g. a cache built from another reference release).
+    whole_round -- round predictions to whole numbers
+
+    Each stage consumes the previous stage's table directly, rather than
+    writing it out and parsing it back in as the individual scripts do.
+
+    Returns (normalized otu table, predicted metagenome,
+    [categorized metagenome for each of levels]).
+    """
+    if memberships is None:
+        memberships = {}
+
+    normalized_table = normalize_by_copy_number(otu_table, copy_number_table,
+        metadata_identifier=metadata_identifier)
+    predicted_metagenome = predict_metagenomes(normalized_table, genome_table,
+                                               whole_round=whole_round)
+
+    categorized_metagenomes = []
+    if category is not None:
+        for level in levels:
+            if level in memberships and \
+                    not memberships[level].matches(category, level, ignore):
+                raise ValueError("The category membership for level %i was"
+                                 " built for %s at level %s" %
+                                 (level, memberships[level].category,
+                                  memberships[level].level))
+            if level not in memberships or \
+                    not memberships[level].matches_table(predicted_metagenome):
+                memberships[level] = CategoryMembership.from_table(
+                    predicted_metagenome, category, level, ignore)
+            categorized_metagenomes.append(
+                memberships[level].collapse(predicted_metagenome))
+
+    return normalized_table, predicted_metagenome, categorized_metagenomes
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2015, The PICRUSt Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.1.4"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+__status__ = "Development"
+
+from os.path import exists, getsize
+from zlib import compressobj, decompress, DEFLATED, MAX_WBITS, Z_DEFAULT_COMPRESSION
+import gzip
+from picrust.util import atomic_write
+
+# An indexed precalc file is an ordinary .tab.gz made of many independent gzip
+# members (as in BGZF): the first holds the header and metadata rows, each of
+# the others a run of OTU rows. gzip, zcat and convert_precalc_to_biom read it
+# like any other .gz file. The sidecar <precalc file>.idx lists the offset and
+# length of every member and the OTU ids it holds, so that only the members
+# holding requested OTUs need to be decompressed.
+PRECALC_INDEX_EXT = '.idx'
+PRECALC_INDEX_HEADER = '# PICRUSt precalc block index v1'
+
+# target uncompressed size of each block of OTU rows
+DEFAULT_BLOCK_SIZE = 65536
+
+# wbits value for reading and writing gzip (rather than zlib) streams
+GZIP_WBITS = 16 + MAX_WBITS
+
+
+def precalc_index_fp(precalc_fp):
+    """Return the path of the block index for a precalc file"""
+    return precalc_fp + PRECALC_INDEX_EXT
+
+
+def gzip_block(data, level=Z_DEFAULT_COMPRESSION):
+    """Return data compressed as a single, complete gzip member"""
+    compressor = compressobj(level, DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def index_precalc_file(precalc_fp, output_fp=None, block_size=DEFAULT_BLOCK_SIZE,
+                       md_prefix='metadata_'):
+    """Recompress a precalc file into gzip blocks and write its block index
+
+    precalc_fp -- a tab-delimited precalc file (gzipped or not)
+    output_fp -- the indexed .gz file to write. If None, precalc_fp is
+      replaced (it must then be gzipped).
+    block_size -- target uncompressed size of each block of OTU rows. Smaller
+      blocks mean less wasted decompression when loading a few OTUs, at the
+      cost of a slightly larger file.
+
+    Returns the number of blocks of OTU rows written.
+    """
+    if output_fp is None:
+        if not precalc_fp.endswith('.gz'):
+            raise ValueError("Only gzipped precalc files can be indexed in"
+                             " place. Pass an output filepath ending in .gz")
+        output_fp = precalc_fp
+
+    if precalc_fp.endswith('.gz'):
+        precalc_fh = gzip.open(precalc_fp, 'rb')
+    else:
+        precalc_fh = open(precalc_fp, 'U')
+
+    index_lines = []
+    with atomic_write(output_fp) as out_fh:
+        offset = [0]
+
+        def write_block(lines, ids):
+            block = gzip_block(''.join(lines))
+            out_fh.write(block)
+            index_lines.append('\t'.join(
+                [str(offset[0]), str(len(block))] + ids))
+            offset[0] += len(block)
+
+        #the header and metadata rows make up the first block
+        lines = [precalc_fh.readline()]
+        ids = []
+        in_header_block = True
+        size = 0
+        for line in precalc_fh:
+            row_id = line.split('\t', 1)[0].strip()
+            if in_header_block:
+                if row_id.startswith(md_prefix) or not row_id:
+                    lines.append(line)
+                    continue
+                write_block(lines, [])
+                lines = []
+                in_header_block = False
+            elif row_id.startswith(md_prefix):
+                raise ValueError("Metadata row %s follows OTU rows. Metadata"
+                                 " rows must come directly after the header"
+                                 " to index a precalc file." % row_id)
+
+            lines.append(line)
+            ids.append(row_id)
+            size += len(line)
+            if size >= block_size:
+                write_block(lines, ids)
+                lines = []
+                ids = []
+                size = 0
+
+        if in_header_block or lines:
+            write_block(lines, ids)
+    precalc_fh.close()
+
+    with atomic_write(precalc_index_fp(output_fp)) as index_fh:
+        index_fh.write('%s\n' % PRECALC_INDEX_HEADER)
+        index_fh.write('#size\t%i\n' % getsize(output_fp))
+        index_fh.write('\n'.join(index_lines))
+        index_fh.write('\n')
+
+    return len(index_lines) - 1
+
+
+def has_precalc_index(precalc_fp):
+    """Return True if precalc_fp has an up to date block index
+
+    An index is considered stale (and is ignored) if the size of the precalc
+    file no longer matches the size recorded when it was indexed, e.g.
+    because the file was downloaded again.
+    """
+    index_fp = precalc_index_fp(precalc_fp)
+    if not (exists(precalc_fp) and exists(index_fp)):
+        return False
+    with open(index_fp, 'U') as index_fh:
+        if index_fh.readline().strip() != PRECALC_INDEX_HEADER:
+            return False
+        fields = index_fh.readline().strip().split('\t')
+    return fields[0] == '#size' and int(fields[1]) == getsize(precalc_fp)
+
+
+def find_precalc_blocks(index_lines, ids_to_load):
+    """Return [(offset,length)] of the blocks holding the header and ids_to_load
+
+    index_lines -- lines of a block index, as written by index_precalc_file
+    ids_to_load -- the OTU ids of interest
+
+    Blocks are returned in file order, starting with the header block.
+    """
+    ids_to_load = set(ids_to_load)
+    blocks = []
+    for line in index_lines:
+        if line.startswith('#'):
+            continue
+        fields = line.rstrip('\n').split('\t')
+        if not blocks or not ids_to_load.isdisjoint(fields[2:]):
+            blocks.append((int(fields[0]), int(fields[1])))
+    return blocks
+
+
+def iter_indexed_precalc_lines(precalc_fp, ids_to_load):
+    """Yield the header and metadata lines and the blocks holding ids_to_load
+
+    Only the gzip blocks of precalc_fp that contain at least one of
+    ids_to_load are read and decompressed. Lines of other OTUs that share a
+    block with a requested OTU are yielded too.
+    """
+    with open(precalc_index_fp(precalc_fp), 'U') as index_fh:
+        blocks = find_precalc_blocks(index_fh, ids_to_load)
+
+    with open(precalc_fp, 'rb') as precalc_fh:
+        for offset, length in blocks:
+            precalc_fh.seek(offset)
+            data = decompress(precalc_fh.read(length), GZIP_WBITS)
+            for line in data.splitlines(True):
+                yield line
+
+
+class LineReader(object):
+    """Minimal read-only file object over an iterator of lines
+
+    Lets line generators be passed to functions that expect an open file,
+    such as convert_precalc_to_biom.
+    """
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+
+    def readline(self):
+        return next(self._lines, '')
+
+    def __iter__(self):
+        return self._lines
+
+
+def open_indexed_precalc(precalc_fp, ids_to_load):
+    """Return a file-like object over the parts of precalc_fp for ids_to_load"""
+    return LineReader(iter_indexed_precalc_lines(precalc_fp, ids_to_load))
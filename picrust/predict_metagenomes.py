@@ -11,10 +11,26 @@ __maintainer__ = "Greg Caporaso"
 __email__ = "gregcaporaso@gmail.com"
 __status__ = "Development"
 
-from numpy import abs,compress, dot, array, around, asarray,empty,zeros, sum as numpy_sum,sqrt,apply_along_axis
+from numpy import abs,compress, dot, array, around, asarray,empty,zeros, sum as numpy_sum,sqrt,apply_along_axis,\
+  intersect1d,hstack,unique,arange,ones,concatenate,diff,column_stack,\
+  flatnonzero,array_equal
+from numpy.random import RandomState
+from biom import load_table
 from biom.table import Table
 from biom.parse import parse_biom_table, get_axis_indices, direct_slice_data, direct_parse_key
+from os import path
+from os.path import join
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from math import ceil
+from scipy.sparse import csr_matrix, hstack as sparse_hstack
+import gzip
 from picrust.predict_traits import variance_of_weighted_mean,calc_confidence_interval_95
+from picrust.binary_precalc import binary_precalc_fp_for, is_binary_precalc,\
+  load_binary_precalc
+from picrust.precalc_index import has_precalc_index, open_indexed_precalc
+from picrust.util import convert_precalc_to_biom
+from picrust.chunked_output import iter_sample_chunks
 
 def get_overlapping_ids(otu_table,genome_table,genome_table_ids="sample",\
   otu_table_ids="observation"):
@@ -67,6 +83,109 @@ def extract_otu_and_genome_data(otu_table, genome_table,
     return otu_data, genome_data, overlapping_otus
 
 
+def extract_otu_and_genome_matrices(otu_table, genome_table,
+                                    genome_table_ids="sample",
+                                    otu_table_ids="observation"):
+    """Return sparse otu and genome matrices aligned on their overlapping ids
+
+    otu_table -- biom Table object for the OTUs
+    genome_table -- biom Table object for the genomes
+
+    Returns (otu_data, genome_data, overlapping_otus), where otu_data is an
+    OTUs x samples and genome_data an OTUs x genes scipy.sparse CSR matrix,
+    with row i of both corresponding to overlapping_otus[i]. The tables are
+    aligned with a single sorted intersection of their ids, and their data
+    is sliced without densifying.
+    """
+    for id_type in [genome_table_ids,otu_table_ids]:
+        if id_type not in ["sample", "observation"]:
+            raise ValueError(\
+              "%s is not a valid id type. Choices are 'sample' or 'observation'" % id_type)
+
+    overlapping_otus, otu_idxs, genome_idxs = intersect1d(
+        asarray(otu_table.ids(axis=otu_table_ids)),
+        asarray(genome_table.ids(axis=genome_table_ids)),
+        assume_unique=True, return_indices=True)
+
+    if len(overlapping_otus) < 1:
+        raise ValueError,\
+         "No common OTUs between the otu table and the genome table, so can't predict metagenome."
+
+    #biom stores data as observations x samples
+    otu_data = otu_table.matrix_data
+    if otu_table_ids == "sample":
+        otu_data = otu_data.T
+    genome_data = genome_table.matrix_data
+    if genome_table_ids == "sample":
+        genome_data = genome_data.T
+
+    otu_data = otu_data.tocsr()[otu_idxs]
+    genome_data = genome_data.tocsr()[genome_idxs]
+    return otu_data, genome_data, list(overlapping_otus)
+
+
+def dedup_genome_profiles(genome_data):
+    """Return the unique rows of a sparse OTUs x genes matrix
+
+    genome_data -- scipy.sparse matrix with one predicted genome per row
+
+    Returns (unique_data, profile_idxs), where unique_data holds each
+    distinct genome once (in order of first appearance) and row i of
+    genome_data equals row profile_idxs[i] of unique_data.
+
+    Rows are grouped by a signature made of their number of non-zero genes
+    and two random projections, computed with a single sparse product.
+    Every row is then checked against the first row with its signature, and
+    the (vanishingly rare) rows that only share a signature by chance are
+    kept as profiles of their own, so the result is always exact.
+    """
+    genome_data = csr_matrix(genome_data)
+    genome_data.sort_indices()
+    n_rows = genome_data.shape[0]
+    if n_rows == 0:
+        return genome_data, arange(0)
+
+    weights = RandomState(0).random_sample((genome_data.shape[1], 2))
+    signatures = column_stack([diff(genome_data.indptr),
+                               genome_data * weights])
+    first_rows, profile_idxs = unique(signatures, axis=0, return_index=True,
+                                      return_inverse=True)[1:]
+    representatives = first_rows[profile_idxs]
+
+    mismatched = genome_data - genome_data[representatives]
+    mismatched.eliminate_zeros()
+    mismatched = flatnonzero(diff(mismatched.tocsr().indptr))
+    if len(mismatched):
+        profile_idxs[mismatched] = len(first_rows) + arange(len(mismatched))
+        first_rows = concatenate([first_rows, mismatched])
+
+    # renumber profiles in order of first appearance
+    order = first_rows.argsort(kind='mergesort')
+    renumber = empty(len(order), dtype=profile_idxs.dtype)
+    renumber[order] = arange(len(order))
+    return genome_data[first_rows[order]], renumber[profile_idxs]
+
+
+def align_variance_matrix(gene_variances, overlapping_otus):
+    """Return gene variances as a sparse OTUs x genes matrix for overlapping_otus
+
+    gene_variances -- BIOM Table object of gene count variances, with OTUs as
+      samples
+    overlapping_otus -- sorted OTU ids, as returned by
+      extract_otu_and_genome_matrices
+
+    Returns (variance_data, otu_idxs): the rows of variance_data are the OTUs
+    of overlapping_otus[otu_idxs], i.e. those also in the variance table.
+    """
+    common, otu_idxs, variance_idxs = intersect1d(
+        asarray(overlapping_otus), asarray(gene_variances.ids()),
+        assume_unique=True, return_indices=True)
+    if len(common) == 0:
+        raise ValueError("No common OTUs between the otu table and the variance table!")
+    variance_data = gene_variances.matrix_data.T.tocsr()[variance_idxs]
+    return variance_data, otu_idxs
+
+
 def load_subset_from_biom_str(biom_str, ids_to_load, axis="sample"):
     """Load a biom table containing subset of samples or observations from a BIOM format JSON string"""
     if axis not in ['sample', 'observation']:
@@ -110,6 +229,110 @@ def yield_subset_biom_str(biom_str,new_data,new_axis_md,axis):
         yield direct_parse_key(biom_str, "rows")
     yield "}"
 
+def determine_data_table_fp(precalc_data_dir,type_of_prediction,gg_version,\
+      user_specified_table=None,precalc_file_suffix='precalculated.tab.gz',verbose=False):
+    """Determine data table to load, allowing custom user tables or a choice of precalculated files
+
+    precalc_data_dir -- the directory where precalculated tables of gene counts and variances are stored
+    type_of_prediction -- a string describing the type of precalculated prediction file.
+    gg_version -- the version of greengenes the precalculated prediction was generated against
+
+    This function assumes that precalculated files are named based on the type of prediction,
+    (KO, COG, PFAM, etc) and the greengenes version, and then end with a set suffix, which might
+    vary between count tables and variance tables. If a binary version of the precalculated
+    file exists alongside it (see picrust.binary_precalc) that file is returned instead.
+    """
+
+    if(user_specified_table is None):
+        #We assume the precalc file has a specific name (e.g. ko_13_5_precalculated.tab.gz)
+        precalc_file_name='_'.join([type_of_prediction,gg_version,\
+          precalc_file_suffix])
+
+        input_count_table=join(precalc_data_dir,precalc_file_name)
+
+        #Prefer a binary version of the precalculated file if one has
+        #been made with convert_precalc_table.py
+        binary_count_table=binary_precalc_fp_for(input_count_table)
+        if is_binary_precalc(binary_count_table):
+            input_count_table=binary_count_table
+    else:
+        input_count_table=user_specified_table
+
+    if verbose:
+        print "Selected data table for loading: ", input_count_table
+    return input_count_table
+
+
+def load_data_table(data_table_fp,\
+  load_data_table_in_biom=False,suppress_subset_loading=False,ids_to_load=None,\
+  transpose=False,verbose=False):
+    """Load a data table, detecting gziiped files and subset loading
+    data_table_fp -- path to the input data table
+
+    load_data_table_in_biom -- if True, load the data table as a BIOM table rather
+    than as tab-delimited
+
+    suppress_subset_loading -- if True, load the entire table, rather than just
+    ids_of_interest
+
+    ids_to_load -- a list of OTU ids for which data should be loaded
+
+    gzipped files are detected based on the '.gz' suffix. Binary precalculated
+    tables (see picrust.binary_precalc) are detected based on the '.npy' suffix
+    and the presence of their id index and metadata files, and only the rows
+    for ids_to_load are read from them. Likewise, only the gzip blocks holding
+    ids_to_load are decompressed from tab-delimited files that have a block
+    index (see picrust.precalc_index).
+    """
+    if not path.exists(data_table_fp):
+        raise IOError("File "+data_table_fp+" doesn't exist! Did you forget to download it?")
+
+    if is_binary_precalc(data_table_fp):
+        if suppress_subset_loading:
+            ids_to_load = None
+        if verbose:
+            print "Loading binary precalculated table: %s" %data_table_fp
+        genome_table = load_binary_precalc(data_table_fp,ids_to_load,\
+          transpose=transpose)
+        if verbose:
+            print "Done loading trait table containing %i functions for %i organisms." %(len(genome_table.ids(axis='observation')),len(genome_table.ids()))
+        return genome_table
+
+    ext=path.splitext(data_table_fp)[1]
+    use_block_index = not load_data_table_in_biom and\
+      ids_to_load is not None and len(ids_to_load) > 0 and\
+      has_precalc_index(data_table_fp)
+    if use_block_index:
+        if verbose:
+            print "Using block index to load traits for %i organisms" %len(ids_to_load)
+        genome_table_fh = open_indexed_precalc(data_table_fp,ids_to_load)
+    elif (ext == '.gz'):
+        genome_table_fh = gzip.open(data_table_fp,'rb')
+    else:
+        genome_table_fh = open(data_table_fp,'U')
+
+    if load_data_table_in_biom:
+        if not suppress_subset_loading:
+            #Now we want to use the OTU table information
+            #to load only rows in the count table corresponding
+            #to relevant OTUs
+
+            if verbose:
+                print "Loading traits for %i organisms from the trait table" %len(ids_to_load)
+
+            genome_table = load_subset_from_biom_str(genome_table_fh.read(),ids_to_load,axis='samples')
+        else:
+            if verbose:
+                print "Loading *full* count table because --suppress_subset_loading was passed. This may result in high memory usage"
+            genome_table = load_table(data_table_fp)
+    else:
+        genome_table = convert_precalc_to_biom(genome_table_fh,ids_to_load,transpose=transpose)
+
+    if verbose:
+        print "Done loading trait table containing %i functions for %i organisms." %(len(genome_table.ids(axis='observation')),len(genome_table.ids()))
+
+    return genome_table
+
 def predict_metagenomes(otu_table, genome_table, verbose=False, 
                         whole_round=True):
     """ Predict metagenomes from OTU table and genome table. Can optionally
@@ -117,13 +340,8 @@ def predict_metagenomes(otu_table, genome_table, verbose=False,
     rounding to nearest whole numbers by setting whole_round=False.
     """
 
-    otu_data,genome_data,overlapping_otus = extract_otu_and_genome_data(otu_table,genome_table)
-    # matrix multiplication to get the predicted metagenomes
-    new_data = dot(array(otu_data).T,array(genome_data)).T
-
-    if whole_round:
-        #Round counts to nearest whole numbers
-        new_data = around(new_data)
+    new_data = _predict_metagenome_matrix(otu_table, genome_table,
+                                          whole_round=whole_round)
 
     # return the result as a sparse biom table - the sample ids are now the
     # sample ids from the otu table, and the observation ids are now the
@@ -139,12 +357,151 @@ def predict_metagenomes(otu_table, genome_table, verbose=False,
 
     return result_table
 
+def _predict_metagenome_matrix(otu_table, genome_table, whole_round=True):
+    """Return the predicted metagenomes as a sparse genes x samples matrix"""
+    otu_data,genome_data,overlapping_otus = \
+      extract_otu_and_genome_matrices(otu_table,genome_table)
+    return _predict_aligned_matrix(otu_data,genome_data,whole_round)
+
+def _predict_aligned_matrix(otu_data, genome_data, whole_round=True):
+    """Return genes x samples predictions from row-aligned sparse matrices
+
+    otu_data -- OTUs x samples scipy.sparse CSR matrix
+    genome_data -- OTUs x genes scipy.sparse CSR matrix, with row i for the
+      same OTU as row i of otu_data
+
+    Many OTUs share the same predicted genome, so when all counts are whole
+    numbers the counts of OTUs with identical genomes are summed and only
+    the unique genomes are multiplied. Sums and products of whole numbers
+    are exact, so this gives the same result as the full product. Fractional
+    counts would be summed in a different order, so they are multiplied
+    without collapsing.
+    """
+    if _is_whole(otu_data) and _is_whole(genome_data):
+        genome_data,profile_idxs = dedup_genome_profiles(genome_data)
+        if genome_data.shape[0] < otu_data.shape[0]:
+            collapse = csr_matrix((ones(len(profile_idxs)),\
+              (profile_idxs,arange(len(profile_idxs)))),\
+              shape=(genome_data.shape[0],otu_data.shape[0]))
+            otu_data = collapse * otu_data
+    # sparse matrix multiplication to get the predicted metagenomes:
+    # (genes x OTUs) * (OTUs x samples) -> genes x samples
+    new_data = (genome_data.T * otu_data).tocsr()
+
+    if whole_round:
+        #Round counts to nearest whole numbers
+        new_data.data = around(new_data.data)
+        new_data.eliminate_zeros()
+    return new_data
+
+def _is_whole(data):
+    """Return True if every value of sparse matrix data is a whole number"""
+    return array_equal(data.data,around(data.data))
+
+def predict_metagenomes_multi(otu_table, genome_tables, verbose=False,
+                              whole_round=True, n_threads=None):
+    """Predict metagenomes from one OTU table for several genome tables
+
+    otu_table -- BIOM Table object of OTUs (observations) by samples
+    genome_tables -- a list of BIOM Table objects of genes by OTUs (e.g.
+      the KO, COG and RFAM precalculated tables)
+    n_threads -- number of threads to run the predictions in [default:
+      one per genome table]
+
+    Returns a list of predicted metagenome tables, in the order of
+    genome_tables, each identical to the result of predict_metagenomes.
+
+    The OTU table is aligned to the OTUs of each distinct set of genome
+    table ids only once (precalculated tables loaded for the same OTU table
+    usually share theirs), and the sparse matrix products for the different
+    genome tables run in parallel threads.
+    """
+    otu_ids = asarray(otu_table.ids(axis='observation'))
+    otu_matrix = otu_table.matrix_data.tocsr()
+
+    alignments = []
+    jobs = []
+    for genome_table in genome_tables:
+        genome_ids = asarray(genome_table.ids())
+        for aligned_ids,otu_data,genome_idxs in alignments:
+            if array_equal(aligned_ids,genome_ids):
+                break
+        else:
+            overlapping_otus,otu_idxs,genome_idxs = intersect1d(otu_ids,
+              genome_ids,assume_unique=True,return_indices=True)
+            if len(overlapping_otus) < 1:
+                raise ValueError,\
+                 "No common OTUs between the otu table and the genome table, so can't predict metagenome."
+            otu_data = otu_matrix[otu_idxs]
+            alignments.append((genome_ids,otu_data,genome_idxs))
+        genome_data = genome_table.matrix_data.T.tocsr()[genome_idxs]
+        jobs.append((otu_data,genome_data))
+
+    if verbose:
+        print "Predicting %i metagenomes from %i distinct OTU alignments" \
+          %(len(jobs),len(alignments))
+
+    # the sparse products run in compiled code, so threads (which share the
+    # aligned OTU matrix without copying it) overlap well
+    pool = ThreadPool(n_threads or len(jobs))
+    try:
+        new_datas = pool.map(lambda job: _predict_aligned_matrix(job[0],\
+          job[1],whole_round=whole_round),jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    return [table_from_template(new_data,otu_table.ids(),
+                                genome_table.ids(axis='observation'),
+                                sample_metadata_source=otu_table,
+                                observation_metadata_source=genome_table,
+                                verbose=verbose)
+            for new_data,genome_table in zip(new_datas,genome_tables)]
+
+def union_otu_ids(otu_tables):
+    """Return the sorted list of OTU ids found in any of otu_tables
+
+    otu_tables -- an iterable of BIOM Table objects with OTUs as observations.
+      Tables are only looked at once, so a generator can be passed to avoid
+      holding all of them in memory.
+    """
+    otu_ids = set()
+    for otu_table in otu_tables:
+        otu_ids.update(otu_table.ids(axis='observation'))
+    return sorted(otu_ids)
+
+
+def predict_metagenomes_batch(otu_tables, genome_table, gene_variances=None,
+                              verbose=False, whole_round=True):
+    """Yield the predicted metagenome of each of otu_tables
+
+    otu_tables -- an iterable of BIOM Table objects of OTUs
+    genome_table -- BIOM Table object of predicted gene counts, with (at
+      least) the OTUs of all of otu_tables as samples, e.g. as loaded with
+      load_data_table(...,ids_to_load=union_otu_ids(otu_tables))
+    gene_variances -- if given, yield the (prediction, variance, lower CI,
+      upper CI) tables of predict_metagenome_variances instead
+
+    The reference tables are loaded once by the caller and shared by every
+    prediction, rather than being loaded again for each OTU table.
+    """
+    for otu_table in otu_tables:
+        if gene_variances is None:
+            yield predict_metagenomes(otu_table, genome_table,
+                                      verbose=verbose, whole_round=whole_round)
+        else:
+            yield predict_metagenome_variances(otu_table, genome_table,
+                                               gene_variances, verbose=verbose,
+                                               whole_round=whole_round)
+
+
 def predict_metagenome_variances(otu_table, genome_table, gene_variances,
                                  verbose=False, whole_round=True):
     """Predict variances for metagenome predictions
     otu_table -- BIOM Table object of OTUs
     gene_table -- BIOM Table object of predicted gene counts per OTU and samples
-    gene_variances -- BIOM Table object of predicted variance in each gene count
+    gene_variances -- BIOM Table object of predicted variance in each gene count.
+      Genes must be in the same order as in the genome table.
 
     Users can also specify verbose mode and whether functional count confidence
     interval rounding should be performed.
@@ -153,56 +510,9 @@ def predict_metagenome_variances(otu_table, genome_table, gene_variances,
     for now. If a good method for getting variance for OTU counts becomes available, this should
     be updated to treat them as random variables as well.
     """
-    #Assume that OTUs are samples in the genome table, but observations in the OTU table
-    genome_table_otu_ids = "sample"
-    otu_table_otu_ids = "observation"
-
-    #Find overlapping otus
-    overlapping_otus = get_overlapping_ids(otu_table, genome_table,
-        genome_table_ids=genome_table_otu_ids, otu_table_ids=otu_table_otu_ids)
-    #Ensure they overlap fully with variance table
-    overlapping_otus = get_overlapping_ids(otu_table, gene_variances,
-        genome_table_ids=genome_table_otu_ids, otu_table_ids=otu_table_otu_ids)
-
-    #Filter OTU and Genome Table to contain only overlapping IDs
-    filter_f = lambda v, id_, m: id_ in overlapping_otus
-    otu_table = otu_table.filter(filter_f, axis='observation', inplace=False)
-    genome_table = genome_table.filter(filter_f, inplace=False)
-
-    metagenome_data = None
-    metagenome_variance_data = None
-    if verbose:
-        print "Calculating the variance of the estimated metagenome for %i OTUs." %len(overlapping_otus)
-    for otu_id in overlapping_otus:
-        otu_across_samples = otu_table.data(otu_id, axis='observation')
-        otu_across_genes = genome_table.data(otu_id)
-        otu_variance_across_genes = gene_variances.data(otu_id)
-        otu_contrib_to_metagenome = array([o*otu_across_genes
-                                           for o in otu_across_samples])
-        var_otu_contrib_to_metagenome = \
-            array([scaled_variance(otu_variance_across_genes,o)
-                   for o in otu_across_samples])
-
-        if metagenome_data is None:
-            metagenome_data = otu_contrib_to_metagenome
-            metagenome_variance_data = var_otu_contrib_to_metagenome
-        else:
-            metagenome_data += otu_contrib_to_metagenome
-            metagenome_variance_data = variance_of_sum(metagenome_variance_data,var_otu_contrib_to_metagenome)
-
-    data_result = metagenome_data.T
-    variance_result = metagenome_variance_data.T
-
-    if whole_round:
-        #Round counts to nearest whole numbers
-        data_result = around(data_result)
-
-    if verbose:
-        print "Calculating metagenomic confidence intervals from variance."
-
-    lower_95_CI,upper_95_CI=calc_confidence_interval_95(data_result,variance_result,\
-      round_CI=whole_round,min_val=0.0,max_val=None)
-
+    data_result,variance_result,lower_95_CI,upper_95_CI = \
+      _predict_metagenome_variance_matrices(otu_table,genome_table,\
+      gene_variances,verbose=verbose,whole_round=whole_round)
 
     if verbose:
         print "Generating BIOM output tables for the prediction, variance, upper confidence interval and lower confidence interval."
@@ -235,30 +545,173 @@ def predict_metagenome_variances(otu_table, genome_table, gene_variances,
       result_upper_CI_table
 
 
+def _predict_metagenome_variance_matrices(otu_table, genome_table,
+                                          gene_variances, verbose=False,
+                                          whole_round=True):
+    """Return dense genes x samples prediction, variance, lower and upper CI arrays"""
+    #Assume that OTUs are samples in the genome table, but observations in the OTU table
+    otu_data,genome_data,overlapping_otus = \
+      extract_otu_and_genome_matrices(otu_table,genome_table)
+    #Restrict to OTUs that also have variances
+    variance_data,otu_idxs = align_variance_matrix(gene_variances,overlapping_otus)
+    otu_data = otu_data[otu_idxs]
+    genome_data = genome_data[otu_idxs]
+
+    if verbose:
+        print "Calculating the variance of the estimated metagenome for %i OTUs." %len(otu_idxs)
+
+    #With OTU counts c treated as constants and gene counts g as independent
+    #random variables, Var(sum(c*g)) = sum(c**2 * Var(g)), so both the
+    #prediction and its variance are sparse matrix products:
+    #(genes x OTUs) * (OTUs x samples) -> genes x samples
+    data_result = (genome_data.T * otu_data).toarray()
+    variance_result = (variance_data.T * otu_data.multiply(otu_data)).toarray()
+
+    if whole_round:
+        #Round counts to nearest whole numbers
+        data_result = around(data_result)
+
+    if verbose:
+        print "Calculating metagenomic confidence intervals from variance."
+
+    lower_95_CI,upper_95_CI=calc_confidence_interval_95(data_result,variance_result,\
+      round_CI=whole_round,min_val=0.0,max_val=None)
+
+    return data_result,variance_result,lower_95_CI,upper_95_CI
+
+
+# Reference tables used by the worker processes of predict_metagenomes_parallel.
+# They are set before the worker pool is created, so that forked workers
+# share the parent's copy of the (large) reference tables instead of having
+# them pickled and sent along with every shard of samples.
+_shared_reference = {}
+
+
+def _predict_shard(otu_table):
+    """Return the prediction matrices for one shard of samples"""
+    genome_table = _shared_reference['genome_table']
+    gene_variances = _shared_reference['gene_variances']
+    whole_round = _shared_reference['whole_round']
+    if gene_variances is None:
+        return [_predict_metagenome_matrix(otu_table, genome_table,
+                                           whole_round=whole_round)]
+    return _predict_metagenome_variance_matrices(otu_table, genome_table,
+                                                 gene_variances,
+                                                 whole_round=whole_round)
+
+
+def predict_metagenomes_parallel(otu_table, genome_table, n_procs,
+                                 gene_variances=None, verbose=False,
+                                 whole_round=True):
+    """Predict metagenomes with the samples split across n_procs processes
+
+    otu_table -- BIOM Table object of OTUs
+    genome_table -- BIOM Table object of predicted gene counts per OTU
+    n_procs -- number of worker processes
+    gene_variances -- if given, return the (prediction, variance, lower CI,
+      upper CI) tables of predict_metagenome_variances instead of only the
+      prediction
+
+    The samples of otu_table are split into one shard per process. Workers
+    are forked after the reference tables are set up, so they read the
+    parent's copy rather than each receiving their own. The per-shard
+    results are then stitched back together in the original sample order.
+    Results are identical to predict_metagenomes and
+    predict_metagenome_variances.
+    """
+    sample_ids = otu_table.ids()
+    shard_size = max(1, int(ceil(len(sample_ids) / n_procs)))
+    shards = list(iter_sample_chunks(otu_table, shard_size))
+
+    if verbose:
+        print "Predicting %i shards of up to %i samples on %i processes" \
+          %(len(shards), shard_size, n_procs)
+
+    _shared_reference.update(genome_table=genome_table,
+                             gene_variances=gene_variances,
+                             whole_round=whole_round)
+    pool = Pool(min(n_procs, len(shards)))
+    try:
+        shard_results = pool.map(_predict_shard, shards)
+    finally:
+        pool.close()
+        pool.join()
+        _shared_reference.clear()
+
+    result_tables = []
+    for shard_matrices in zip(*shard_results):
+        if gene_variances is None:
+            new_data = sparse_hstack(shard_matrices, format='csr')
+        else:
+            new_data = hstack(shard_matrices)
+        result_tables.append(table_from_template(new_data, sample_ids,
+          genome_table.ids(axis='observation'),
+          sample_metadata_source=otu_table,
+          observation_metadata_source=genome_table, verbose=verbose))
+
+    if gene_variances is None:
+        return result_tables[0]
+    return tuple(result_tables)
+
+
 def table_from_template(new_data,sample_ids,observation_ids,\
     sample_metadata_source=None,observation_metadata_source=None,\
     verbose=False):
-    """Build a new BIOM table from new_data, and transfer metadata from 1-2 existing tables"""
+    """Build a new BIOM table from new_data, and transfer metadata from 1-2 existing tables
 
-    #Build the BIOM table
-    result_table =  Table(new_data, observation_ids, sample_ids,
-                          type='Gene table')
-
-    #Transfer sample metadata from the OTU table
-    #to the metagenome table (samples are the same)
+    The metadata of the source tables are aligned to sample_ids and
+    observation_ids and passed to the Table constructor, rather than
+    transferred id by id after the table is built.
+    """
+    #Sample metadata come from the OTU table (samples are the same),
+    #and observation metadata (e.g. gene metadata) from the genome table
+    sample_metadata = None
     if sample_metadata_source:
-        result_table = transfer_metadata(sample_metadata_source,result_table,\
-          donor_metadata_type='sample',\
-          recipient_metadata_type='sample',verbose=verbose)
+        if verbose:
+            print "Transferring sample metadata to the new table"
+        sample_metadata = aligned_metadata(sample_metadata_source,\
+          sample_ids,axis='sample')
 
-    #Now transfer observation metadata (e.g. gene metadata)
-    #from the genome table to the result table
+    observation_metadata = None
     if observation_metadata_source:
-        result_table = transfer_metadata(observation_metadata_source,\
-          result_table,donor_metadata_type='observation',\
-          recipient_metadata_type='observation',verbose=verbose)
+        if verbose:
+            print "Transferring observation metadata to the new table"
+        observation_metadata = aligned_metadata(observation_metadata_source,\
+          observation_ids,axis='observation')
 
-    return result_table
+    #Build the BIOM table
+    return Table(new_data, observation_ids, sample_ids,
+                 observation_metadata, sample_metadata,
+                 type='Gene table')
+
+
+def aligned_metadata(donor_table,ids,axis='observation'):
+    """Return the metadata of donor_table for ids, in the order of ids
+
+    donor_table -- a BIOM Table object
+    ids -- the ids to return metadata for. Ids that are not in donor_table
+      get no metadata (None).
+    axis -- 'sample' or 'observation'
+
+    Returns None if donor_table has no metadata on axis. When ids are the
+    ids of donor_table in the same order (as for predictions, which keep
+    the samples of the OTU table and the genes of the genome table), the
+    donor's metadata is returned as is, without looking up any ids.
+    """
+    donor_metadata = donor_table.metadata(axis=axis)
+    if not donor_metadata:
+        return None
+
+    donor_ids = donor_table.ids(axis=axis)
+    if len(donor_ids) == len(ids) and array_equal(donor_ids,asarray(ids)):
+        return donor_metadata
+
+    donor_idxs = dict((md_id,i) for i,md_id in enumerate(donor_ids))
+    result = []
+    for md_id in ids:
+        i = donor_idxs.get(md_id)
+        result.append(None if i is None else donor_metadata[i])
+    return result
 
 
 
@@ -300,12 +753,9 @@ def transfer_observation_metadata(donor_table,recipient_table,\
         #No metadata to transfer, so nothing more needs to be done.
         return recipient_table
 
-    metadata = {}
     md_ids = donor_table.ids(axis='observation')
-
-    for md_id in md_ids:
-        metadata_value = donor_table.metadata(axis='observation')[donor_table.index(md_id, axis='observation')]
-        metadata[str(md_id)] = metadata_value
+    metadata = dict((str(md_id),metadata_value) for md_id,metadata_value\
+      in zip(md_ids,donor_metadata))
     if recipient_metadata_type == "observation":
         recipient_table.add_metadata(metadata, axis='observation')
     elif recipient_metadata_type == "sample":
@@ -331,17 +781,14 @@ def transfer_sample_metadata(donor_table,recipient_table,\
         #No metadata to transfer, so nothing more needs to be done.
         return recipient_table
 
-    metadata = {}
     md_ids = donor_table.ids()
-
-    for md_id in md_ids:
-        metadata_value = donor_table.metadata()[donor_table.index(md_id, donor_metadata_type)]
-        metadata[str(md_id)] = metadata_value
+    metadata = dict((str(md_id),metadata_value) for md_id,metadata_value\
+      in zip(md_ids,donor_metadata))
 
     if recipient_metadata_type == "sample":
         recipient_table.add_metadata(metadata)
     elif recipient_metadata_type == "observation":
-        recipient_table.add_Metadata(metadata, axis='observation')
+        recipient_table.add_metadata(metadata, axis='observation')
     return recipient_table
 
 
@@ -12,20 +12,31 @@ __email__ = "zaneveld@gmail.com"
 __status__ = "Development"
 
 from collections import defaultdict
+from csv import reader as csv_reader
+from gzip import GzipFile
 from math import e
 from copy import copy
-from random import choice
+from random import choice, random
 from cogent.util.option_parsing import parse_command_line_parameters, make_option
 from numpy.ma import masked_object
 from numpy.ma import array as masked_array
 from numpy import apply_along_axis,array,around,mean,maximum as numpy_max, minimum as numpy_min,\
-  sqrt,sum,amax,amin,where, logical_not, argmin, histogram, add
+  sqrt,sum,amax,amin,where, logical_not, argmin, histogram, add, newaxis,\
+  concatenate, empty, float32
 from numpy.random import normal
 from cogent.maths.stats.distribution import z_high
 from cogent.maths.stats.special import ndtri
 from cogent import LoadTable
 from warnings import warn
 from biom.table import Table
+from scipy.sparse import csr_matrix
+from picrust.tree_index import TreeIndex
+from picrust.util import PicrustNode
+
+# Number of parent nodes whose children are predicted together by
+# predict_traits_from_ancestors.  Each block holds a dense array of the
+# traits of the nodes it draws on, so this bounds memory use.
+PREDICTION_BLOCK_SIZE = 1000
 
 
 def biom_table_from_predictions(predictions, trait_ids,
@@ -61,7 +72,8 @@ def assign_traits_to_tree(traits, tree, fix_bad_labels=True,
                           trait_label="Reconstruction"):
     """Assign a dict of traits to a PyCogent tree
 
-    traits -- a dict of traits, keyed by node names
+    traits -- a dict of traits, keyed by node names, or a TraitStore (in
+    which case each node is given a view of its row of the store)
     tree -- a PyCogent phylonode object
     trait_label -- a string defining the attribute in which
     traits will be recorded.  For example, if this is set to 'Reconstruction',
@@ -549,24 +561,28 @@ def predict_random_neighbor(tree,nodes_to_predict,\
     """
 
     results = {}
-    n_traits = None
     annotated_nodes = \
       [t for t in tree.tips() if \
        getattr(t,trait_label,None) is not None]
+    annotated_positions = dict((t.Name,i) for i,t in enumerate(annotated_nodes))
 
     for node_label in nodes_to_predict:
 
         if verbose:
             print "Predicting traits for node:",node_label
 
-        node_to_predict = tree.getNodeMatchingName(node_label)
-        if not use_self_in_prediction:
-            possible_nodes = [t for t in annotated_nodes if \
-                t.Name != node_label]
+        self_position = annotated_positions.get(node_label)
+        if use_self_in_prediction or self_position is None:
+            node_to_predict = choice(annotated_nodes)
         else:
-            possible_nodes = annotated_nodes
-
-        node_to_predict = choice(possible_nodes)
+            #Choose among the other annotated nodes without building a
+            #list of them for each node
+            if len(annotated_nodes) < 2:
+                raise IndexError("No annotated nodes other than %s to predict from" % node_label)
+            position = int(random() * (len(annotated_nodes) - 1))
+            if position >= self_position:
+                position += 1
+            node_to_predict = annotated_nodes[position]
 
         if verbose:
             print "Predicting using node:", node_to_predict.Name
@@ -600,48 +616,77 @@ def predict_nearest_neighbor(tree,nodes_to_predict,\
     verbose -- output verbose debugging info
 
     """
-    closest_annotated_node = None
+    nearest_annotated_neighbors =\
+      get_nearest_annotated_neighbors(tree,nodes_to_predict,\
+      trait_label=trait_label, tips_only = tips_only,\
+      include_self = use_self_in_prediction)
+
     results = {}
     n_traits = None
     for node_label in nodes_to_predict:
-        if verbose:
-            print "Predicting traits for node:",node_label
-        node_to_predict = tree.getNodeMatchingName(node_label)
+        nearest_annotated_neighbor = nearest_annotated_neighbors[node_label]
+        if nearest_annotated_neighbor is None:
+            raise ValueError("Couldn't find an annotated nearest neighbor for node %s on tree" % node_label)
 
-        traits = getattr(node_to_predict,trait_label)
+        traits = getattr(nearest_annotated_neighbor,trait_label)
 
-        # Do a little checking to make sure trait values either look
-        # like valid numpy arrays of equal length, are not specified
-        # or are set to None.
+        # Do a little checking to make sure trait values look
+        # like valid numpy arrays of equal length
+        if n_traits is None:
+            n_traits = len(traits)
+        elif len(traits) != n_traits:
+            raise ValueError(\
+              "The number of traits in the array for node %s (%i) does not match other nodes (%i)" %(\
+               nearest_annotated_neighbor.Name,len(traits),n_traits))
 
-        if traits is not None:
-            if n_traits is None:
-                #Check that trait length is consistent
-                try:
-                    n_traits = len(traits)
-                except TypeError:
-                    raise TypeError("Node trait values must be arrays!  Couldn't call len() on %s" % traits)
-
-            if traits and len(traits) != n_traits:
-                raise ValueError(\
-                  "The number of traits in the array for node %s (%i) does not match other nodes (%i)" %(\
-                   node_to_predict,len(traits),n_traits))
+        if verbose:
+            print "Predicting traits for node %s using node %s" %\
+              (node_label,nearest_annotated_neighbor.Name)
 
+        results[node_label] = traits
+    return results
 
-        if not use_self_in_prediction:
-            # ignore knowledge about self without modifying tree
-            traits = None
+def get_nearest_annotated_neighbors(tree,node_names,\
+    trait_label="Reconstruction",tips_only=True,include_self=True):
+    """Return the nearest annotated node of each of node_names
 
-        nearest_annotated_neighbor =\
-          get_nearest_annotated_neighbor(tree,node_label,\
-          trait_label=trait_label, tips_only = tips_only,\
-          include_self = use_self_in_prediction)
-        #print "NAN:", nearest_annotated_neighbor
-        if nearest_annotated_neighbor is None:
-            raise ValueError("Couldn't find an annotated nearest neighbor for node %s on tree" % node_label)
+    tree -- PhyloNode object, decorated with traits in the
+    attribute specified in trait_label
+    node_names -- names of the nodes of interest
+    trait_label -- attribute where traits are stored where
+    available
+    tips_only -- if True, consider only extant, tip nodes
+    as neighbors.  if False, allow the nearest neighbor to be
+    ancestral.
+    include_self -- if True, an annotated node is its own nearest
+    neighbor
 
-        results[node_label] = getattr(nearest_annotated_neighbor,trait_label)
-    return results
+    The neighbors of all nodes are found together in two traversals
+    of the tree (see TreeIndex.nearest_annotated_nodes).
+
+    Returns a dict of {node name: nearest annotated node}, with None for
+    nodes without an annotated neighbor.  Raises a KeyError if a node
+    name is not in the tree.
+    """
+    tree_index = TreeIndex(tree)
+    annotated = []
+    for node in tree_index.nodes:
+        traits = getattr(node,trait_label,None)
+        annotated.append(traits is not None and len(traits) > 0)
+    neighbors,distances = tree_index.nearest_annotated_nodes(\
+      array(annotated,dtype=bool),include_self=include_self,\
+      tips_only=tips_only)
+
+    #Match the first node with each name in preorder, as getNodeMatchingName does
+    node_idxs = {}
+    for i,name in enumerate(tree_index.names):
+        node_idxs.setdefault(name,i)
+
+    result = {}
+    for node_name in node_names:
+        neighbor = neighbors[node_idxs[node_name]]
+        result[node_name] = tree_index.nodes[neighbor] if neighbor >= 0 else None
+    return result
 
 def get_nearest_annotated_neighbor(tree,node_name,\
     trait_label="Reconstruction",tips_only= True, include_self=True):
@@ -655,124 +700,57 @@ def get_nearest_annotated_neighbor(tree,node_name,\
     tips_only -- if True, consider only extant, tip nodes
     as neighbors.  if False, allow the nearest neighbor to be
     ancestral.
+
+    To find the neighbors of many nodes, use
+    get_nearest_annotated_neighbors, which finds them all at once.
     """
-    n1 = tree.getNodeMatchingName(node_name)
-    min_dist = 99999999999999999.0
-    curr_best_match = None
-    if tips_only:
-        neighbors = tree.tips()
-    else:
-        neighbors = tree.preorder()
-    #print neighbors
-    for n2 in neighbors:
-        traits = getattr(n2,trait_label,None)
-        #print n2.Name, traits
-        if not traits:
-            continue
-        if not include_self and n1.Name == n2.Name:
-            continue
-        dist = n1.distance(n2)
-        if dist < min_dist:
-            curr_best_match = n2
-            min_dist = dist
-    return curr_best_match
+    return get_nearest_annotated_neighbors(tree,[node_name],\
+      trait_label=trait_label,tips_only=tips_only,\
+      include_self=include_self)[node_name]
 
 
 def calc_nearest_sequenced_taxon_index(tree,limit_to_tips = [],\
         trait_label="Reconstruction",include_self=True, verbose = True):
-    """Calculate an index of the average distance to the nearest sequenced taxon on the tree"""
+    """Calculate an index of the average distance to the nearest sequenced taxon on the tree
+
+    The nearest annotated (sequenced) tip of every tip is found with two
+    passes over the tree (see TreeIndex.nearest_annotated_nodes), rather
+    than from a tip-to-tip distance matrix, so this takes time linear in
+    the size of the tree.
+    """
+    if verbose:
+        print "Calculating Nearest Sequenced Taxon Index (NTSI):"
+        print "Indexing tree..."
+    tree_index = TreeIndex(tree)
+    annotated = array([getattr(node,trait_label,None) is not None \
+      for node in tree_index.nodes],dtype=bool)
 
-    distances = []
     if verbose:
-        print "Finding all tree tips (may take a moment for large trees)"
-    tree_tips = tree.tips()
-    #TODO: there may be a way to use itertips her instead
-    #if tips to examine is specified.  This would be much
-    #more memory-efficient
+        print "Finding the nearest annotated tip of each node..."
+    if verbose and include_self:
+        print "(annotated nodes of interest use themselves as the nearest neighbor)"
+    nearest_tips,nearest_distances =\
+      tree_index.nearest_annotated_nodes(annotated,include_self=include_self)
 
+    tips_to_examine = tree_index.is_tip.nonzero()[0]
     if limit_to_tips:
         # limit to specified tips if this value is passed
-        # this is both faster and allows customized metrics for each OTU table
+        # this allows customized metrics for each OTU table
         # rather than just generically for all sequenced genomes + greengenes
         limit_to_tips = set(limit_to_tips)
-        tips_to_examine = [t for t in tree_tips if t.Name in limit_to_tips]
-    else:
-        # If no set is specficied, calculate for all tips
-        tips_to_examine = tree_tips
-
-    # tips_to_examine is used as a lookup downstream
-    tips_to_examine = set(tips_to_examine)
-
-    if verbose:
-        print "Calculating Nearest Sequenced Taxon Index (NTSI):"
-        print "NOTE: this can be slow.  Run without -a to disable"
-
-    #Next, build up a list of tips that are annotated with traits
-    if verbose:
-        print "Building a list of annotated tree tips"
-    annot_tree_tip_names =\
-        [t for t in tree_tips if getattr(t,trait_label,None) is not None]
-
-    #Build up the set of tips we actually need info about:
-    #The sequenced/annotated tips plus those we want to predict.
-    annot_plus_to_predict = annot_tree_tip_names
-    for tip in tips_to_examine:
-        if tip not in annot_plus_to_predict:
-            annot_plus_to_predict.append(tip)
-
-    if verbose:
-        print "Getting dists, tips for %i tips" % len(annot_plus_to_predict)
-
-
-    #Armed with the set of all annotated tips, plus all tips
-    #that we care to calculate NSTI for, we can restrict
-    #our analysis to just these tips.
-
-    #Restricting the space is critical for working with
-    #large trees....
-
-    dists,tree_tips =\
-      tree.tipToTipDistances(annot_plus_to_predict)
-
-    # caching here saves time with some options by preventing recalculation
-
-    if verbose:
-        print "Checking which tips are annotated with trait data..."
+        tips_to_examine = [i for i in tips_to_examine \
+          if tree_index.names[i] in limit_to_tips]
 
-    not_annot_tip_indices =\
-      [i for i,t in enumerate(tree_tips) if getattr(t,trait_label,None) is None]
-
-    if verbose:
-        print "Not annotated tip indices:",not_annot_tip_indices
+    #Tips with no annotated neighbor get a non-minimal value
     big_number = 1e250
     min_distances = {}
-
-    if verbose:
-        print "Finding min dists for each node..."
-
-    if verbose and include_self:
-        print "(annotated nodes of interest use themselves as the nearest neighbor)"
-
-    for i,t in enumerate(tree_tips):
-        if t not in tips_to_examine:
-            continue
-        #Copy to avoid messing up source tree when resetting dists
-        #NOTE: need to check if this is strictly necessary?
-        dist_to_curr_tip = copy(dists[i])
-        #Mask non-annotated indices by setting to
-        #a non-minimal value
-        dist_to_curr_tip[not_annot_tip_indices] = big_number
-        #if verbose:
-        #    print "distances:",dist_to_curr_tip
-
-        if not include_self:
-            #Mask out self
-            dist_to_curr_tip[i] = big_number
-
-        min_dist = dist_to_curr_tip.min()
+    for i in tips_to_examine:
+        min_dist = nearest_distances[i]
+        if nearest_tips[i] < 0:
+            min_dist = big_number
         if verbose:
-            print t.Name," d(NN):",min_dist
-        min_distances[t.Name]=min_dist
+            print tree_index.names[i]," d(NN):",min_dist
+        min_distances[tree_index.names[i]]=min_dist
 
     # Average the nearest sequenced neighbor in each case to get a composite score
     nsti =  sum(min_distances.values())/float(len(min_distances))
@@ -805,7 +783,10 @@ def get_nn_by_tree_descent(tree,node_of_interest,filter_by_property = "Reconstru
             #consider all non-self possibilities
             possible_NNs = [n for n in curr_base_node.tipChildren() if n !=start_node]
 
-        dists = [start_node.distance(n) for n in possible_NNs]
+        if isinstance(start_node,PicrustNode):
+            dists = start_node.distances(possible_NNs)
+        else:
+            dists = [start_node.distance(n) for n in possible_NNs]
 
         curr_min = min(dists)
         if curr_base_node.Length + curr_base_node.distance(start_node) >= curr_min:
@@ -858,7 +839,7 @@ def get_brownian_motion_param_from_confidence_intervals(tree,\
                 if c.Name == tip.Name:
                     continue
                 else:
-                   if getattr(c,trait_label,None):
+                   if getattr(c,trait_label,None) is not None:
                        more_than_one_annotated_child = True
                        break
             if more_than_one_annotated_child:
@@ -970,61 +951,38 @@ def predict_traits_from_ancestors(tree,
             raise ValueError(err_text)
 
 
-    #result_tree = tree.deepcopy()
     results = {}
     variance_result = {}
     confidence_interval_results = defaultdict(dict)
-    n_traits = None
-    #Set up a dict to hold alredy sequenced genomes/tips with known character values
-    tips_with_prior_info = {}
 
-    #Calculate 1% progress so verbose output isn't too overwhelming.
-    one_percent_progress = max(1,int((len(nodes_to_predict))*0.01))
-    if verbose:
-        print "Every %ith node prediction will be printed" % one_percent_progress
+    #Convert the tree to arrays once, and find the most recent reconstructed
+    #ancestor of every node in a single traversal
+    tree_index = TreeIndex(tree)
+    nodes = tree_index.nodes
+    annotated = array([getattr(node,trait_label,None) is not None \
+      for node in nodes],dtype=bool)
+    ancestors,ancestor_distances =\
+      tree_index.nearest_annotated_ancestors(annotated)
 
-    #Interate through nodes, calculating trait predictions,
-    #and (if requested) variances and confidence intervals
+    n_traits = None
+    annotated_idxs = annotated.nonzero()[0]
+    if len(annotated_idxs):
+        first_traits = getattr(nodes[annotated_idxs[0]],trait_label)
+        try:
+            n_traits = len(first_traits)
+        except TypeError:
+            raise TypeError("Node trait values must be arrays!  Couldn't call len() on %s" % first_traits)
 
-    # cache nodes to avoid tree traversals
+    #A tip's prediction depends only on its parent: the parent's most recent
+    #reconstructed ancestor and its annotated children. So tips are grouped
+    #by parent, and each parent is predicted once.
     nodes_to_predict = set(nodes_to_predict)
-    node_lookup = dict([(n.Name,n) for n in tree.tips() \
-                         if n.Name in nodes_to_predict])
-
-    print_this_node = False
-    for i,node_label in enumerate(nodes_to_predict):
-        if verbose:
-            #Only prent every 1/100 tips predicted
-            if i%one_percent_progress==0:
-                print_this_node = True
-            else:
-                print_this_node = False
-
-        if print_this_node:
-            print "Predicting traits for node %i/%i:%s" %(i,len(nodes_to_predict),node_label)
-        node_to_predict = node_lookup[node_label]
-
-        traits = getattr(node_to_predict,trait_label)
-
-        # Do a little checking to make sure trait values either look
-        # like valid numpy arrays of equal length, are not specified
-        # or are set to None.
-
-        if traits is not None:
-            if n_traits is None:
-                #Check that trait length is consistent
-                try:
-                    n_traits = len(traits)
-                except TypeError:
-                    raise TypeError("Node trait values must be arrays!  Couldn't call len() on %s" % traits)
-
-            if traits and len(traits) != n_traits:
-                raise ValueError(\
-                  "The number of traits in the array for node %s (%i) does not match other nodes (%i)" %(\
-                   node_to_predict,len(traits),n_traits))
-
-        #If we already know the answer (because a genome is sequenced), skip
-        #the prediction step, and use the known answer.
+    tips_by_parent = defaultdict(list)
+    #Set up a dict to hold alredy sequenced genomes/tips with known character values
+    tips_with_prior_info = {}
+    for node_label in nodes_to_predict:
+        tip = tree_index.tip_index(node_label)
+        traits = getattr(nodes[tip],trait_label,None)
         if traits is not None:
             # if we already know the traits (e.g. from a sequenced genome)
             # just predict those traits
@@ -1032,62 +990,132 @@ def predict_traits_from_ancestors(tree,
             #These will overwrite predictions downstream
             #predictions are still performed to roughly estimate variance
             #which will still be non-zero due to within-OTU effects
+        tips_by_parent[int(tree_index.parents[tip])].append(tip)
 
-        #Find ancestral states, possibly with variance values
-        if calc_confidence_intervals:
-            ancestral_states,ancestral_variance =\
-              get_most_recent_ancestral_states(node_to_predict,trait_label,\
-              upper_bound_trait_label=upper_bound_trait_label,\
-              lower_bound_trait_label=lower_bound_trait_label)
-
-        #Find most recent ancestral node with ASR values
-        most_recent_reconstructed_ancestor =\
-            get_most_recent_reconstructed_ancestor(node_to_predict,trait_label)
-        #print "Calc_confidence_intervals:",calc_confidence_intervals
-        #print "most_recent_reconstructed_ancestor",most_recent_reconstructed_ancestor
-        #Perform point estimate of trait values using weighted-average
-        #prediction from last reconstructed ancestor
-        prediction =\
-              weighted_average_tip_prediction(tree,node_to_predict,\
-              most_recent_reconstructed_ancestor =\
-              most_recent_reconstructed_ancestor,\
-              weight_fn = weight_fn)
-        #round all predictions to whole numbers
+    if calc_confidence_intervals:
+        brownian_motion_parameter = array(brownian_motion_parameter,dtype=float)
+        ancestral_variances = {}
+        z = ndtri(0.95)
 
+    parents = sorted(tips_by_parent)
+    if verbose:
+        print "Predicting traits for %i nodes from %i parent nodes" %\
+          (len(nodes_to_predict),len(parents))
+
+    for block_start in xrange(0,len(parents),PREDICTION_BLOCK_SIZE):
+        block_parents = parents[block_start:block_start+PREDICTION_BLOCK_SIZE]
+
+        #Build a sparse parents x nodes matrix of weights. As in
+        #weighted_average_tip_prediction, each row holds the weight of the
+        #most recent reconstructed ancestor followed by those of the annotated
+        #children in the order of parent.Children.
+        columns = {}
+        weights = []
+        indices = []
+        indptr = [0]
+        total_weights = []
+        variance_coefficients = []
+        for parent in block_parents:
+            entries = []
+            if parent >= 0:
+                ancestor = int(ancestors[parent])
+                if ancestor >= 0:
+                    entries.append((ancestor,\
+                      weight_fn(float(ancestor_distances[parent])),\
+                      float(ancestor_distances[parent])))
+                for child in tree_index.children(parent):
+                    if annotated[child]:
+                        distance_to_parent = float(tree_index.lengths[child])
+                        entries.append((int(child),\
+                          weight_fn(distance_to_parent),distance_to_parent))
+
+            total_weight = None
+            variance_coefficient = 0.0
+            for node_idx,weight,distance in entries:
+                indices.append(columns.setdefault(node_idx,len(columns)))
+                weights.append(weight)
+                if total_weight is None:
+                    total_weight = weight
+                else:
+                    total_weight += weight
+                variance_coefficient += weight**2 * distance
+            indptr.append(len(indices))
+            total_weights.append(total_weight)
+            variance_coefficients.append(variance_coefficient)
+
+        column_nodes = sorted(columns,key=columns.get)
+        block_traits = stack_node_traits([nodes[i] for i in column_nodes],\
+          trait_label,n_traits)
+        weight_matrix = csr_matrix((weights,indices,indptr),\
+          shape=(len(block_parents),len(column_nodes)))
+        block_predictions = weight_matrix * block_traits
+
+        #Parents without a reconstructed ancestor or annotated children
+        #can't be predicted
+        has_prediction = array([w is not None for w in total_weights],dtype=bool)
+        denominators = array([w if w is not None else 1.0 \
+          for w in total_weights],dtype=float)
+        block_predictions /= denominators[:,newaxis]
         if round_predictions:
-            prediction=around(prediction)
+            block_predictions = around(block_predictions)
 
-        results[node_label] = prediction
+        if calc_confidence_intervals:
+            #The variance of the weighted mean at the parent combines the
+            #ancestral reconstruction's variance with Brownian motion along
+            #each weighted branch:
+            #  sum(w_i**2 * var_i) = w_anc**2 * var_anc + sum(w_i**2 * d_i) * bm
+            parent_variances = []
+            for row,parent in enumerate(block_parents):
+                if indptr[row] == indptr[row+1] or parent < 0 or ancestors[parent] < 0:
+                    raise ValueError("No reconstructed ancestor was found for the parent of node %s, so confidence intervals can't be calculated" % nodes[tips_by_parent[parent][0]].Name)
+                ancestor = int(ancestors[parent])
+                if ancestor not in ancestral_variances:
+                    ancestral_variances[ancestor] =\
+                      _ancestral_variance(nodes[ancestor],trait_label,\
+                      upper_bound_trait_label,z)
+                ancestor_weight = weights[indptr[row]]
+                parent_variances.append(sqrt(ancestor_weight**2 *\
+                  ancestral_variances[ancestor] +\
+                  variance_coefficients[row]*brownian_motion_parameter))
+            parent_variances = array(parent_variances,dtype=float).reshape(\
+              len(block_parents),n_traits)
+
+        tips = []
+        tip_rows = []
+        for row,parent in enumerate(block_parents):
+            for tip in tips_by_parent[parent]:
+                if has_prediction[row]:
+                    tips.append(tip)
+                    tip_rows.append(row)
+                else:
+                    results[nodes[tip].Name] = None
+        tip_predictions = block_predictions[tip_rows]
+        for tip,prediction in zip(tips,tip_predictions):
+            results[nodes[tip].Name] = prediction
 
         #Now calculate variance of the estimate if requested
         if calc_confidence_intervals:
-            variances =\
-              weighted_average_variance_prediction(tree,node_to_predict,\
-              weight_fn = weight_fn,\
-              most_recent_reconstructed_ancestor =\
-              most_recent_reconstructed_ancestor,\
-              ancestral_variance=ancestral_variance,\
-              brownian_motion_parameter=brownian_motion_parameter)
-
-            variance_result[node_label] = {"variance":variances.tolist()}
-           
-            lower_95_CI,upper_95_CI = calc_confidence_interval_95(prediction,
-                                                                  variances,
-                                                                  round_CI=round_predictions)
-            confidence_interval_results[node_label]['lower_CI']=lower_95_CI
-            confidence_interval_results[node_label]['upper_CI']=upper_95_CI
-
-
-        if print_this_node:
-            n_traits_to_print = min(len(prediction),50)
-            print "First %i trait predictions:%s" %(n_traits_to_print,\
-              ','.join(map(str,list(prediction[:n_traits_to_print]))))
-
-            if calc_confidence_intervals:
-                print "First %i trait variances:%s" %(n_traits_to_print,\
-                  ','.join(map(str,list(variances[:n_traits_to_print]))))
-                print "Lower 95% confidence interval:",lower_95_CI[:n_traits_to_print]
-                print "Upper 95% confidence interval:",upper_95_CI[:n_traits_to_print]
+            #The variance added due to evolution between the parent and the
+            #predicted node is independent of the variance in the parent
+            tip_lengths = tree_index.lengths[tips]
+            tip_variances = parent_variances[tip_rows] +\
+              tip_lengths[:,newaxis]*brownian_motion_parameter
+            lower_95_CI,upper_95_CI = calc_confidence_interval_95(\
+              tip_predictions,tip_variances,round_CI=round_predictions)
+            for i,tip in enumerate(tips):
+                node_label = nodes[tip].Name
+                variance_result[node_label] = {"variance":tip_variances[i].tolist()}
+                confidence_interval_results[node_label]['lower_CI']=lower_95_CI[i]
+                confidence_interval_results[node_label]['upper_CI']=upper_95_CI[i]
+
+        if verbose:
+            print "Predicted traits for the children of %i/%i parent nodes" %\
+              (block_start+len(block_parents),len(parents))
+            if tips:
+                n_traits_to_print = min(n_traits,50)
+                print "First %i trait predictions for %s:%s" %(n_traits_to_print,\
+                  nodes[tips[0]].Name,\
+                  ','.join(map(str,list(tip_predictions[0][:n_traits_to_print]))))
 
     #Overwrite known results from the dict of known results
     results.update(tips_with_prior_info)
@@ -1097,6 +1125,41 @@ def predict_traits_from_ancestors(tree,
     else:
         return results
 
+def stack_node_traits(nodes,trait_label="Reconstruction",n_traits=None):
+    """Return a nodes x traits array of the traits of nodes
+
+    nodes -- a list of PhyloNode objects, each with an array of traits
+    stored in the attribute specified by trait_label
+    n_traits -- the number of traits each node must have.  If None, this
+    is taken from the first node.
+    """
+    rows = []
+    for node in nodes:
+        traits = getattr(node,trait_label)
+        try:
+            n_node_traits = len(traits)
+        except TypeError:
+            raise TypeError("Node trait values must be arrays!  Couldn't call len() on %s" % traits)
+        if n_traits is None:
+            n_traits = n_node_traits
+        elif n_node_traits != n_traits:
+            raise ValueError(\
+              "The number of traits in the array for node %s (%i) does not match other nodes (%i)" %(\
+              node.Name,n_node_traits,n_traits))
+        rows.append(traits)
+    return array(rows,dtype=float).reshape(len(rows),n_traits or 0)
+
+def _ancestral_variance(node,trait_label,upper_bound_trait_label,z):
+    """Return the variance of each of node's reconstructed traits
+
+    The variances are those of normal distributions fit to the upper 95%
+    confidence limits of the reconstruction, as in
+    fit_normal_to_confidence_interval
+    """
+    traits = array(getattr(node,trait_label),dtype=float)
+    upper_bound = array(getattr(node,upper_bound_trait_label),dtype=float)
+    return (abs(upper_bound - traits) / z)**2
+
 def calc_confidence_interval_95(predictions,variances,round_CI=True,\
         min_val=0.0,max_val=None):
     """Calc the 95% confidence interval given predictions and variances"""
@@ -1194,36 +1257,78 @@ def get_most_recent_reconstructed_ancestor(node,trait_label="Reconstruction"):
     # then there are no most recent reconstructed ancestors
     return None
 
-def update_trait_dict_from_file(table_file, header = [],input_sep="\t"):
-    """Update a trait dictionary from a table file
+def check_trait_table_header(table_header, header):
+    """Check that the traits of a trait table can be ordered as in header
 
-    table_file --  File name of a trait table.
+    table_header -- the header row of the trait table (the name of the
+      row ids, followed by the trait names)
+    header -- the trait names the table is expected to have
 
-    The first line should be a header line, with column headers equal to trait
-    (e.g. gene family) names, while the row headers should be organism
-    ids that match the tree.
+    Warns if the table has traits that are not in header (they will not be
+    predicted), and raises a RuntimeError if header has traits that are
+    not in the table.
+    """
+    #error checking to make sure traits in ASR table are a subset of traits in genome table
+    if set(header) != set(table_header[1:]):
+        if set(header).issubset(set(table_header[1:])):
+            diff_traits = set(table_header[1:]).difference(set(header))
+            warn("Missing traits in given ASR table with labels:{0}. Predictions will not be produced for these traits.".format(list(diff_traits)))
+        else:
+            raise RuntimeError("Given ASR trait table contains one or more traits that do not exist in given genome trait table. Predictions can not be made.")
 
-    trait_dict -- a dictionary of traits, keyed by organism.
-    Items in trait dict will be overwritten if present.
+def _cast_trait_table_id(value):
+    """Cast a row id as cogent's LoadTable does: int, then float, then str"""
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+def _open_trait_table(table_file):
+    """Open a trait table file, as text, gzipped if it ends in gz"""
+    if table_file.endswith('gz'):
+        return GzipFile(table_file,'rb')
+    return open(table_file,'U')
+
+def load_trait_table(table_file, header = [],input_sep="\t"):
+    """Load a trait table file, with columns ordered as in header
+
+    table_file --  File name of a trait table.
+    header -- trait names, in the order the columns should be returned.
+    If empty, the order in the file is used.
+
+    Returns a cogent Table, with organism ids in the first column.
     """
     #First line should be headers
     table=LoadTable(filename=table_file,header=True,sep=input_sep)
 
     #do some extra stuff to match columns if a header is provided
     if header:
-        #error checking to make sure traits in ASR table are a subset of traits in genome table
-        if set(header) != set(table.Header[1:]):
-            if set(header).issubset(set(table.Header[1:])):
-                diff_traits = set(table.Header[1:]).difference(set(header))
-                warn("Missing traits in given ASR table with labels:{0}. Predictions will not be produced for these traits.".format(list(diff_traits)))
-            else:
-                raise RuntimeError("Given ASR trait table contains one or more traits that do not exist in given genome trait table. Predictions can not be made.")
+        check_trait_table_header(table.Header,header)
 
         #Note: keep the first column heading at the beginning not sorted (this is the name for the row ids
         sorted_header=[table.Header[0]]
         sorted_header.extend(header)
         table = table.getColumns(sorted_header)
 
+    return table
+
+def update_trait_dict_from_file(table_file, header = [],input_sep="\t"):
+    """Update a trait dictionary from a table file
+
+    table_file --  File name of a trait table.
+
+    The first line should be a header line, with column headers equal to trait
+    (e.g. gene family) names, while the row headers should be organism
+    ids that match the tree.
+
+    trait_dict -- a dictionary of traits, keyed by organism.
+    Items in trait dict will be overwritten if present.
+    """
+    table = load_trait_table(table_file,header,input_sep)
+
     traits = {}
     for fields in table:
         try:
@@ -1235,6 +1340,185 @@ def update_trait_dict_from_file(table_file, header = [],input_sep="\t"):
 
     return table.Header[1:],traits
 
+def trait_store_from_file(table_file, header = [],input_sep="\t",\
+  dtype=float32):
+    """Load a trait table file into a TraitStore
+
+    Takes the same arguments as update_trait_dict_from_file, plus the dtype
+    of the stored traits, and returns the trait names and a TraitStore.
+
+    The file is read twice, one line at a time: once to count its rows, and
+    once to parse each row straight into the preallocated trait array, so
+    the table is never held in memory as strings. Row ids are cast as by
+    load_trait_table.
+    """
+    table_fh = _open_trait_table(table_file)
+    try:
+        n_rows = sum(1 for fields in csv_reader(table_fh,delimiter=input_sep)\
+          if fields) - 1
+    finally:
+        table_fh.close()
+
+    table_fh = _open_trait_table(table_file)
+    try:
+        rows = (fields for fields in csv_reader(table_fh,delimiter=input_sep)\
+          if fields)
+        table_header = rows.next()
+        if header:
+            check_trait_table_header(table_header,header)
+        else:
+            header = table_header[1:]
+        column_idxs = [table_header.index(trait) for trait in header]
+
+        data = empty((max(n_rows,0),len(header)),dtype=dtype)
+        ids = []
+        for i,fields in enumerate(rows):
+            try:
+                data[i] = [float(fields[j]) for j in column_idxs]
+            except (ValueError,IndexError):
+                err_str =\
+                        "Could not convert trait table fields:'%s' to float" %(fields[1:])
+                raise ValueError(err_str)
+            ids.append(_cast_trait_table_id(fields[0]))
+    finally:
+        table_fh.close()
+
+    return list(header),TraitStore(data,ids)
+
+def asr_confidence_stores_from_file(table_file,param_names=['loglik','sigma'],\
+  dtype=float32):
+    """Load the confidence intervals of an ancestral state reconstruction
+
+    Parses the same format as picrust.parse.parse_asr_confidence_output, but
+    fills the lower and upper bounds of each node straight into two
+    TraitStores rather than into dicts of lists. As with
+    trait_store_from_file, the file is read twice, to size the arrays and
+    then to fill them.
+
+    Returns (lower bounds, upper bounds, params, column_mapping), as
+    parse_asr_confidence_output does.
+    """
+    table_fh = _open_trait_table(table_file)
+    try:
+        n_rows = -1
+        n_traits = 0
+        for line in table_fh:
+            if line.strip():
+                n_rows += 1
+                n_traits = max(n_traits,len(line.split("\t"))-1)
+    finally:
+        table_fh.close()
+
+    min_data = empty((max(n_rows,0),n_traits),dtype=dtype)
+    max_data = empty((max(n_rows,0),n_traits),dtype=dtype)
+    row_idxs = {}
+    params = {}
+    column_mapping = {}
+    table_fh = _open_trait_table(table_file)
+    try:
+        lines = (line for line in table_fh if line.strip())
+        column_names = lines.next().split("\t")[1:]
+        for i,column_name in enumerate(column_names):
+            column_mapping[column_name] = i
+        for line in lines:
+            fields = line.split("\t")
+            if fields[0] in param_names:
+                params[fields[0]] = [None if val == "NaN" else float(val)\
+                  for val in fields[1].split("|")]
+                continue
+            organism_name = fields[0]
+            #as with a dict, a node listed twice keeps its last bounds
+            i = row_idxs.setdefault(organism_name,len(row_idxs))
+            bounds = [f.split("|") for f in fields[1:]]
+            if len(bounds) != n_traits:
+                raise ValueError("The number of traits for node %s (%i) does not match other nodes (%i)" %(organism_name,len(bounds),n_traits))
+            min_data[i] = [float(lower) for lower,upper in bounds]
+            max_data[i] = [float(upper) for lower,upper in bounds]
+    finally:
+        table_fh.close()
+
+    ids = sorted(row_idxs,key=row_idxs.get)
+    return TraitStore(min_data[:len(ids)],ids),\
+      TraitStore(max_data[:len(ids)],ids),params,column_mapping
+
+class TraitStore(object):
+    """Traits of many nodes, held in a single nodes x traits array
+
+    Each node's traits are a row of data, looked up by node name. A
+    TraitStore can be passed in place of a dict of traits (e.g. to
+    assign_traits_to_tree), in which case each node is assigned a view of
+    its row rather than its own list of floats.
+    """
+
+    def __init__(self, data, ids):
+        """
+        data -- a 2D numpy array with one row of traits per node
+        ids -- the node names, in the order of the rows of data
+        """
+        if len(data) != len(ids):
+            raise ValueError("The number of rows of traits (%i) does not match the number of node names (%i)" % (len(data),len(ids)))
+        self.data = data
+        self.ids = list(ids)
+        self._index = dict((node_id,i) for i,node_id in enumerate(self.ids))
+        if len(self._index) != len(self.ids):
+            raise ValueError("Node names in a TraitStore must be unique")
+
+    @classmethod
+    def from_dict(cls, traits, dtype=float32):
+        """Return a TraitStore of a dict of trait arrays, keyed by node name"""
+        ids = traits.keys()
+        n_traits = len(traits[ids[0]]) if ids else 0
+        data = empty((len(ids),n_traits),dtype=dtype)
+        for i,node_id in enumerate(ids):
+            if len(traits[node_id]) != n_traits:
+                raise ValueError(\
+                  "The number of traits in the array for node %s (%i) does not match other nodes (%i)" %(\
+                  node_id,len(traits[node_id]),n_traits))
+            data[i] = traits[node_id]
+        return cls(data,ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, node_id):
+        return node_id in self._index
+
+    def __getitem__(self, node_id):
+        return self.data[self._index[node_id]]
+
+    def get(self, node_id, default=None):
+        if node_id in self._index:
+            return self.data[self._index[node_id]]
+        return default
+
+    def keys(self):
+        return list(self.ids)
+
+    def rows(self, node_ids):
+        """Return a 2D array of the traits of node_ids, one row per node"""
+        return self.data[[self._index[node_id] for node_id in node_ids]]
+
+    def update(self, other):
+        """Add the traits in other, overwriting those of nodes in both
+
+        As with dict.update. other must be a TraitStore with the same traits.
+        """
+        if other.data.shape[1] != self.data.shape[1]:
+            raise ValueError("Can't combine TraitStores with different numbers of traits (%i and %i)" % (self.data.shape[1],other.data.shape[1]))
+        new_ids = [node_id for node_id in other.ids if node_id not in self._index]
+        data = self.data
+        if new_ids:
+            data = concatenate([data,empty((len(new_ids),data.shape[1]),\
+              dtype=data.dtype)])
+            for node_id in new_ids:
+                self._index[node_id] = len(self.ids)
+                self.ids.append(node_id)
+        data[[self._index[node_id] for node_id in other.ids]] = other.data
+        self.data = data
+
 def normal_product_monte_carlo(mean1,variance1,mean2,variance2,confidence =0.95, n_trials = 5000):
     """Estimate the lower & upper confidence limits for the product of two normal distributions
 
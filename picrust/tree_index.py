@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2015, The PICRUSt Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.1.4"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+__status__ = "Development"
+
+from numpy import arange, array, argsort, asarray, bincount, concatenate,\
+  cumsum, empty, float64, int32, int64, maximum, minimum, where, zeros
+
+
+class TreeIndex(object):
+    """Array representation of a PyCogent tree, built in one traversal
+
+    Nodes are numbered in preorder, so every node comes after its parent.
+    The index holds:
+
+     - nodes: the PhyloNode objects, in preorder
+     - names: their names
+     - parents: the index of each node's parent (-1 for the root)
+     - lengths: the length of the branch above each node (0.0 where the
+       node has no Length, as in PhyloNode.distance)
+     - is_tip: True for nodes without children
+     - depths: the number of branches between each node and the root
+     - root_distances: the branch length from the root to each node
+
+    The children of node i are child_idxs[child_ptr[i]:child_ptr[i+1]], in
+    the order of node.Children.
+
+    Per-node computations that would otherwise walk node.ancestors() or call
+    node.distance() for every node can then be done with one pass over
+    these arrays.
+    """
+
+    def __init__(self, tree):
+        self.nodes = list(tree.preorder())
+        self.names = [node.Name for node in self.nodes]
+        n_nodes = len(self.nodes)
+
+        node_idxs = dict((id(node), i) for i, node in enumerate(self.nodes))
+        self.parents = array([node_idxs.get(id(node.Parent), -1)
+                              if node.Parent is not None else -1
+                              for node in self.nodes], dtype=int64)
+        self.parents[0] = -1
+        self.lengths = array([node.Length or 0.0 for node in self.nodes],
+                             dtype=float64)
+        self.is_tip = array([not node.Children for node in self.nodes],
+                            dtype=bool)
+
+        # a stable sort by parent keeps siblings in preorder, which is the
+        # order of node.Children
+        non_root = self.parents >= 0
+        child_parents = self.parents[non_root]
+        self.child_idxs = non_root.nonzero()[0][
+            argsort(child_parents, kind='mergesort')]
+        self.child_ptr = concatenate(([0], cumsum(
+            bincount(child_parents, minlength=n_nodes)))).astype(int64)
+
+        depths = [0] * n_nodes
+        root_distances = [0.0] * n_nodes
+        parents = self.parents.tolist()
+        lengths = self.lengths.tolist()
+        for i in xrange(1, n_nodes):
+            depths[i] = depths[parents[i]] + 1
+            root_distances[i] = root_distances[parents[i]] + lengths[i]
+        self.depths = array(depths, dtype=int64)
+        self.root_distances = array(root_distances, dtype=float64)
+
+        self._tip_lookup = None
+        self._lca_table = None
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def children(self, i):
+        """Return the indices of the children of node i"""
+        return self.child_idxs[self.child_ptr[i]:self.child_ptr[i + 1]]
+
+    def tip_index(self, name):
+        """Return the index of the tip called name (KeyError if missing)"""
+        if self._tip_lookup is None:
+            self._tip_lookup = dict((self.names[i], i)
+                                    for i in self.is_tip.nonzero()[0])
+        return self._tip_lookup[name]
+
+    def _build_lca_table(self):
+        """Build a sparse table of the shallowest node in preorder ranges
+
+        Row k holds, for each index i, the shallowest of nodes i to
+        i + 2**k - 1. This takes O(n log n) time and memory, once.
+        """
+        n_nodes = len(self.nodes)
+        n_levels = 1
+        while 2 ** n_levels <= n_nodes:
+            n_levels += 1
+        table = empty((n_levels, n_nodes), dtype=int32)
+        table[0] = arange(n_nodes)
+        for k in xrange(1, n_levels):
+            half = 2 ** (k - 1)
+            left = table[k - 1, :n_nodes - half]
+            right = table[k - 1, half:]
+            table[k, :n_nodes - half] = where(
+                self.depths[left] <= self.depths[right], left, right)
+            #unused: no range starting here is 2**k nodes long
+            table[k, n_nodes - half:] = table[k - 1, n_nodes - half:]
+
+        log2 = zeros(n_nodes + 1, dtype=int64)
+        for i in xrange(2, n_nodes + 1):
+            log2[i] = log2[i // 2] + 1
+        self._log2 = log2
+        self._lca_table = table
+
+    def lowest_common_ancestors(self, a, b):
+        """Return the lowest common ancestors of nodes a and b
+
+        a, b -- node indices, or equal length arrays of node indices
+
+        Because nodes are numbered in preorder, the subtree of the lowest
+        common ancestor of nodes i < j spans i to j, and its child on the
+        path to j is the shallowest of nodes i+1 to j. That node is found
+        with two lookups in a sparse table (built on the first call), so
+        each query takes constant time.
+        """
+        if self._lca_table is None:
+            self._build_lca_table()
+        a = asarray(a)
+        b = asarray(b)
+        low = minimum(a, b)
+        high = maximum(a, b)
+        start = minimum(low + 1, high)
+        k = self._log2[high - start + 1]
+        left = self._lca_table[k, start]
+        right = self._lca_table[k, high - (1 << k) + 1]
+        shallowest = where(self.depths[left] <= self.depths[right],
+                           left, right)
+        return where(low == high, low, self.parents[shallowest])
+
+    def distances(self, a, b):
+        """Return the branch length between nodes a and b
+
+        a, b -- node indices, or equal length arrays of node indices
+
+        Distances are found from the root distances of the nodes and their
+        lowest common ancestor, in constant time per pair.
+        """
+        ancestors = self.lowest_common_ancestors(a, b)
+        return (self.root_distances[a] + self.root_distances[b] -
+                2 * self.root_distances[ancestors])
+
+    def distance(self, i, j):
+        """Return the branch length between nodes i and j, as a float"""
+        return float(self.distances(i, j))
+
+    def nearest_annotated_ancestors(self, annotated):
+        """Return the closest annotated node at or above each node
+
+        annotated -- boolean array with True for nodes that have traits
+
+        Returns (ancestors, distances): ancestors[i] is i itself if it is
+        annotated, and otherwise the first annotated node on the path to the
+        root (-1 if there is none). distances[i] is the branch length from
+        node i up to ancestors[i].
+        """
+        ancestors = zeros(len(self.nodes), dtype=int64)
+        distances = zeros(len(self.nodes), dtype=float64)
+        parents = self.parents
+        lengths = self.lengths
+        for i in xrange(len(self.nodes)):
+            if annotated[i]:
+                ancestors[i] = i
+            elif parents[i] < 0:
+                ancestors[i] = -1
+            else:
+                parent = parents[i]
+                ancestors[i] = ancestors[parent]
+                distances[i] = lengths[i] + distances[parent]
+        return ancestors, distances
+
+    def nearest_annotated_nodes(self, annotated, include_self=True,
+                                tips_only=True):
+        """Return the closest annotated node to each node, in linear time
+
+        annotated -- boolean array with True for nodes that have traits
+        include_self -- if False, an annotated node is not its own nearest
+          annotated node
+        tips_only -- if True, only annotated tips are considered as
+          neighbours. If False, annotated internal nodes are too.
+
+        The nearest annotated node in each node's subtree is found in a
+        postorder pass, keeping the best and second best child subtrees of
+        each node. A preorder pass then finds the nearest annotated node
+        outside each node's subtree: through the node's parent, either in a
+        sibling's subtree, at the parent itself or outside the parent's
+        subtree.
+
+        Returns (neighbors, distances): neighbors[i] is the index of the
+        annotated node closest to node i (-1 if there is none), and
+        distances[i] is the branch length between them (inf if there is
+        none).
+        """
+        n_nodes = len(self.nodes)
+        parents = self.parents.tolist()
+        lengths = self.lengths.tolist()
+        if tips_only:
+            candidates = (self.is_tip & annotated).tolist()
+        else:
+            candidates = [bool(a) for a in annotated]
+        inf = float('inf')
+
+        #nearest annotated node within each node's subtree (the node itself,
+        #if it is annotated)
+        down = [0.0 if c else inf for c in candidates]
+        down_node = [i if c else -1 for i, c in enumerate(candidates)]
+        #the child whose subtree holds it, and the runner-up, so a child can
+        #exclude its own subtree in the preorder pass. For annotated nodes
+        #the runner-up is the nearest node in any child's subtree.
+        down_child = [-1] * n_nodes
+        second = [inf] * n_nodes
+        second_node = [-1] * n_nodes
+        for i in xrange(n_nodes - 1, 0, -1):
+            parent = parents[i]
+            if parent < 0:
+                continue
+            d = down[i] + lengths[i]
+            if d < down[parent]:
+                second[parent] = down[parent]
+                second_node[parent] = down_node[parent]
+                down[parent] = d
+                down_node[parent] = down_node[i]
+                down_child[parent] = i
+            elif d < second[parent]:
+                second[parent] = d
+                second_node[parent] = down_node[i]
+
+        #nearest annotated node outside each node's subtree
+        up = [inf] * n_nodes
+        up_node = [-1] * n_nodes
+        for i in xrange(1, n_nodes):
+            parent = parents[i]
+            if parent < 0:
+                continue
+            if down_child[parent] == i:
+                d, node = second[parent], second_node[parent]
+            else:
+                d, node = down[parent], down_node[parent]
+            if up[parent] < d:
+                d, node = up[parent], up_node[parent]
+            up[i] = d + lengths[i]
+            up_node[i] = node
+
+        neighbors = []
+        distances = []
+        for i in xrange(n_nodes):
+            if candidates[i] and not include_self:
+                d, node = second[i], second_node[i]
+            else:
+                d, node = down[i], down_node[i]
+            if up[i] < d:
+                d, node = up[i], up_node[i]
+            neighbors.append(node)
+            distances.append(d)
+        return array(neighbors, dtype=int64), array(distances, dtype=float64)
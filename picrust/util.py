@@ -18,11 +18,12 @@ from biom.util import biom_open, HAVE_H5PY
 from cogent.core.tree import PhyloNode, TreeError
 from contextlib import contextmanager
 from json import dumps
-from numpy import array, asarray, atleast_1d
+from numpy import array, asarray, atleast_1d, empty, float64
 from os import fsync, makedirs, remove, rename
 from os.path import abspath, dirname, isdir, join, split
 import StringIO
 from subprocess import PIPE, Popen
+from picrust.tree_index import TreeIndex
 
 
 def make_sample_transformer(scaling_factors):
@@ -42,7 +43,12 @@ def scale_metagenomes(metagenome_table,scaling_factors):
 
 
 def convert_precalc_to_biom(precalc_in, ids_to_load=None,transpose=True,md_prefix='metadata_'):
-    """Loads PICRUSTs tab-delimited version of the precalc file and outputs a BIOM object"""
+    """Loads PICRUSTs tab-delimited version of the precalc file and outputs a BIOM object
+
+    If ids_to_load is given, only the id field of each line is split off and
+    looked up in a set; the values of matching rows are parsed straight into a
+    preallocated array and all other rows are skipped without being parsed.
+    """
 
     #if given a string convert to a filehandle
     if type(precalc_in) ==str or type(precalc_in) == unicode:
@@ -67,34 +73,42 @@ def convert_precalc_to_biom(precalc_in, ids_to_load=None,transpose=True,md_prefi
     if ids_to_load is not None and len(ids_to_load) > 0:
         ids_to_load=set(ids_to_load)
         load_all_ids=False
+        #each requested id is loaded at most once
+        matching=empty((len(ids_to_load),len(trait_ids)),dtype=float64)
     else:
         load_all_ids=True
+        matching=[]
 
-    matching=[]
     otu_ids=[]
     for line in fh:
-        fields = line.strip().split('\t')
-        row_id=fields[0]
+        row_id=line.split('\t',1)[0].strip()
         if(row_id.startswith(md_prefix)):
             #handle metadata
+            fields = line.strip().split('\t')
 
             #determine type of metadata (this may not be perfect)
             metadata_type=determine_metadata_type(line)
             for idx,trait_name in enumerate(trait_ids):
                 row_meta[idx][row_id[len(md_prefix):]]=parse_metadata_field(fields[idx+1],metadata_type)
+            continue
+
+        if load_all_ids:
+            fields = line.strip().split('\t')
+            matching.append(asarray(fields[1:end_of_data],dtype=float64))
+        elif row_id in ids_to_load:
+            fields = line.strip().split('\t')
+            matching[len(otu_ids)]=asarray(fields[1:end_of_data],dtype=float64)
+            ids_to_load.remove(row_id)
+        else:
+            continue
 
-        elif load_all_ids or (row_id in set(ids_to_load)):
-            otu_ids.append(row_id)
-            matching.append(map(float,fields[1:end_of_data]))
-
-            #add metadata
-            col_meta_dict={}
-            for meta_name in col_meta_locs:
-                col_meta_dict[meta_name]=fields[col_meta_locs[meta_name]]
-            col_meta.append(col_meta_dict)
+        otu_ids.append(row_id)
 
-            if not load_all_ids:
-                ids_to_load.remove(row_id)
+        #add metadata
+        col_meta_dict={}
+        for meta_name in col_meta_locs:
+            col_meta_dict[meta_name]=fields[col_meta_locs[meta_name]]
+        col_meta.append(col_meta_dict)
 
     if not otu_ids:
         raise ValueError,"No OTUs match identifiers in precalculated file. PICRUSt requires an OTU table reference/closed picked against GreenGenes.\nExample of the first 5 OTU ids from your table: {0}".format(', '.join(list(ids_to_load)[:5]))
@@ -103,7 +117,7 @@ def convert_precalc_to_biom(precalc_in, ids_to_load=None,transpose=True,md_prefi
        raise ValueError,"One or more OTU ids were not found in the precalculated file!\nAre you using the correct --gg_version?\nExample of (the {0}) unknown OTU ids: {1}".format(len(ids_to_load),', '.join(list(ids_to_load)[:5]))
 
     #note that we transpose the data before making biom obj
-    matching = asarray(matching)
+    matching = asarray(matching)[:len(otu_ids)]
     if transpose:
         return Table(matching.T, trait_ids, otu_ids, row_meta, col_meta,
                      type='Gene table')
@@ -349,7 +363,25 @@ def make_output_dir(dirpath, strict=False):
     return dirpath
 
 
+def _indexed_id(node, tree_index):
+    """Return node's index in tree_index, or None if it isn't indexed there
+
+    Nodes copied from an indexed tree, or indexed in an earlier index, are
+    not in tree_index.
+    """
+    if getattr(node, '_tree_index', None) is not tree_index:
+        return None
+    i = node._tree_index_id
+    if tree_index.nodes[i] is not node:
+        return None
+    return i
+
 class PicrustNode(PhyloNode):
+    # the distance index is shared by the whole tree, so copies of a node
+    # must not carry (or deepcopy) it
+    _exclude_from_copy = dict(getattr(PhyloNode, '_exclude_from_copy', {}),
+                              _tree_index=None, _tree_index_id=None)
+
     def multifurcating(self, num, eps=None, constructor=None):
         """Return a new tree with every node having num or few children
 
@@ -438,6 +470,61 @@ class PicrustNode(PhyloNode):
 
         return tcopy
 
+    def buildDistanceIndex(self):
+        """Index the tree below self so distances between its nodes are O(1)
+
+        Builds a TreeIndex of the tree rooted at self, and records each
+        node's place in it. Afterwards distance() and distances() between
+        nodes of the tree look up root distances and lowest common
+        ancestors in the index, rather than walking the tree.
+
+        The index describes the tree as it is now: call
+        clearDistanceIndex (or buildDistanceIndex again) after changing
+        the tree's topology or branch lengths.
+
+        Returns the TreeIndex.
+        """
+        tree_index = TreeIndex(self)
+        for i, node in enumerate(tree_index.nodes):
+            node._tree_index = tree_index
+            node._tree_index_id = i
+        return tree_index
+
+    def clearDistanceIndex(self):
+        """Remove the index built by buildDistanceIndex"""
+        for node in self.preorder(include_self=True):
+            node.__dict__.pop('_tree_index', None)
+            node.__dict__.pop('_tree_index_id', None)
+
+    def distance(self, other):
+        """Return the branch length between self and other
+
+        Uses the distance index if both nodes are in it (see
+        buildDistanceIndex), and PhyloNode.distance otherwise.
+        """
+        tree_index = getattr(self, '_tree_index', None)
+        if tree_index is not None:
+            i = _indexed_id(self, tree_index)
+            j = _indexed_id(other, tree_index)
+            if i is not None and j is not None:
+                return tree_index.distance(i, j)
+        return PhyloNode.distance(self, other)
+
+    def distances(self, others):
+        """Return an array of the branch lengths between self and others
+
+        With a distance index (see buildDistanceIndex) this is a single
+        vectorized lookup; otherwise each distance is found in turn.
+        """
+        tree_index = getattr(self, '_tree_index', None)
+        if tree_index is not None:
+            i = _indexed_id(self, tree_index)
+            ids = [_indexed_id(other, tree_index) for other in others]
+            if i is not None and None not in ids:
+                return tree_index.distances(i, array(ids, dtype=int))
+        return array([PhyloNode.distance(self, other) for other in others],
+                     dtype=float64)
+
 def list_of_list_of_str_formatter(grp, header, md, compression):
     """Serialize [[str]] into a BIOM hdf5 compatible form
 
@@ -17,7 +17,9 @@ import h5py
 from cogent.util.option_parsing import parse_command_line_parameters, make_option
 from biom import load_table
 from biom.table import vlen_list_of_str_formatter
-from picrust.util import write_biom_table
+from os.path import exists
+from picrust.categorize_by_function import CategoryMembership
+from picrust.util import write_biom_table, make_output_dir_for_file
 
 script_info = {}
 script_info['brief_description'] = "Collapse table data to a specified level in a hierarchy."
@@ -26,6 +28,7 @@ script_info['script_usage'] = [\
 ("","Collapse predicted metagenome using KEGG Pathway metadata.","""%prog -i predicted_metagenomes.biom -c KEGG_Pathways -l 3 -o predicted_metagenomes.L3.biom"""),\
 ("","Change output to tab-delimited format (instead of BIOM).","""%prog -f -i predicted_metagenomes.biom -c KEGG_Pathways -l 3 -o predicted_metagenomes.L3.txt"""),\
 ("","Collapse COG Categories.","""%prog -i cog_predicted_metagenomes.biom -c COG_Category -l 2 -o cog_predicted_metagenomes.L2.biom"""),\
+("","Collapse predicted metagenome using KEGG Pathway metadata, caching the KO to pathway membership matrix of the reference the metagenome was predicted from. The first run writes the cache file, and later runs at the same level reuse it.","""%prog -i predicted_metagenomes.biom -c KEGG_Pathways -l 3 -m ko_13_5.KEGG_Pathways.L3.npz -o predicted_metagenomes.L3.biom"""),\
 ("","Collapse predicted metagenome using taxonomy metadata (not one-to-many).","""%prog -i observation_table.biom -c taxonomy -l 1 -o observation_table.L1.biom"""),\
 
 
@@ -39,43 +42,10 @@ script_info['required_options'] = [\
 ]
 script_info['optional_options'] = [
  make_option('--ignore',type='string',default=None, help="Ignore the comma separated list of names. For instance, specifying --ignore_unknown=unknown,unclassified will ignore those labels while collapsing. The default is to not ignore anything. [default: %default]"),
- make_option('-f','--format_tab_delimited',action="store_true",default=False,help='output the predicted metagenome table in tab-delimited format [default: %default]')]
+ make_option('-f','--format_tab_delimited',action="store_true",default=False,help='output the predicted metagenome table in tab-delimited format [default: %default]'),
+ make_option('-m','--membership_fp',type='string',default=None,help='cache file (.npz) for the sparse matrix of function to category membership at this level. If it exists and was built from the same function metadata as the table, it is loaded rather than rebuilt from the table metadata; otherwise it is built and written there. Use one file per reference release (e.g. ko_13_5), metadata category, level and --ignore value [default: %default]')]
 script_info['version'] = __version__
 
-def make_collapse_f(category, level, ignore):
-    """produce a collapsing function for one-to-many relationships"""
-    # adjust level such that, for instance, level 1 corresponds to index 0
-    if level > 0:
-        level -= 1
-
-    def collapse(id_, md):
-        if ignore is not None:
-            ignore_labels = set(ignore.split(','))
-        else:
-            ignore_labels = None
-
-        is_single_level = False
-
-        for path in md[category]:
-
-            # need to convert strings to lists (if needed) before checking
-            #if they are in the ignore list
-            if isinstance(path,basestring):
-                # If we have a list of strings, we want the whole thing (only)
-                path = md[category]
-                is_single_level = True
-
-            if ignore is not None and path[level].lower() in ignore_labels:
-                continue
-
-            yield (path[:(level+1)],path[level])
-
-            #If we only have one list of strings, we're done - bail.
-            if is_single_level:
-                break
-    return collapse
-
-
 def main():
     option_parser, opts, args =\
        parse_command_line_parameters(**script_info)
@@ -83,8 +53,6 @@ def main():
     if opts.level <= 0:
         option_parser.error("level must be greater than zero!")
 
-    collapse_f = make_collapse_f(opts.metadata_category, opts.level,
-                                 opts.ignore)
     table = load_table(opts.input_fp)
 
     if h5py.is_hdf5(opts.input_fp):
@@ -95,9 +63,31 @@ def main():
             update_d[i] = {k: json.loads(v[0]) for k, v in md.items()}
         table.add_metadata(update_d, axis='observation')
 
-    result = table.collapse(collapse_f, axis='observation', one_to_many=True,
-                            norm=False,
-                            one_to_many_md_key=opts.metadata_category)
+    membership = None
+    if opts.membership_fp and exists(opts.membership_fp):
+        membership = CategoryMembership.load(opts.membership_fp)
+        if not membership.matches(opts.metadata_category, opts.level,
+                                  opts.ignore):
+            option_parser.error("%s was built for metadata category %s at"
+                                " level %s (ignoring %s)" %
+                                (opts.membership_fp, membership.category,
+                                 membership.level, membership.ignore))
+        # a cache built from another reference (or another release of it)
+        # is rebuilt from this table's metadata and overwritten
+        if not membership.matches_table(table):
+            membership = None
+
+    if membership is None:
+        membership = CategoryMembership.from_table(table,
+                                                   opts.metadata_category,
+                                                   opts.level, opts.ignore)
+        if opts.membership_fp:
+            make_output_dir_for_file(opts.membership_fp)
+            membership.save(opts.membership_fp)
+
+    # a single sparse (categories x functions) by (functions x samples)
+    # product, rather than Table.collapse walking the functions one by one
+    result = membership.collapse(table)
 
     if(opts.format_tab_delimited):
         f = open(opts.output_fp, 'w')
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2011-2015, The PICRUSt Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.1.4"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+__status__ = "Development"
+
+
+from cogent.util.option_parsing import parse_command_line_parameters, make_option
+from biom import load_table
+from os.path import basename
+from sys import exit
+from picrust.binary_precalc import BINARY_PRECALC_DTYPES, binary_precalc_fp_for,\
+    convert_precalc_to_binary, load_binary_precalc_header, verify_binary_precalc,\
+    write_binary_precalc
+from picrust.precalc_index import DEFAULT_BLOCK_SIZE, index_precalc_file,\
+    precalc_index_fp
+from picrust.util import make_output_dir_for_file
+import gzip
+
+script_info = {}
+script_info['brief_description'] = "Convert a precalculated table to PICRUSt's fast binary format"
+script_info['script_description'] = "Converts a precalculated table (as downloaded by download_picrust_files.py) to a memory-mappable binary table that predict_metagenomes.py, metagenome_contributions.py and normalize_by_copy_number.py can load much faster. When the binary table is written next to the original file in the PICRUSt data directory it is used automatically in place of the original. The conversion only needs to be done once per precalculated file."
+script_info['script_usage'] = [
+("","Convert the KO precalculated file in place (writes ko_13_5_precalculated.npy and its index and metadata files next to the input):","%prog -i $PWD/picrust/data/ko_13_5_precalculated.tab.gz"),
+("","Convert a custom trait table in BIOM format:","%prog --load_precalc_file_in_biom -i custom_trait_table.biom -o custom_trait_table.npy"),
+("","Check a converted table against the checksum recorded at conversion time:","%prog --verify -i $PWD/picrust/data/ko_13_5_precalculated.npy"),
+("","Keep the KO precalculated file as .tab.gz, but recompress it in blocks and index it so that only the blocks holding the OTUs of interest are decompressed (writes ko_13_5_precalculated.tab.gz.idx):","%prog --index_gzip -i $PWD/picrust/data/ko_13_5_precalculated.tab.gz")
+]
+script_info['output_description']= "A binary precalculated table made of a .npy matrix file, a .ids.npy OTU id index and a .metadata.json metadata file. With --index_gzip, a block-compressed .tab.gz file and its .idx block index."
+script_info['required_options'] = [
+ make_option('-i','--input_precalc_fp',type='existing_filepath',help='the input precalculated table in tab-delimited or BIOM format (can be gzipped), or the binary table to check if --verify is passed'),
+]
+type_of_prediction_choices=['ko','cog','rfam','16S']
+gg_version_choices=['13_5','18may2012']
+script_info['optional_options'] = [
+ make_option('-o','--output_fp',type="new_filepath",default=None,help='the output .npy matrix file, or the output .tab.gz file with --index_gzip [default: the input filepath with its extension replaced by .npy, or the input filepath itself with --index_gzip]'),
+ make_option('-t','--type_of_prediction',default=None,type="choice",\
+                    choices=type_of_prediction_choices,\
+                    help='Type of functional predictions in the table, recorded in the output metadata. Valid choices are: '+\
+                    ', '.join(type_of_prediction_choices)+\
+                    ' [default: inferred from the input filename]'),
+ make_option('-g','--gg_version',default=None,type="choice",\
+                    choices=gg_version_choices,\
+                    help='Version of GreenGenes the table was calculated against, recorded in the output metadata. Valid choices are: '+\
+                    ', '.join(gg_version_choices)+\
+                    ' [default: inferred from the input filename]'),
+ make_option('--dtype',default=None,type="choice",\
+                    choices=BINARY_PRECALC_DTYPES,\
+                    help='Data type of the output matrix. Valid choices are: '+\
+                    ', '.join(BINARY_PRECALC_DTYPES)+\
+                    ' [default: uint16 if all values are whole numbers between 0 and 65535, otherwise float32]'),
+ make_option('--load_precalc_file_in_biom',default=False,action="store_true",help='Instead of loading the precalculated file in tab-delimited format (with otu ids as row ids and traits as columns) load the data in biom format (with otu as SampleIds and traits as ObservationIds) [default: %default]'),
+ make_option('--verify',default=False,action="store_true",help='Instead of converting, check that the binary table passed with -i matches the dtype, shape and checksum recorded when it was written [default: %default]'),
+ make_option('--index_gzip',default=False,action="store_true",help='Instead of converting to the binary format, recompress the tab-delimited table into independently gzipped blocks and write a block index (.idx) next to it. The result is still a valid .tab.gz file. The input is replaced unless -o is given [default: %default]'),
+ make_option('--block_size',default=DEFAULT_BLOCK_SIZE,type="int",help='Target uncompressed size in bytes of each block written with --index_gzip [default: %default]'),
+]
+script_info['version'] = __version__
+
+
+def infer_precalc_table_info(precalc_fp):
+    """Return (type_of_prediction, gg_version) from a precalc filename
+
+    e.g. ko_13_5_precalculated.tab.gz -> ('ko','13_5'). Unrecognized parts
+    are returned as None.
+    """
+    name = basename(precalc_fp).split('_precalculated')[0]
+    type_of_prediction = None
+    gg_version = None
+    for choice in type_of_prediction_choices:
+        if name.startswith(choice + '_'):
+            type_of_prediction = choice
+            name = name[len(choice)+1:]
+            break
+    if name in gg_version_choices:
+        gg_version = name
+    return type_of_prediction, gg_version
+
+
+def main():
+    option_parser, opts, args =\
+       parse_command_line_parameters(**script_info)
+
+    if opts.verify:
+        if opts.verbose:
+            print "Verifying binary precalculated table: ", opts.input_precalc_fp
+        problems = verify_binary_precalc(opts.input_precalc_fp)
+        if problems:
+            for problem in problems:
+                print "FAILED: %s" % problem
+            exit(1)
+        header = load_binary_precalc_header(opts.input_precalc_fp)
+        print "OK: %s (%s, %s, gg_version %s, %i OTUs x %i traits)" %\
+          (opts.input_precalc_fp,header['type_of_prediction'],header['dtype'],\
+          header['gg_version'],header['shape'][0],header['shape'][1])
+        return
+
+    if opts.index_gzip:
+        if opts.load_precalc_file_in_biom:
+            option_parser.error("Only tab-delimited tables can be indexed with --index_gzip")
+        if opts.output_fp:
+            make_output_dir_for_file(opts.output_fp)
+        if opts.verbose:
+            print "Recompressing and indexing %s" % opts.input_precalc_fp
+        num_blocks = index_precalc_file(opts.input_precalc_fp,opts.output_fp,\
+          block_size=opts.block_size)
+        if opts.verbose:
+            print "Wrote %i blocks of OTU rows, indexed in %s" %\
+              (num_blocks,precalc_index_fp(opts.output_fp or opts.input_precalc_fp))
+        return
+
+    output_fp = opts.output_fp
+    if output_fp is None:
+        output_fp = binary_precalc_fp_for(opts.input_precalc_fp)
+    if output_fp == opts.input_precalc_fp:
+        option_parser.error("Output filepath must differ from the input filepath")
+
+    type_of_prediction, gg_version = infer_precalc_table_info(opts.input_precalc_fp)
+    if opts.type_of_prediction:
+        type_of_prediction = opts.type_of_prediction
+    if opts.gg_version:
+        gg_version = opts.gg_version
+
+    make_output_dir_for_file(output_fp)
+    if opts.verbose:
+        print "Converting %s to binary precalculated table %s" %\
+          (opts.input_precalc_fp,output_fp)
+
+    if opts.load_precalc_file_in_biom:
+        header = write_binary_precalc(load_table(opts.input_precalc_fp),\
+          output_fp,dtype=opts.dtype,gg_version=gg_version,\
+          type_of_prediction=type_of_prediction)
+    else:
+        if opts.input_precalc_fp.endswith('.gz'):
+            precalc_fh = gzip.open(opts.input_precalc_fp,'rb')
+        else:
+            precalc_fh = open(opts.input_precalc_fp,'U')
+        header = convert_precalc_to_binary(precalc_fh,output_fp,\
+          dtype=opts.dtype,gg_version=gg_version,\
+          type_of_prediction=type_of_prediction)
+        precalc_fh.close()
+
+    if opts.verbose:
+        print "Wrote %i OTUs x %i traits as %s (sha256 %s)" %\
+          (header['shape'][0],header['shape'][1],header['dtype'],header['sha256'])
+
+
+if __name__ == "__main__":
+    main()
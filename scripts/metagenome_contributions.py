@@ -14,12 +14,14 @@ __status__ = "Development"
 
 from cogent.util.option_parsing import parse_command_line_parameters, make_option
 from biom import load_table
-from picrust.predict_metagenomes import predict_metagenomes, calc_nsti
-from picrust.metagenome_contributions import partition_metagenome_contributions
-from picrust.util import make_output_dir_for_file, get_picrust_project_dir, convert_precalc_to_biom
-from os import path
+from picrust.predict_metagenomes import predict_metagenomes, calc_nsti,\
+  determine_data_table_fp, load_data_table
+from picrust.metagenome_contributions import iter_gene_contributions,\
+  write_metagenome_contributions,filter_genome_table_by_function,\
+  write_metagenome_contributions_hdf5,write_metagenome_contributions_parallel
+from biom.util import HAVE_H5PY
+from picrust.util import make_output_dir_for_file, get_picrust_project_dir
 from os.path import join
-import gzip
 from sys import exit
 
 script_info = {}
@@ -27,14 +29,19 @@ script_info['brief_description'] = "This script partitions metagenome functional
 script_info['script_description'] = ""
 script_info['script_usage'] = [
 ("","Partition the predicted contribution to the  metagenomes from each organism in the given OTU table, limited to only K00001, K00002, and K00004.","%prog -i normalized_otus.biom -l K00001,K00002,K00004 -o ko_metagenome_contributions.tab"),
-("","Partition the predicted contribution to the  metagenomes from each organism in the given OTU table, limited to only COG0001 and COG0002.","%prog -i normalized_otus.biom -l COG0001,COG0002 -t cog -o cog_metagenome_contributions.tab")
+("","Partition the predicted contribution to the  metagenomes from each organism in the given OTU table, limited to only COG0001 and COG0002.","%prog -i normalized_otus.biom -l COG0001,COG0002 -t cog -o cog_metagenome_contributions.tab"),
+("","Partition the predicted contribution to K00001 and K00002, reporting only the 5 OTUs contributing most to each KO in each sample.","%prog -i normalized_otus.biom -l K00001,K00002 --top_k 5 -o ko_top_contributions.tab"),
+("","Partition the predicted contribution to all KOs, writing gzipped output.","%prog -i normalized_otus.biom -o ko_metagenome_contributions.tab.gz"),
+("","Partition the predicted contribution to all KOs using 16 processes.","%prog -i normalized_otus.biom --n_procs 16 -o ko_metagenome_contributions.tab"),
+("","Partition the predicted contribution to all KOs, writing a compact HDF5 file of integer-coded columns rather than text.","%prog -i normalized_otus.biom --output_format hdf5 -o ko_metagenome_contributions.h5")
 ]
-script_info['output_description']= "Output is a tab-delimited column indicating OTU contribution to each function."
+script_info['output_description']= "Output is a tab-delimited column indicating OTU contribution to each function. With --output_format hdf5, the same information is written as an HDF5 file: the contributions/ group holds one dataset per column, with genes, samples and OTUs stored as integer indices into the genes/ids, samples/ids and otus/ids datasets (OTU taxonomy is in otus/taxonomy). The contributions to gene i are rows genes/offsets[i] to genes/offsets[i+1]."
 script_info['required_options'] = [
  make_option('-i','--input_otu_table',type='existing_filepath',help='the input otu table in biom format'),
- make_option('-o','--output_fp',type="new_filepath",help='the output file for the metagenome contributions')
+ make_option('-o','--output_fp',type="new_filepath",help='the output file for the metagenome contributions. The output is gzipped if this ends in .gz')
 ]
 type_of_prediction_choices=['ko','cog','rfam']
+output_format_choices=['tab-delimited','hdf5']
 gg_version_choices=['13_5','18may2012']
 script_info['optional_options'] = [\
     make_option('-t','--type_of_prediction',default=type_of_prediction_choices[0],type="choice",\
@@ -48,11 +55,19 @@ script_info['optional_options'] = [\
                     ', '.join(gg_version_choices)+\
                     ' [default: %default]'),
 
-    make_option('-c','--input_count_table',default=None,type="existing_filepath",help='Precalculated function predictions on per otu basis in biom format (can be gzipped). Note: using this option overrides --type_of_prediction and --gg_version. [default: %default]'),
+    make_option('-c','--input_count_table',default=None,type="existing_filepath",help='Precalculated function predictions on per otu basis in biom format (can be gzipped), or a binary precalculated table (.npy). Note: using this option overrides --type_of_prediction and --gg_version. [default: %default]'),
  make_option('--suppress_subset_loading',default=False,action="store_true",help='Normally, only counts for OTUs present in the sample are loaded.  If this flag is passed, the full biom table is loaded.  This makes no difference for the analysis, but may result in faster load times (at the cost of more memory usage)'),
     make_option('--load_precalc_file_in_biom',default=False,action="store_true",help='Instead of loading the precalculated file in tab-delimited format (with otu ids as row ids and traits as columns) load the data in biom format (with otu as SampleIds and traits as ObservationIds) [default: %default]'),
     make_option('-f','--limit_to_functional_categories',default=False,action="store",type='string',help='If provided only output prediction for functions that match the specified functional category. Multiple categories can be passed as a list separated by | [default: %default]'),
-        make_option('-l','--limit_to_function',default=None,help='If provided, only output predictions for the specified function ids.  Multiple function ids can be passed using comma delimiters.')
+        make_option('-l','--limit_to_function',default=None,help='If provided, only output predictions for the specified function ids.  Multiple function ids can be passed using comma delimiters.'),
+    make_option('--top_k',default=None,type="int",help='If provided, only output the K OTUs contributing most to each function in each sample [default: output all contributing OTUs]'),
+    make_option('--min_percent',default=None,type="float",help='If provided, only output OTUs contributing at least this percentage (0-100) of the counts of a function in a sample. Note that the ContributionPercentOfSample column of the output is a fraction (0-1), and is still relative to all contributing OTUs [default: output all contributing OTUs]'),
+    make_option('--n_procs',default=1,type="int",help='Number of processes to split the functions across. Each process writes the contributions to its share of the functions to a temporary partition file, and these are concatenated into the output file. Only tab-delimited output is supported [default: %default]'),
+    make_option('--output_format',default=output_format_choices[0],type="choice",\
+                    choices=output_format_choices,\
+                    help='Format of the output file. Valid choices are: '+\
+                    ', '.join(output_format_choices)+\
+                    '. hdf5 requires h5py [default: %default]')
 ]
 script_info['version'] = __version__
 
@@ -62,6 +77,19 @@ def main():
        parse_command_line_parameters(**script_info)
 
 
+    if opts.output_format == 'hdf5' and not HAVE_H5PY:
+        option_parser.error("h5py must be installed to write hdf5 output")
+
+    if opts.n_procs < 1:
+        option_parser.error("--n_procs must be at least 1")
+    if opts.n_procs > 1 and opts.output_format != 'tab-delimited':
+        option_parser.error("--n_procs is only supported for tab-delimited output")
+
+    if opts.top_k is not None and opts.top_k < 1:
+        option_parser.error("--top_k must be at least 1")
+    if opts.min_percent is not None and not 0 <= opts.min_percent <= 100:
+        option_parser.error("--min_percent must be between 0 and 100")
+
     if opts.limit_to_function:
         limit_to_functions = opts.limit_to_function.split(',')
         if opts.verbose:
@@ -75,46 +103,24 @@ def main():
     otu_table = load_table(opts.input_otu_table)
     ids_to_load = otu_table.ids(axis='observation')
 
-    if(opts.input_count_table is None):
-        #precalc file has specific name (e.g. ko_13_5_precalculated.tab.gz)
-        precalc_file_name='_'.join([opts.type_of_prediction,opts.gg_version,'precalculated.tab.gz'])
-        input_count_table=join(get_picrust_project_dir(),'picrust','data',precalc_file_name)
-    else:
-        input_count_table=opts.input_count_table
-
-    if opts.verbose:
-        print "Loading trait table: ", input_count_table
+    #Hardcoded loaction of the precalculated datasets for PICRUSt,
+    #relative to the project directory
+    precalc_data_dir=join(get_picrust_project_dir(),'picrust','data')
 
-    ext=path.splitext(input_count_table)[1]
+    #precalc file has specific name (e.g. ko_13_5_precalculated.tab.gz)
+    input_count_table = determine_data_table_fp(precalc_data_dir,\
+      opts.type_of_prediction,opts.gg_version,\
+      user_specified_table=opts.input_count_table,verbose=opts.verbose)
 
     if opts.verbose:
         print "Loading count table: ", input_count_table
 
-    if (ext == '.gz'):
-        genome_table_fh = gzip.open(input_count_table,'rb')
-    else:
-        genome_table_fh = open(input_count_table,'U')
-
     #In the genome/trait table genomes are the samples and
     #genes are the observations
-
-
-    if opts.load_precalc_file_in_biom:
-        if not opts.suppress_subset_loading:
-            #Now we want to use the OTU table information
-            #to load only rows in the count table corresponding
-            #to relevant OTUs
-
-            if opts.verbose:
-                print "Loading traits for %i organisms from the trait table" %len(ids_to_load)
-
-            genome_table = load_subset_from_biom_str(genome_table_fh.read(),ids_to_load,axis='samples')
-        else:
-            if opts.verbose:
-                print "Loading *full* count table because --suppress_subset_loading was passed. This may result in high memory usage"
-            genome_table = load_table(genome_table_fh)
-    else:
-        genome_table = convert_precalc_to_biom(genome_table_fh,ids_to_load)
+    genome_table = load_data_table(input_count_table,\
+      load_data_table_in_biom=opts.load_precalc_file_in_biom,\
+      suppress_subset_loading=opts.suppress_subset_loading,\
+      ids_to_load=ids_to_load,verbose=opts.verbose,transpose=True)
     ok_functional_categories = None
 
     metadata_type = None
@@ -135,15 +141,31 @@ def main():
         elif opts.type_of_prediction == "rfam":
             exit("Stopping program: when type of prediction is set to rfam you can only limit to individual functions (-l) rather than to functional categories (-f)")
               
-    partitioned_metagenomes = partition_metagenome_contributions(otu_table,genome_table,limit_to_functions=limit_to_functions,\
-      limit_to_functional_categories = ok_functional_categories ,  metadata_key = metadata_type )
+    genome_table = filter_genome_table_by_function(genome_table,\
+      limit_to_functions=limit_to_functions,\
+      limit_to_functional_categories=ok_functional_categories,\
+      metadata_key=metadata_type,verbose=opts.verbose)
 
-    output_text = "\n".join(["\t".join(map(str,i)) for i in partitioned_metagenomes])
     if opts.verbose:
         print "Writing results to output file: ",opts.output_fp
 
     make_output_dir_for_file(opts.output_fp)
-    open(opts.output_fp,'w').write(output_text)
+    if opts.output_format == 'hdf5':
+        n_rows = write_metagenome_contributions_hdf5(otu_table,genome_table,\
+          opts.output_fp,top_k=opts.top_k,min_percent=opts.min_percent)
+    elif opts.n_procs > 1:
+        n_rows = write_metagenome_contributions_parallel(otu_table,\
+          genome_table,opts.output_fp,opts.n_procs,top_k=opts.top_k,\
+          min_percent=opts.min_percent)
+    else:
+        #Rows are generated and written one function at a time, so the
+        #(potentially huge) output is never held in memory
+        partitioned_metagenomes = iter_gene_contributions(otu_table,\
+          genome_table,top_k=opts.top_k,min_percent=opts.min_percent)
+        n_rows = write_metagenome_contributions(partitioned_metagenomes,opts.output_fp)
+
+    if opts.verbose:
+        print "Wrote %i contribution rows" %n_rows
 
 if __name__ == "__main__":
     main()
@@ -13,12 +13,11 @@ __status__ = "Development"
 
 
 from cogent.util.option_parsing import parse_command_line_parameters, make_option
-from biom import load_table, Table
-from picrust.predict_metagenomes import transfer_observation_metadata
-from os import path
+from biom import load_table
+from picrust.predict_metagenomes import determine_data_table_fp, load_data_table
+from picrust.normalize_by_copy_number import normalize_by_copy_number
 from os.path import join
-from picrust.util import get_picrust_project_dir, convert_precalc_to_biom,make_output_dir_for_file, write_biom_table
-import gzip
+from picrust.util import get_picrust_project_dir, make_output_dir_for_file, write_biom_table
 
 script_info = {}
 script_info['brief_description'] = "Normalize an OTU table by marker gene copy number"
@@ -41,7 +40,7 @@ script_info['optional_options'] = [
                     ' [default: %default]'),
 
     make_option('-c','--input_count_fp',default=None,type="existing_filepath",\
-                    help='Precalculated input marker gene copy number predictions on per otu basis in biom format (can be gzipped).Note: using this option overrides --gg_version. [default: %default]'),
+                    help='Precalculated input marker gene copy number predictions on per otu basis in biom format (can be gzipped), or a binary precalculated table (.npy).Note: using this option overrides --gg_version. [default: %default]'),
     make_option('--metadata_identifer',
              default='CopyNumber',
              help='identifier for copy number entry as observation metadata [default: %default]'),
@@ -61,67 +60,25 @@ def main():
 
     ids_to_load = otu_table.ids(axis='observation')
 
-    if(opts.input_count_fp is None):
-        #precalc file has specific name (e.g. 16S_13_5_precalculated.tab.gz)
-        precalc_file_name='_'.join(['16S',opts.gg_version,'precalculated.tab.gz'])
-        input_count_table=join(get_picrust_project_dir(),'picrust','data',precalc_file_name)
-    else:
-        input_count_table=opts.input_count_fp
+    #precalc file has specific name (e.g. 16S_13_5_precalculated.tab.gz)
+    precalc_data_dir=join(get_picrust_project_dir(),'picrust','data')
+    input_count_table = determine_data_table_fp(precalc_data_dir,'16S',\
+      opts.gg_version,user_specified_table=opts.input_count_fp,\
+      verbose=opts.verbose)
 
     if opts.verbose:
         print "Loading trait table: ", input_count_table
 
-    ext=path.splitext(input_count_table)[1]
+    #BIOM format count tables are loaded in full
+    count_table = load_data_table(input_count_table,\
+      load_data_table_in_biom=opts.load_precalc_file_in_biom,\
+      suppress_subset_loading=opts.load_precalc_file_in_biom,\
+      ids_to_load=ids_to_load,verbose=opts.verbose,transpose=True)
 
-    if (ext == '.gz'):
-        count_table_fh = gzip.open(input_count_table,'rb')
-    else:
-        count_table_fh = open(input_count_table,'U')
-
-    if opts.load_precalc_file_in_biom:
-        count_table = load_table(count_table_fh)
-    else:
-        count_table = convert_precalc_to_biom(count_table_fh, ids_to_load)
-
-    #Need to only keep data relevant to our otu list
-    ids=[]
-    for x in otu_table.iter(axis='observation'):
-        ids.append(str(x[1]))
-
-    ob_id=count_table.ids(axis='observation')[0]
-
-    filtered_otus=[]
-    filtered_values=[]
-    for x in ids:
-        if count_table.exists(x, axis='sample'):
-            filtered_otus.append(x)
-            filtered_values.append(otu_table.data(x, axis='observation'))
-
-    filtered_otu_table = Table(filtered_values, filtered_otus, otu_table.ids())
-
-    copy_numbers_filtered={}
-    for x in filtered_otus:
-        value = count_table.get_value_by_ids(ob_id,x)
-        try:
-            #data can be floats so round them and make them integers
-            value = int(round(float(value)))
-
-        except ValueError:
-            raise ValueError,\
-                  "Invalid type passed as copy number for OTU ID %s. Must be int-able." % (value)
-        if value < 1:
-            raise ValueError, "Copy numbers must be greater than or equal to 1."
-
-        copy_numbers_filtered[x]={opts.metadata_identifer:value}
-
-    filtered_otu_table.add_metadata(copy_numbers_filtered, axis='observation')
-
-    def metadata_norm(v, i, md):
-        return v / float(md[opts.metadata_identifer])
-    normalized_table = filtered_otu_table.transform(metadata_norm, axis='observation')
-
-    #move Observation Metadata from original to filtered OTU table
-    normalized_table = transfer_observation_metadata(otu_table, normalized_table, 'observation')
+    #OTUs are aligned to their copy numbers once, and the counts divided
+    #by them in a single sparse operation
+    normalized_table = normalize_by_copy_number(otu_table,count_table,\
+      metadata_identifier=opts.metadata_identifer)
 
     make_output_dir_for_file(opts.output_otu_fp)
     write_biom_table(normalized_table, opts.output_otu_fp)
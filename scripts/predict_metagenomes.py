@@ -14,14 +14,15 @@ __status__ = "Development"
 
 from cogent.util.option_parsing import parse_command_line_parameters, make_option
 from biom import load_table
+from biom.util import HAVE_H5PY
 from picrust.predict_metagenomes import predict_metagenomes,predict_metagenome_variances,\
-  calc_nsti,load_subset_from_biom_str
-from picrust.util import make_output_dir_for_file,write_biom_table, convert_precalc_to_biom
-from os import path
+  calc_nsti,determine_data_table_fp,load_data_table,union_otu_ids,\
+  predict_metagenomes_parallel,predict_metagenomes_multi
+from picrust.util import make_output_dir_for_file,write_biom_table
+from picrust.chunked_output import iter_sample_chunks,ChunkedTableWriter
 from os.path import split,join,splitext
 from picrust.util import get_picrust_project_dir, scale_metagenomes, \
     picrust_formatter
-import gzip
 import re
 
 script_info = {}
@@ -36,28 +37,31 @@ script_info['script_usage'] = [
                                ("","Output confidence intervals for each prediction.","%prog -i normalized_otus.biom -o predicted_metagenomes.biom --with_confidence"),\
                                ("","Predict metagenomes using a custom trait table in tab-delimited format.","%prog -i otu_table_for_custom_trait_table.biom -c custom_trait_table.tab -o output_metagenome_from_custom_trait_table.biom"),\
                                ("","Predict metagenomes,variances,and 95% confidence intervals for each gene category using a custom trait table in tab-delimited format.","%prog -i otu_table_for_custom_trait_table.biom --input_variance_table custom_trait_table_variances.tab -c custom_trait_table.tab -o output_metagenome_from_custom_trait_table.biom --with_confidence"),\
-                               ("","Change the version of GG used to pick OTUs","%prog -i normalized_otus.biom -g 18may2012 -o predicted_metagenomes.biom")
+                               ("","Change the version of GG used to pick OTUs","%prog -i normalized_otus.biom -g 18may2012 -o predicted_metagenomes.biom"),\
+                               ("","Predict KO abundances for each OTU table listed in a manifest file, loading the KO precalculated table only once. Each line of otu_tables.txt holds an input OTU table and output metagenome filepath separated by a tab.","%prog -m otu_tables.txt"),\
+                               ("","Predict KO, COG and RFAM abundances from a single pass over the OTU table. The outputs are named after -o with the type of prediction appended (here predicted_metagenomes_ko.biom, predicted_metagenomes_cog.biom and predicted_metagenomes_rfam.biom).","%prog -i normalized_otus.biom -t ko,cog,rfam -o predicted_metagenomes.biom"),\
+                               ("","Predict KO abundances using 8 processes.","%prog -i normalized_otus.biom -o predicted_metagenomes.biom --n_procs 8"),\
+                               ("","Predict KO abundances for an OTU table with a very large number of samples, 1000 samples at a time, to limit memory usage.","%prog -i normalized_otus.biom -o predicted_metagenomes.biom --chunk_samples 1000")
                                 ]
 script_info['output_description']= "Output is a table of function counts (e.g. KEGG KOs) by sample ids."
-script_info['required_options'] = [
- make_option('-i','--input_otu_table',type='existing_filepath',help='the input otu table in biom format'),
- make_option('-o','--output_metagenome_table',type="new_filepath",help='the output file for the predicted metagenome')
-]
+script_info['required_options'] = []
 type_of_prediction_choices=['ko','cog','rfam']
 gg_version_choices=['13_5','18may2012']
 script_info['optional_options'] = [\
-    make_option('-t','--type_of_prediction',default=type_of_prediction_choices[0],type="choice",\
-                    choices=type_of_prediction_choices,\
+    make_option('-i','--input_otu_table',type='existing_filepath',help='the input otu table in biom format (required unless --otu_table_manifest is passed)'),
+    make_option('-o','--output_metagenome_table',type="new_filepath",help='the output file for the predicted metagenome (required unless --otu_table_manifest is passed)'),
+    make_option('-m','--otu_table_manifest',default=None,type="existing_filepath",help='Predict metagenomes for many OTU tables, loading the precalculated tables only once (with only the OTUs found in any of the OTU tables). Each line of this tab-delimited file gives an input otu table and its output metagenome file, as would be passed with -i and -o. Lines starting with # are ignored. Note: this option cannot be used together with -i and -o. [default: %default]'),
+    make_option('-t','--type_of_prediction',default=type_of_prediction_choices[0],type="string",\
                     help='Type of functional predictions. Valid choices are: '+\
                     ', '.join(type_of_prediction_choices)+\
-                    ' [default: %default]'),
+                    '. Several types can be passed separated by commas (e.g. ko,cog,rfam) to predict them all from one loaded OTU table, with the predictions for each type made in parallel threads. Each output is then named after the output filepath with _<type> appended before the file extension. [default: %default]'),
     make_option('-g','--gg_version',default=gg_version_choices[0],type="choice",\
                     choices=gg_version_choices,\
                     help='Version of GreenGenes that was used for OTU picking. Valid choices are: '+\
                     ', '.join(gg_version_choices)+\
                     ' [default: %default]'),
 
-    make_option('-c','--input_count_table',default=None,type="existing_filepath",help='Precalculated function predictions on per otu basis in biom format (can be gzipped). Note: using this option overrides --type_of_prediction and --gg_version. [default: %default]'),
+    make_option('-c','--input_count_table',default=None,type="existing_filepath",help='Precalculated function predictions on per otu basis in biom format (can be gzipped), or a binary precalculated table (.npy). Note: using this option overrides --type_of_prediction and --gg_version. [default: %default]'),
     make_option('-a','--accuracy_metrics',default=None,type="new_filepath",help='If provided, calculate accuracy metrics for the predicted metagenome.  NOTE: requires that per-genome accuracy metrics were calculated using predict_traits.py during genome prediction (e.g. there are "NSTI" values in the genome .biom file metadata)'),
     make_option('--no_round',default=False,action="store_true",help='Disable rounding number of predicted functions to the the nearest whole number. This option is important if you are inputting abundances as proportions [default: %default]'),
     make_option('--normalize_by_function',default=False,action="store_true",help='Normalizes the predicted functional abundances by dividing each abundance by the sum of functional abundances in the sample. Total sum of abundances for each sample will equal 1.'),
@@ -66,94 +70,78 @@ script_info['optional_options'] = [\
     make_option('--load_precalc_file_in_biom',default=False,action="store_true",help='Instead of loading the precalculated file in tab-delimited format (with otu ids as row ids and traits as columns) load the data in biom format (with otu as SampleIds and traits as ObservationIds) [default: %default]'),
     make_option('--input_variance_table',default=None,type="existing_filepath",help='Precalculated table of variances corresponding to the precalculated table of function predictions.  As with the count table, these are on a per otu basis and in BIOM format (can be gzipped). Note: using this option overrides --type_of_prediction and --gg_version. [default: %default]'),
     make_option('--with_confidence',default=False,action="store_true",help='Calculate 95% confidence intervals for metagenome predictions.  By default, this uses the confidence intervals for the precalculated table of genes for greengenes OTUs.  If you pass a custom count table with -c and select this option, you must also specify a corresponding table of confidence intervals for the gene content prediction using --input_variance_table. (these are generated by running predict_traits.py with the --with_confidence option). If this flag is set, three addtional output files will be generated, named the same as the metagenome prediction output, but with .variance .upper_CI or .lower_CI appended immediately before the file extension [default: %default]'),
-    make_option('-f','--format_tab_delimited',action="store_true",default=False,help='output the predicted metagenome table in tab-delimited format [default: %default]')]
+    make_option('-f','--format_tab_delimited',action="store_true",default=False,help='output the predicted metagenome table in tab-delimited format [default: %default]'),
+    make_option('--n_procs',default=1,type="int",help='Number of processes to split the samples of each OTU table across when predicting metagenomes. The precalculated tables are loaded once and shared by all processes. [default: %default]'),
+    make_option('--chunk_samples',default=None,type="int",help='Predict the metagenomes of this many samples at a time, writing each set of predictions to disk before moving on to the next. This bounds memory usage by the number of samples per chunk rather than by the total number of samples. The output files are identical to those written without this option. [default: predict all samples at once]')]
 script_info['version'] = __version__
 
-
-def determine_data_table_fp(precalc_data_dir,type_of_prediction,gg_version,\
-      user_specified_table=None,precalc_file_suffix='precalculated.tab.gz',verbose=False):
-    """Determine data table to load, allowing custom user tables or a choice of precalculated files
-
-    precalc_data_dir -- the directory where precalculated tables of gene counts and variances are stored
-    type_of_prediction -- a string describing the type of precalculated prediction file.
-    gg_version -- the version of greengenes the precalculated prediction was generated against
-
-    This function assumes that precalculated files are named based on the type of prediction,
-    (KO, COG, PFAM, etc) and the greengenes version, and then end with a set suffix, which might
-    vary between count tables and variance tables.
-    """
-
-    if(user_specified_table is None):
-        #We assume the precalc file has a specific name (e.g. ko_13_5_precalculated.tab.gz)
-        precalc_file_name='_'.join([type_of_prediction,gg_version,\
-          precalc_file_suffix])
-
-        input_count_table=join(precalc_data_dir,precalc_file_name)
-    else:
-        input_count_table=user_specified_table
-
-    if verbose:
-        print "Selected data table for loading: ", input_count_table
-    return input_count_table
-
-
-def load_data_table(data_table_fp,\
-  load_data_table_in_biom=False,suppress_subset_loading=False,ids_to_load=None,\
-  transpose=False,verbose=False):
-    """Load a data table, detecting gziiped files and subset loading
-    data_table_fp -- path to the input data table
-
-    load_data_table_in_biom -- if True, load the data table as a BIOM table rather
-    than as tab-delimited
-
-    suppress_subset_loading -- if True, load the entire table, rather than just
-    ids_of_interest
-
-    ids_to_load -- a list of OTU ids for which data should be loaded
-
-    gzipped files are detected based on the '.gz' suffix.
-    """
-    if not path.exists(data_table_fp):
-        raise IOError("File "+data_table_fp+" doesn't exist! Did you forget to download it?")
-
-    ext=path.splitext(data_table_fp)[1]
-    if (ext == '.gz'):
-        genome_table_fh = gzip.open(data_table_fp,'rb')
-    else:
-        genome_table_fh = open(data_table_fp,'U')
-
-    if load_data_table_in_biom:
-        if not suppress_subset_loading:
-            #Now we want to use the OTU table information
-            #to load only rows in the count table corresponding
-            #to relevant OTUs
-
-            if verbose:
-                print "Loading traits for %i organisms from the trait table" %len(ids_to_load)
-
-            genome_table = load_subset_from_biom_str(genome_table_fh.read(),ids_to_load,axis='samples')
-        else:
-            if verbose:
-                print "Loading *full* count table because --suppress_subset_loading was passed. This may result in high memory usage"
-            genome_table = load_table(data_table_fp)
-    else:
-        genome_table = convert_precalc_to_biom(genome_table_fh,ids_to_load,transpose=transpose)
-
-    if verbose:
-        print "Done loading trait table containing %i functions for %i organisms." %(len(genome_table.ids(axis='observation')),len(genome_table.ids()))
-
-    return genome_table
+#formatters for observation metadata written to BIOM (HDF5) output
+BIOM_FORMAT_FS = {'KEGG_Description': picrust_formatter,
+                  'COG_Description': picrust_formatter,
+                  'KEGG_Pathways': picrust_formatter,
+                  'COG_Category': picrust_formatter
+                  }
 
 
 def main():
     option_parser, opts, args =\
        parse_command_line_parameters(**script_info)
 
-    if opts.verbose:
-        print "Loading OTU table: ",opts.input_otu_table
-
-    otu_table = load_table(opts.input_otu_table)
-    ids_to_load = otu_table.ids(axis='observation').tolist()
+    if opts.otu_table_manifest:
+        if opts.input_otu_table or opts.output_metagenome_table:
+            option_parser.error("-i and -o cannot be used with --otu_table_manifest")
+        otu_table_fps = parse_otu_table_manifest(open(opts.otu_table_manifest,'U'))
+        if not otu_table_fps:
+            option_parser.error("No OTU tables listed in %s" %opts.otu_table_manifest)
+    elif opts.input_otu_table and opts.output_metagenome_table:
+        otu_table_fps = [(opts.input_otu_table,opts.output_metagenome_table)]
+    else:
+        option_parser.error("Both -i and -o, or --otu_table_manifest, must be passed")
+
+    if opts.n_procs < 1:
+        option_parser.error("--n_procs must be at least 1")
+
+    types_of_prediction = opts.type_of_prediction.split(',')
+    for type_of_prediction in types_of_prediction:
+        if type_of_prediction not in type_of_prediction_choices:
+            option_parser.error("Invalid type of prediction: %s. Valid choices are: %s"\
+              %(type_of_prediction,', '.join(type_of_prediction_choices)))
+    if len(set(types_of_prediction)) != len(types_of_prediction):
+        option_parser.error("Each type of prediction can only be passed once")
+    if len(types_of_prediction) > 1:
+        for option_name,option_value in [('-c',opts.input_count_table),\
+          ('--input_variance_table',opts.input_variance_table),\
+          ('--with_confidence',opts.with_confidence),\
+          ('--chunk_samples',opts.chunk_samples),\
+          ('--n_procs',opts.n_procs > 1)]:
+            if option_value:
+                option_parser.error("%s cannot be used with more than one type of prediction" %option_name)
+
+    if opts.chunk_samples:
+        if opts.chunk_samples < 1:
+            option_parser.error("--chunk_samples must be at least 1")
+        if not (opts.format_tab_delimited or HAVE_H5PY):
+            option_parser.error("--chunk_samples requires h5py to write BIOM"
+              " output. Install h5py or pass -f for tab-delimited output.")
+
+    if len(otu_table_fps) == 1:
+        if opts.verbose:
+            print "Loading OTU table: ",otu_table_fps[0][0]
+        otu_tables = [load_table(otu_table_fps[0][0])]
+        ids_to_load = otu_tables[0].ids(axis='observation').tolist()
+        if opts.verbose:
+            print "Done loading OTU table containing %i samples and %i OTUs." \
+              %(len(otu_tables[0].ids()),len(otu_tables[0].ids(axis='observation')))
+    else:
+        #Only the OTU ids are needed up front. Tables are loaded again one
+        #at a time for prediction so they do not all have to fit in memory.
+        if opts.verbose:
+            print "Collecting OTU ids from %i OTU tables" %len(otu_table_fps)
+        otu_tables = None
+        ids_to_load = union_otu_ids(load_table(otu_table_fp)\
+          for otu_table_fp,output_fp in otu_table_fps)
+        if opts.verbose:
+            print "Found %i distinct OTUs" %len(ids_to_load)
 
     # Determine whether user wants predictions round to nearest whole
     # number or not.
@@ -162,38 +150,39 @@ def main():
     else:
         round_flag = True
 
-    if opts.verbose:
-        print "Done loading OTU table containing %i samples and %i OTUs." \
-          %(len(otu_table.ids()),len(otu_table.ids(axis='observation')))
-
     #Hardcoded loaction of the precalculated datasets for PICRUSt,
     #relative to the project directory
     precalc_data_dir=join(get_picrust_project_dir(),'picrust','data')
 
-    # Load a table of gene counts by OTUs.
+    # Load a table of gene counts by OTUs for each type of prediction.
     #This can be either user-specified or precalculated
-    genome_table_fp = determine_data_table_fp(precalc_data_dir,\
-      opts.type_of_prediction,opts.gg_version,\
-      user_specified_table=opts.input_count_table,verbose=opts.verbose)
+    genome_tables = []
+    for type_of_prediction in types_of_prediction:
+        genome_table_fp = determine_data_table_fp(precalc_data_dir,\
+          type_of_prediction,opts.gg_version,\
+          user_specified_table=opts.input_count_table,verbose=opts.verbose)
 
-    if opts.verbose:
-        print "Loading gene count data from file: %s" %genome_table_fp
+        if opts.verbose:
+            print "Loading gene count data from file: %s" %genome_table_fp
 
-    genome_table= load_data_table(genome_table_fp,\
-      load_data_table_in_biom=opts.load_precalc_file_in_biom,\
-      suppress_subset_loading=opts.suppress_subset_loading,\
-      ids_to_load=ids_to_load,verbose=opts.verbose,transpose=True)
+        genome_table= load_data_table(genome_table_fp,\
+          load_data_table_in_biom=opts.load_precalc_file_in_biom,\
+          suppress_subset_loading=opts.suppress_subset_loading,\
+          ids_to_load=ids_to_load,verbose=opts.verbose,transpose=True)
 
-    if opts.verbose:
-        print "Loaded %i genes across %i OTUs from gene count table" \
-          %(len(genome_table.ids(axis='observation')),len(genome_table.ids()))
+        if opts.verbose:
+            print "Loaded %i genes across %i OTUs from gene count table" \
+              %(len(genome_table.ids(axis='observation')),len(genome_table.ids()))
+        genome_tables.append(genome_table)
+    genome_table = genome_tables[0]
 
+    variance_table = None
     if opts.with_confidence:
         if opts.input_variance_table:
             variance_table_fp = opts.input_variance_table
         else:
             variance_table_fp = determine_data_table_fp(precalc_data_dir,\
-              opts.type_of_prediction,opts.gg_version,\
+              types_of_prediction[0],opts.gg_version,\
               precalc_file_suffix='precalculated_variances.tab.gz',\
               user_specified_table=opts.input_count_table)
 
@@ -233,22 +222,84 @@ def main():
         variance_table=variance_table.sort_order(genome_table.ids(axis='observation'), axis='observation')
         variance_table=variance_table.sort_order(genome_table.ids(), axis='sample')
 
-    make_output_dir_for_file(opts.output_metagenome_table)
-
     if opts.accuracy_metrics:
-        # Calculate accuracy metrics
-        weighted_nsti = calc_nsti(otu_table,genome_table,weighted=True)
-        samples= weighted_nsti[0]
-        nstis = list(weighted_nsti[1])
-        samples_and_nstis = zip(samples,nstis)
         if opts.verbose:
             print "Writing NSTI information to file:", opts.accuracy_metrics
+        make_output_dir_for_file(opts.accuracy_metrics)
         accuracy_output_fh = open(opts.accuracy_metrics,'w')
         accuracy_output_fh.write("#Sample\tMetric\tValue\n")
-        for sample,nsti in samples_and_nstis:
-            line = "%s\tWeighted NSTI\t%s\n" %(sample,str(nsti))
-            accuracy_output_fh.write(line)
 
+    for i,(otu_table_fp,output_fp) in enumerate(otu_table_fps):
+        if otu_tables:
+            otu_table = otu_tables[i]
+        else:
+            if opts.verbose:
+                print "Loading OTU table: ",otu_table_fp
+            otu_table = load_table(otu_table_fp)
+
+        make_output_dir_for_file(output_fp)
+
+        if opts.accuracy_metrics:
+            # Calculate accuracy metrics
+            weighted_nsti = calc_nsti(otu_table,genome_table,weighted=True)
+            samples= weighted_nsti[0]
+            nstis = list(weighted_nsti[1])
+            samples_and_nstis = zip(samples,nstis)
+            for sample,nsti in samples_and_nstis:
+                line = "%s\tWeighted NSTI\t%s\n" %(sample,str(nsti))
+                accuracy_output_fh.write(line)
+
+        if len(genome_tables) > 1:
+            if opts.verbose:
+                print "Predicting the metagenome for %s..." %', '.join(types_of_prediction)
+            predictions = predict_metagenomes_multi(otu_table,genome_tables,\
+              verbose=opts.verbose,whole_round=round_flag)
+            for type_of_prediction,prediction in zip(types_of_prediction,predictions):
+                write_metagenome_to_file(\
+                  normalize_predictions(prediction,otu_table,opts),\
+                  prediction_output_fp_for_type(output_fp,type_of_prediction),\
+                  opts.format_tab_delimited,\
+                  "%s metagenome prediction" %type_of_prediction,\
+                  verbose=opts.verbose)
+            continue
+
+        if opts.chunk_samples:
+            write_predictions_in_chunks(otu_table,genome_table,variance_table,\
+              output_fp,opts,round_flag)
+            continue
+
+        predictions = predict_and_normalize(otu_table,genome_table,\
+          variance_table,opts,round_flag)
+        for (description,prediction_fp),prediction in\
+          zip(prediction_output_fps(output_fp,opts.with_confidence),predictions):
+            write_metagenome_to_file(prediction,prediction_fp,\
+              opts.format_tab_delimited,description,verbose=opts.verbose)
+
+    if opts.accuracy_metrics:
+        accuracy_output_fh.close()
+
+
+def parse_otu_table_manifest(lines):
+    """Return [(input otu table fp, output metagenome fp)] from manifest lines"""
+    result = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        if len(fields) != 2:
+            raise ValueError("Manifest lines must contain an input OTU table"
+              " and an output filepath separated by a tab: %s" %line)
+        result.append((fields[0].strip(),fields[1].strip()))
+    return result
+
+
+def predict_and_normalize(otu_table,genome_table,variance_table,opts,\
+    round_flag):
+    """Return the predicted metagenome, and variance and CI tables if requested
+
+    The tables are returned as a list in the order of prediction_output_fps.
+    """
     if opts.with_confidence:
         #If we are calculating variance, we get the prediction as part
         #of the process
@@ -256,16 +307,39 @@ def main():
         if opts.verbose:
             print "Predicting the metagenome, metagenome variance and confidence intervals for the metagenome..."
 
-        predicted_metagenomes,predicted_metagenome_variances,\
-        predicted_metagenomes_lower_CI_95,predicted_metagenomes_upper_CI_95=\
-          predict_metagenome_variances(otu_table,genome_table,variance_table,whole_round=round_flag)
+        if opts.n_procs > 1:
+            predicted_metagenomes,predicted_metagenome_variances,\
+            predicted_metagenomes_lower_CI_95,predicted_metagenomes_upper_CI_95=\
+              predict_metagenomes_parallel(otu_table,genome_table,opts.n_procs,\
+              gene_variances=variance_table,verbose=opts.verbose,\
+              whole_round=round_flag)
+        else:
+            predicted_metagenomes,predicted_metagenome_variances,\
+            predicted_metagenomes_lower_CI_95,predicted_metagenomes_upper_CI_95=\
+              predict_metagenome_variances(otu_table,genome_table,variance_table,whole_round=round_flag)
     else:
         #If we don't need confidence intervals, we can do a faster pure numpy prediction
 
         if opts.verbose:
             print "Predicting the metagenome..."
-        predicted_metagenomes = predict_metagenomes(otu_table,genome_table,whole_round=round_flag)
+        if opts.n_procs > 1:
+            predicted_metagenomes = predict_metagenomes_parallel(otu_table,\
+              genome_table,opts.n_procs,verbose=opts.verbose,\
+              whole_round=round_flag)
+        else:
+            predicted_metagenomes = predict_metagenomes(otu_table,genome_table,whole_round=round_flag)
+
+    predicted_metagenomes = normalize_predictions(predicted_metagenomes,\
+      otu_table,opts)
 
+    if opts.with_confidence:
+        return [predicted_metagenomes,predicted_metagenome_variances,\
+          predicted_metagenomes_upper_CI_95,predicted_metagenomes_lower_CI_95]
+    return [predicted_metagenomes]
+
+
+def normalize_predictions(predicted_metagenomes,otu_table,opts):
+    """Return the predicted metagenome normalized as requested in opts"""
     if opts.normalize_by_otu:
         #normalize (e.g. divide) the abundances by the sum of the OTUs per sample
         if opts.verbose:
@@ -281,33 +355,67 @@ def main():
             print "Normalizing functional abundances by sum of functions per sample"
         predicted_metagenomes = predicted_metagenomes.norm(axis='sample', inplace=False)
 
+    return predicted_metagenomes
 
-    write_metagenome_to_file(predicted_metagenomes,opts.output_metagenome_table,\
-        opts.format_tab_delimited,"metagenome prediction",verbose=opts.verbose)
 
-    if opts.with_confidence:
-        output_path,output_filename = split(opts.output_metagenome_table)
+def prediction_output_fps(output_metagenome_table,with_confidence=False):
+    """Return [(description,filepath)] of the output tables"""
+    output_fps = [("metagenome prediction",output_metagenome_table)]
+    if with_confidence:
+        output_path,output_filename = split(output_metagenome_table)
         base_output_filename,ext = splitext(output_filename)
-        variance_output_fp =\
-          join(output_path,"%s_variances%s" %(base_output_filename,ext))
-        upper_CI_95_output_fp =\
-          join(output_path,"%s_upper_CI_95%s" %(base_output_filename,ext))
-        lower_CI_95_output_fp =\
-          join(output_path,"%s_lower_CI_95%s" %(base_output_filename,ext))
+        for description,suffix in [\
+          ("metagenome prediction variance","variances"),\
+          ("metagenome prediction upper 95% confidence interval","upper_CI_95"),\
+          ("metagenome prediction lower 95% confidence interval","lower_CI_95")]:
+            output_fps.append((description,\
+              join(output_path,"%s_%s%s" %(base_output_filename,suffix,ext))))
+    return output_fps
 
-        write_metagenome_to_file(predicted_metagenome_variances,\
-          variance_output_fp,opts.format_tab_delimited,\
-          "metagenome prediction variance",verbose=opts.verbose)
 
-        write_metagenome_to_file(predicted_metagenomes_upper_CI_95,\
-          upper_CI_95_output_fp,opts.format_tab_delimited,\
-          "metagenome prediction upper 95% confidence interval",\
-          verbose=opts.verbose)
+def prediction_output_fp_for_type(output_metagenome_table,type_of_prediction):
+    """Return the output filepath of one of several types of prediction"""
+    output_path,output_filename = split(output_metagenome_table)
+    base_output_filename,ext = splitext(output_filename)
+    return join(output_path,"%s_%s%s" %(base_output_filename,type_of_prediction,ext))
 
-        write_metagenome_to_file(predicted_metagenomes_lower_CI_95,\
-          lower_CI_95_output_fp,opts.format_tab_delimited,\
-          "metagenome prediction lower 95% confidence interval",\
-          verbose=opts.verbose)
+
+def write_predictions_in_chunks(otu_table,genome_table,variance_table,\
+    output_metagenome_table,opts,round_flag):
+    """Predict and write the metagenomes of opts.chunk_samples samples at a time
+
+    The genome (and variance) tables are loaded only once. Each chunk of
+    predictions is spilled to disk by a ChunkedTableWriter, which assembles
+    the output files once all chunks have been predicted.
+    """
+    if not len(otu_table.ids()):
+        raise ValueError("The OTU table has no samples to predict")
+    output_fps = prediction_output_fps(output_metagenome_table,\
+      opts.with_confidence)
+    writers = None
+    for i,chunk_otu_table in enumerate(iter_sample_chunks(otu_table,\
+      opts.chunk_samples)):
+        if opts.verbose:
+            print "Predicting chunk %i (%i samples)" %(i+1,len(chunk_otu_table.ids()))
+        predictions = predict_and_normalize(chunk_otu_table,genome_table,\
+          variance_table,opts,round_flag)
+        if writers is None:
+            header_key = None
+            if opts.format_tab_delimited:
+                header_key = tab_delimited_metadata_name(predictions[0])
+            writers = [ChunkedTableWriter(output_fp,\
+              tab_delimited=opts.format_tab_delimited,header_key=header_key,\
+              metadata_formatter=biom_meta_to_string,format_fs=BIOM_FORMAT_FS)\
+              for description,output_fp in output_fps]
+        for writer,prediction in zip(writers,predictions):
+            writer.write_chunk(prediction)
+
+    for writer,(description,output_fp) in zip(writers,output_fps):
+        if opts.verbose:
+            print "Writing %s results to output file: %s"\
+              %(description,output_fp)
+        make_output_dir_for_file(output_fp)
+        writer.close()
 
 
 def write_metagenome_to_file(predicted_metagenome,output_fp,\
@@ -326,36 +434,39 @@ def write_metagenome_to_file(predicted_metagenome,output_fp,\
 
     make_output_dir_for_file(output_fp)
     if tab_delimited:
-        #peek at first observation to decide on what observeration metadata
-        #to output in tab-delimited format
-        (obs_val,obs_id,obs_metadata)=\
-          predicted_metagenome.iter(axis='observation').next()
-
-        #see if there is a metadata field that contains the "Description"
-        #(e.g. KEGG_Description or COG_Description)
-        h = re.compile('.*Description')
-        metadata_names=filter(h.search,obs_metadata.keys())
-        if metadata_names:
-            #use the "Description" field we found
-            metadata_name=metadata_names[0]
-        elif(obs_metadata.keys()):
-            #if no "Description" metadata then just output the first
-            #observation metadata
-            metadata_name=(obs_metadata.keys())[0]
-        else:
-            #if no observation metadata then don't output any
-            metadata_name=None
+        metadata_name=tab_delimited_metadata_name(predicted_metagenome)
 
         open(output_fp,'w').write(predicted_metagenome.to_tsv(\
           header_key=metadata_name,header_value=metadata_name,metadata_formatter=biom_meta_to_string))
     else:
         #output in BIOM format
-        format_fs = {'KEGG_Description': picrust_formatter,
-                     'COG_Description': picrust_formatter,
-                     'KEGG_Pathways': picrust_formatter,
-                     'COG_Category': picrust_formatter
-                     }
-        write_biom_table(predicted_metagenome, output_fp, format_fs=format_fs)
+        write_biom_table(predicted_metagenome, output_fp, format_fs=BIOM_FORMAT_FS)
+
+
+def tab_delimited_metadata_name(predicted_metagenome):
+    """Return the observation metadata field to output in tab-delimited format"""
+    #peek at first observation to decide on what observeration metadata
+    #to output in tab-delimited format
+    (obs_val,obs_id,obs_metadata)=\
+      predicted_metagenome.iter(axis='observation').next()
+    if not obs_metadata:
+        return None
+
+    #see if there is a metadata field that contains the "Description"
+    #(e.g. KEGG_Description or COG_Description)
+    h = re.compile('.*Description')
+    metadata_names=filter(h.search,obs_metadata.keys())
+    if metadata_names:
+        #use the "Description" field we found
+        metadata_name=metadata_names[0]
+    elif(obs_metadata.keys()):
+        #if no "Description" metadata then just output the first
+        #observation metadata
+        metadata_name=(obs_metadata.keys())[0]
+    else:
+        #if no observation metadata then don't output any
+        metadata_name=None
+    return metadata_name
 
 
 def biom_meta_to_string(metadata, replace_str=':'):
@@ -15,10 +15,10 @@ __status__ = "Development"
 from math import e
 from os.path import splitext
 from cogent.util.option_parsing import parse_command_line_parameters, make_option
-from picrust.parse import extract_ids_from_table,\
-  parse_asr_confidence_output
+from picrust.parse import extract_ids_from_table
 from picrust.predict_traits import assign_traits_to_tree,\
-  predict_traits_from_ancestors, update_trait_dict_from_file,\
+  predict_traits_from_ancestors, trait_store_from_file,\
+  asr_confidence_stores_from_file,\
   make_neg_exponential_weight_fn, biom_table_from_predictions,\
   predict_random_neighbor,predict_nearest_neighbor,\
   calc_nearest_sequenced_taxon_index,weighted_average_tip_prediction, \
@@ -143,11 +143,13 @@ def main():
     tree = load_picrust_tree(opts.tree, opts.verbose)
 
     table_headers=[]
-    traits={}
+    traits=None
     #load the asr trait table using the previous list of functions to order the arrays
+    #Traits are held in a single float32 array per table, and nodes are
+    #assigned views of their rows, rather than lists of floats
     if opts.reconstructed_trait_table:
         table_headers,traits =\
-                update_trait_dict_from_file(opts.reconstructed_trait_table)
+                trait_store_from_file(opts.reconstructed_trait_table)
 
         #Only load confidence intervals on the reconstruction
         #If we actually have ASR values in the analysis
@@ -157,9 +159,8 @@ def main():
                 opts.reconstruction_confidence
                 print "Assuming confidence data is of type:",opts.confidence_format
 
-            asr_confidence_output = open(opts.reconstruction_confidence)
             asr_min_vals,asr_max_vals, params,column_mapping =\
-              parse_asr_confidence_output(asr_confidence_output,format=opts.confidence_format)
+              asr_confidence_stores_from_file(opts.reconstruction_confidence)
             if 'sigma' in params:
                 brownian_motion_parameter = params['sigma'][0]
             else:
@@ -173,11 +174,15 @@ def main():
 
     #load the trait table into a dict with organism names as keys and arrays as functions
     table_headers,genome_traits =\
-            update_trait_dict_from_file(opts.observed_trait_table,table_headers)
+            trait_store_from_file(opts.observed_trait_table,table_headers)
 
 
     #Combine the trait tables overwriting the asr ones if they exist in the genome trait table.
-    traits.update(genome_traits)
+    if traits is None:
+        traits = genome_traits
+    else:
+        traits.update(genome_traits)
+    del genome_traits
 
     # Specify the attribute where we'll store the reconstructions
     trait_label = "Reconstruction"
@@ -209,6 +214,12 @@ def main():
                       confidence=0.95)
              if opts.verbose:
                  print "Inferred the following rate parameters:",brownian_motion_parameter
+    #Index the tree so that the per-node prediction methods look up
+    #distances between nodes in constant time, rather than walking the tree
+    if opts.verbose:
+        print "Indexing distances between tree nodes..."
+    tree.buildDistanceIndex()
+
     if opts.verbose:
         print "Collecting list of nodes to predict..."
 
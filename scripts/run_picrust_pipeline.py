@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2011-2015, The PICRUSt Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.1.4"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+__status__ = "Development"
+
+
+from cogent.util.option_parsing import parse_command_line_parameters, make_option
+from biom import load_table
+from biom.table import vlen_list_of_str_formatter
+from os.path import exists, join
+from picrust.predict_metagenomes import determine_data_table_fp, load_data_table
+from picrust.categorize_by_function import CategoryMembership
+from picrust.pipeline import DEFAULT_METADATA_CATEGORIES,\
+  membership_cache_fp, normalize_predict_categorize
+from picrust.util import get_picrust_project_dir, make_output_dir,\
+  write_biom_table, picrust_formatter
+
+script_info = {}
+script_info['brief_description'] = "Normalize an OTU table by copy number, predict its metagenome and collapse it to functional categories in one process"
+script_info['script_description'] = "Runs the steps of normalize_by_copy_number.py, predict_metagenomes.py and categorize_by_function.py in a single process. Each table is passed to the next step in memory rather than being written to a BIOM file and parsed back in, and the precalculated tables are loaded once. Only the categorized metagenomes are written, unless --keep_intermediates is passed (or no functional categories apply, e.g. for rfam predictions, in which case the predicted metagenome is written)."
+script_info['script_usage'] = [
+("","Predict the KO metagenome and collapse it to KEGG Pathways at level 3:","%prog -i closed_picked_otus.biom -o picrust_out"),
+("","Collapse to KEGG Pathways at levels 1, 2 and 3, also writing the normalized OTU table and predicted metagenome:","%prog -i closed_picked_otus.biom -l 1,2,3 --keep_intermediates -o picrust_out"),
+("","Predict the COG metagenome and collapse it to COG Categories, caching the COG to category membership matrices between runs:","%prog -i closed_picked_otus.biom -t cog -l 2 --membership_cache_dir $PWD/membership_cache -o picrust_out"),
+]
+script_info['output_description']= "In the output directory, predicted_metagenomes.L<level>.biom (or .txt with -f) for each level. With --keep_intermediates, also normalized_otus.biom and predicted_metagenomes.biom, as written by normalize_by_copy_number.py and predict_metagenomes.py."
+script_info['required_options'] = [
+ make_option('-i','--input_otu_fp',type="existing_filepath",help='the input otu table filepath in biom format'),
+ make_option('-o','--output_dir',type="new_dirpath",help='the output directory'),
+]
+type_of_prediction_choices=['ko','cog','rfam']
+gg_version_choices=['13_5','18may2012']
+script_info['optional_options'] = [
+    make_option('-t','--type_of_prediction',default=type_of_prediction_choices[0],type="choice",\
+                    choices=type_of_prediction_choices,\
+                    help='Type of functional predictions. Valid choices are: '+\
+                    ', '.join(type_of_prediction_choices)+\
+                    ' [default: %default]'),
+    make_option('-g','--gg_version',default=gg_version_choices[0],type="choice",\
+                    choices=gg_version_choices,\
+                    help='Version of GreenGenes that was used for OTU picking. Valid choices are: '+\
+                    ', '.join(gg_version_choices)+\
+                    ' [default: %default]'),
+    make_option('--input_copy_number_fp',default=None,type="existing_filepath",\
+                    help='Precalculated marker gene copy numbers, as passed to normalize_by_copy_number.py with -c. Note: using this option overrides --gg_version for normalization. [default: %default]'),
+    make_option('--input_count_table',default=None,type="existing_filepath",\
+                    help='Precalculated function predictions, as passed to predict_metagenomes.py with -c. Note: using this option overrides --type_of_prediction and --gg_version for prediction. [default: %default]'),
+    make_option('--load_precalc_file_in_biom',default=False,action="store_true",\
+                    help='Load the precalculated files in biom format rather than tab-delimited format [default: %default]'),
+    make_option('--no_round',default=False,action="store_true",help='Disable rounding number of predicted functions to the the nearest whole number [default: %default]'),
+    make_option('-c','--metadata_category',default=None,type='string',\
+                    help='the metadata category that describes the hierarchy of functions [default: KEGG_Pathways for ko, COG_Category for cog predictions, and no categorization for rfam predictions]'),
+    make_option('-l','--levels',default='3',type='string',\
+                    help='comma-separated levels in the hierarchy to collapse to, each written to its own output file [default: %default]'),
+    make_option('--ignore',type='string',default=None,\
+                    help="Ignore the comma separated list of names while collapsing, as with categorize_by_function.py [default: %default]"),
+    make_option('--membership_cache_dir',default=None,type='new_dirpath',\
+                    help='directory in which to cache the function to category membership matrices, one file per precalculated table, metadata category, level and --ignore value. Cached matrices are reused by later runs [default: %default]'),
+    make_option('--keep_intermediates',default=False,action="store_true",\
+                    help='also write the normalized OTU table and the predicted metagenome to the output directory [default: %default]'),
+    make_option('-f','--format_tab_delimited',action="store_true",default=False,\
+                    help='output the categorized metagenomes in tab-delimited format [default: %default]'),
+]
+script_info['version'] = __version__
+
+#formatters for observation metadata written to BIOM (HDF5) output
+BIOM_FORMAT_FS = {'KEGG_Description': picrust_formatter,
+                  'COG_Description': picrust_formatter,
+                  'KEGG_Pathways': picrust_formatter,
+                  'COG_Category': picrust_formatter
+                  }
+
+
+def main():
+    option_parser, opts, args =\
+       parse_command_line_parameters(**script_info)
+
+    category = opts.metadata_category
+    if category is None:
+        category = DEFAULT_METADATA_CATEGORIES.get(opts.type_of_prediction)
+    try:
+        levels = [int(level) for level in opts.levels.split(',')]
+    except ValueError:
+        option_parser.error("--levels must be a comma-separated list of integers")
+    if min(levels) <= 0:
+        option_parser.error("levels must be greater than zero!")
+
+    make_output_dir(opts.output_dir)
+    if opts.membership_cache_dir:
+        make_output_dir(opts.membership_cache_dir)
+
+    if opts.verbose:
+        print "Loading OTU table: ",opts.input_otu_fp
+    otu_table = load_table(opts.input_otu_fp)
+
+    precalc_data_dir=join(get_picrust_project_dir(),'picrust','data')
+    copy_number_table_fp = determine_data_table_fp(precalc_data_dir,'16S',\
+      opts.gg_version,user_specified_table=opts.input_copy_number_fp,\
+      verbose=opts.verbose)
+    copy_number_table = load_data_table(copy_number_table_fp,\
+      load_data_table_in_biom=opts.load_precalc_file_in_biom,\
+      suppress_subset_loading=opts.load_precalc_file_in_biom,\
+      ids_to_load=otu_table.ids(axis='observation').tolist(),\
+      verbose=opts.verbose,transpose=True)
+
+    genome_table_fp = determine_data_table_fp(precalc_data_dir,\
+      opts.type_of_prediction,opts.gg_version,\
+      user_specified_table=opts.input_count_table,verbose=opts.verbose)
+    #OTUs without a copy number are dropped by normalization, but loading
+    #their counts too is harmless
+    genome_table = load_data_table(genome_table_fp,\
+      load_data_table_in_biom=opts.load_precalc_file_in_biom,\
+      suppress_subset_loading=opts.load_precalc_file_in_biom,\
+      ids_to_load=otu_table.ids(axis='observation').tolist(),\
+      verbose=opts.verbose,transpose=True)
+
+    memberships = {}
+    cache_fps = {}
+    if category is not None and opts.membership_cache_dir:
+        for level in levels:
+            cache_fps[level] = membership_cache_fp(opts.membership_cache_dir,\
+              genome_table_fp,category,level,opts.ignore)
+            if exists(cache_fps[level]):
+                if opts.verbose:
+                    print "Loading category membership: ",cache_fps[level]
+                memberships[level] = CategoryMembership.load(cache_fps[level])
+
+    cached_memberships = dict(memberships)
+
+    if opts.verbose:
+        print "Normalizing, predicting and categorizing the metagenome..."
+    normalized_table, predicted_metagenome, categorized_metagenomes =\
+      normalize_predict_categorize(otu_table,copy_number_table,genome_table,\
+      category=category,levels=levels,ignore=opts.ignore,\
+      memberships=memberships,whole_round=not opts.no_round)
+
+    #write new memberships, and rewrite those that were rebuilt because the
+    #cached ones did not match the reference's function metadata
+    for level,cache_fp in cache_fps.items():
+        if memberships[level] is not cached_memberships.get(level):
+            if opts.verbose:
+                print "Caching category membership: ",cache_fp
+            memberships[level].save(cache_fp)
+
+    if opts.keep_intermediates:
+        write_biom_table(normalized_table,\
+          join(opts.output_dir,'normalized_otus.biom'))
+    if opts.keep_intermediates or category is None:
+        write_biom_table(predicted_metagenome,\
+          join(opts.output_dir,'predicted_metagenomes.biom'),\
+          format_fs=BIOM_FORMAT_FS)
+
+    for level,categorized_metagenome in zip(levels,categorized_metagenomes):
+        if opts.format_tab_delimited:
+            output_fp = join(opts.output_dir,'predicted_metagenomes.L%i.txt' %level)
+            f = open(output_fp, 'w')
+            f.write(categorized_metagenome.to_tsv(header_key=category,
+                                                  header_value=category,
+                                                  metadata_formatter=lambda s: '; '.join(s)))
+            f.close()
+        else:
+            output_fp = join(opts.output_dir,'predicted_metagenomes.L%i.biom' %level)
+            write_biom_table(categorized_metagenome, output_fp,
+                             format_fs={category: vlen_list_of_str_formatter})
+        if opts.verbose:
+            print "Wrote level %i categories to: %s" %(level,output_fp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2015, The PICRUSt Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.1.4"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+__status__ = "Development"
+
+
+from cogent.util.unit_test import main, TestCase
+from os import listdir
+from os.path import exists, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from numpy import load as numpy_load
+from picrust.binary_precalc import (
+    binary_precalc_fp_for,
+    binary_precalc_fps,
+    choose_precalc_dtype,
+    convert_precalc_to_binary,
+    is_binary_precalc,
+    load_binary_precalc,
+    load_binary_precalc_header,
+    verify_binary_precalc,
+    write_binary_precalc,
+)
+from picrust.util import convert_precalc_to_biom
+import StringIO
+
+
+class BinaryPrecalcTests(TestCase):
+    """ Tests of the picrust/binary_precalc.py module """
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+        self.matrix_fp = join(self.tmp_dir, 'ko_13_5_precalculated.npy')
+        self.precalc_table = convert_precalc_to_biom(precalc_in_tab)
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def test_binary_precalc_fps(self):
+        """binary_precalc_fps derives sidecar paths from the matrix path"""
+        exp = ('x/ko.npy', 'x/ko.ids.npy', 'x/ko.metadata.json')
+        self.assertEqual(binary_precalc_fps('x/ko.npy'), exp)
+        self.assertEqual(binary_precalc_fps('x/ko'), exp)
+
+    def test_binary_precalc_fp_for(self):
+        """binary_precalc_fp_for replaces the table extension with .npy"""
+        self.assertEqual(binary_precalc_fp_for('d/ko_13_5_precalculated.tab.gz'),
+                         'd/ko_13_5_precalculated.npy')
+        self.assertEqual(binary_precalc_fp_for('custom.biom'), 'custom.npy')
+        self.assertEqual(binary_precalc_fp_for('custom'), 'custom.npy')
+
+    def test_is_binary_precalc(self):
+        """is_binary_precalc requires the matrix and both sidecar files"""
+        self.assertFalse(is_binary_precalc(self.matrix_fp))
+        write_binary_precalc(self.precalc_table, self.matrix_fp)
+        self.assertTrue(is_binary_precalc(self.matrix_fp))
+        self.assertFalse(is_binary_precalc(binary_precalc_fps(self.matrix_fp)[1]))
+        self.assertFalse(is_binary_precalc(join(self.tmp_dir, 'x.tab.gz')))
+
+    def test_choose_precalc_dtype(self):
+        """choose_precalc_dtype picks uint16 for small whole counts"""
+        self.assertEqual(choose_precalc_dtype([0.0, 1.0, 4.0]), 'uint16')
+        self.assertEqual(choose_precalc_dtype([0.5, 1.0]), 'float32')
+        self.assertEqual(choose_precalc_dtype([-1.0, 1.0]), 'float32')
+        self.assertEqual(choose_precalc_dtype([70000.0]), 'float32')
+
+    def test_write_and_load_binary_precalc(self):
+        """load_binary_precalc round-trips a table written by write_binary_precalc"""
+        header = write_binary_precalc(self.precalc_table, self.matrix_fp)
+        self.assertEqual(header['dtype'], 'uint16')
+        self.assertEqual(header['shape'], [3, 3])
+        for fp in binary_precalc_fps(self.matrix_fp):
+            self.assertTrue(exists(fp))
+
+        # rows are stored sorted by OTU id
+        sorted_ids = ['OTU_1', 'OTU_2', 'OTU_3']
+        obs = load_binary_precalc(self.matrix_fp)
+        self.assertEqual(obs, self.precalc_table.sort_order(sorted_ids))
+
+        obs = load_binary_precalc(self.matrix_fp, transpose=False)
+        exp = convert_precalc_to_biom(precalc_in_tab, transpose=False)
+        self.assertEqual(obs, exp.sort_order(sorted_ids, axis='observation'))
+
+    def test_load_binary_precalc_subset(self):
+        """load_binary_precalc loads only the requested OTUs"""
+        write_binary_precalc(self.precalc_table, self.matrix_fp,
+                             dtype='float32')
+        obs = load_binary_precalc(self.matrix_fp, ['OTU_3', 'OTU_1'])
+        exp = convert_precalc_to_biom(precalc_in_tab, ['OTU_1', 'OTU_3'])
+        self.assertEqualItems(obs.ids(), ['OTU_1', 'OTU_3'])
+        self.assertEqual(obs.sort_order(exp.ids()), exp)
+        self.assertEqual(obs.metadata()[1]['NSTI'], '0.5')
+
+    def test_load_binary_precalc_value_error(self):
+        """load_binary_precalc raises ValueError for unknown OTU ids"""
+        write_binary_precalc(self.precalc_table, self.matrix_fp)
+        self.assertRaises(ValueError, load_binary_precalc, self.matrix_fp,
+                          ['bogus_id1', 'bogus_id2'])
+        self.assertRaises(ValueError, load_binary_precalc, self.matrix_fp,
+                          ['OTU_1', 'bogus_id2'])
+
+    def test_convert_precalc_to_binary(self):
+        """convert_precalc_to_binary matches the BIOM-based writer"""
+        header = convert_precalc_to_binary(StringIO.StringIO(precalc_in_tab),
+                                           self.matrix_fp, gg_version='13_5',
+                                           type_of_prediction='ko')
+        self.assertEqual(header['gg_version'], '13_5')
+        self.assertEqual(header['type_of_prediction'], 'ko')
+        self.assertEqual(header['dtype'], 'uint16')
+        self.assertEqual(header['shape'], [3, 3])
+        self.assertEqual(load_binary_precalc_header(self.matrix_fp)['sha256'],
+                         header['sha256'])
+
+        obs = load_binary_precalc(self.matrix_fp)
+        exp = self.precalc_table.sort_order(['OTU_1', 'OTU_2', 'OTU_3'])
+        self.assertEqual(obs, exp)
+
+        # the same table gives the same checksum whichever writer is used
+        other_fp = join(self.tmp_dir, 'other.npy')
+        other_header = write_binary_precalc(self.precalc_table, other_fp)
+        self.assertEqual(other_header['sha256'], header['sha256'])
+
+        # no leftover temporary files
+        self.assertEqual(len(listdir(self.tmp_dir)), 6)
+
+    def test_convert_precalc_to_binary_float(self):
+        """convert_precalc_to_binary stores fractional values as float32"""
+        header = convert_precalc_to_binary(
+            StringIO.StringIO(precalc_in_tab.replace('4.0\t4.0', '4.5\t4.0')),
+            self.matrix_fp)
+        self.assertEqual(header['dtype'], 'float32')
+        self.assertEqual(header['gg_version'], None)
+        obs = load_binary_precalc(self.matrix_fp, ['OTU_3'])
+        self.assertFloatEqual(obs.data('OTU_3'), [4.5, 4.0, 4.0])
+
+    def test_verify_binary_precalc(self):
+        """verify_binary_precalc detects modified tables"""
+        write_binary_precalc(self.precalc_table, self.matrix_fp)
+        self.assertEqual(verify_binary_precalc(self.matrix_fp), [])
+
+        matrix = numpy_load(self.matrix_fp, mmap_mode='r+')
+        matrix[0, 0] += 1
+        matrix.flush()
+        del matrix
+        obs = verify_binary_precalc(self.matrix_fp)
+        self.assertEqual(len(obs), 1)
+        self.assertTrue('Checksum' in obs[0])
+
+        self.assertEqual(len(verify_binary_precalc(join(self.tmp_dir, 'x.npy'))), 1)
+
+
+precalc_in_tab="""#OTU_IDs	f1	f2	f3	metadata_NSTI
+metadata_simple	f1_desc	f2_desc	f3_desc
+metadata_list	f1;l1;l2	f2;l1;l2	f3;l2;l3
+metadata_list_of_lists	f1;l1;l2	f2;l1;l2|f2;l1a;l2a	f3;l3;l2
+OTU_3	4.0	4.0	4.0	0.5
+OTU_1	1.0	2.0	3.0	1.2
+OTU_2	0.0	0.0	0.0	2.3"""
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2011-2013, The PICRUSt Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.1.4"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+__status__ = "Development"
+
+
+from numpy import array
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from cogent.util.unit_test import main, TestCase
+from biom.table import Table
+from picrust.categorize_by_function import CategoryMembership,\
+    make_collapse_f
+
+
+class CategorizeByFunctionTests(TestCase):
+    """ Tests of the picrust/categorize_by_function.py module """
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+        pathways = [[['Metabolism', 'Amino Acid Metabolism'],
+                     ['Metabolism', 'Energy Metabolism']],
+                    [['Metabolism', 'Energy Metabolism']],
+                    [['Unclassified', 'Poorly Characterized'],
+                     ['Metabolism', 'Energy Metabolism'],
+                     ['Metabolism', 'Energy Metabolism']],
+                    [['Cellular Processes', 'Cell Motility']]]
+        self.table = Table(array([[1.0, 2.0], [3.0, 0.0], [5.0, 1.0],
+                                  [0.0, 4.0]]),
+                           ['K00001', 'K00002', 'K00003', 'K00004'],
+                           ['Sample1', 'Sample2'],
+                           [{'KEGG_Pathways': p} for p in pathways])
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def test_make_collapse_f(self):
+        """make_collapse_f yields the category of each path at level"""
+        collapse_f = make_collapse_f('KEGG_Pathways', 1, 'unclassified')
+        md = {'KEGG_Pathways': [['Metabolism', 'Energy Metabolism'],
+                                ['Unclassified', 'Poorly Characterized']]}
+        self.assertEqual(list(collapse_f('K00001', md)),
+                         [(['Metabolism'], 'Metabolism')])
+
+        md = {'KEGG_Pathways': ['Metabolism', 'Energy Metabolism']}
+        collapse_f = make_collapse_f('KEGG_Pathways', 2, None)
+        self.assertEqual(list(collapse_f('K00001', md)),
+                         [(['Metabolism', 'Energy Metabolism'],
+                           'Energy Metabolism')])
+
+    def test_collapse(self):
+        """CategoryMembership.collapse matches Table.collapse"""
+        for level, ignore in [(1, None), (2, None), (2, 'unclassified')]:
+            membership = CategoryMembership.from_table(
+                self.table, 'KEGG_Pathways', level, ignore)
+            obs = membership.collapse(self.table)
+            exp = self.table.collapse(
+                make_collapse_f('KEGG_Pathways', level, ignore),
+                axis='observation', one_to_many=True, norm=False,
+                one_to_many_md_key='KEGG_Pathways')
+            self.assertEqual(obs, exp)
+
+    def test_collapse_subset(self):
+        """collapse drops categories of functions that are not in the table"""
+        membership = CategoryMembership.from_table(self.table,
+                                                   'KEGG_Pathways', 2)
+        table = Table(array([[1.0, 2.0]]), ['K00004'], ['Sample1', 'Sample2'])
+        obs = membership.collapse(table)
+        self.assertEqual(list(obs.ids(axis='observation')), ['Cell Motility'])
+        self.assertFloatEqual(obs.matrix_data.toarray(), [[1.0, 2.0]])
+
+        table = Table(array([[1.0, 2.0]]), ['K99999'], ['Sample1', 'Sample2'])
+        self.assertRaises(ValueError, membership.collapse, table)
+
+    def test_matches_table(self):
+        """matches_table checks function ids and category metadata"""
+        membership = CategoryMembership.from_table(self.table,
+                                                   'KEGG_Pathways', 2)
+        self.assertTrue(membership.matches_table(self.table))
+
+        #a subset of the functions, with or without metadata
+        table = Table(array([[1.0, 2.0]]), ['K00004'], ['Sample1', 'Sample2'],
+                      [{'KEGG_Pathways': [['Cellular Processes',
+                                           'Cell Motility']]}])
+        self.assertTrue(membership.matches_table(table))
+        table = Table(array([[1.0, 2.0]]), ['K00004'], ['Sample1', 'Sample2'])
+        self.assertTrue(membership.matches_table(table))
+
+        #a function the matrix was not built for
+        table = Table(array([[1.0, 2.0]]), ['K99999'], ['Sample1', 'Sample2'])
+        self.assertFalse(membership.matches_table(table))
+
+        #the same function ids, with other pathways
+        table = Table(array([[1.0, 2.0]]), ['K00004'], ['Sample1', 'Sample2'],
+                      [{'KEGG_Pathways': [['Metabolism',
+                                           'Energy Metabolism']]}])
+        self.assertFalse(membership.matches_table(table))
+
+        #tables with all of the functions are checked with a single digest
+        pathways = [md['KEGG_Pathways']
+                    for md in self.table.metadata(axis='observation')]
+        pathways[3] = [['Metabolism', 'Energy Metabolism']]
+        table = Table(self.table.matrix_data, self.table.ids(axis='observation'),
+                      self.table.ids(), [{'KEGG_Pathways': p} for p in pathways])
+        self.assertFalse(membership.matches_table(table))
+        membership.functions_md_digest = 'stale'
+        self.assertFalse(membership.matches_table(self.table))
+
+    def test_save_load(self):
+        """CategoryMembership survives a save/load roundtrip"""
+        membership = CategoryMembership.from_table(
+            self.table, 'KEGG_Pathways', 2, 'unclassified')
+        membership_fp = join(self.tmp_dir, 'ko.KEGG_Pathways.L2.npz')
+        membership.save(membership_fp)
+
+        obs = CategoryMembership.load(membership_fp)
+        self.assertTrue(obs.matches('KEGG_Pathways', 2, 'unclassified'))
+        self.assertFalse(obs.matches('KEGG_Pathways', 3, 'unclassified'))
+        self.assertFalse(obs.matches('KEGG_Pathways', 2, None))
+        self.assertEqual(obs.function_ids, membership.function_ids)
+        self.assertEqual(obs.category_ids, membership.category_ids)
+        self.assertEqual(obs.function_md_digests,
+                         membership.function_md_digests)
+        self.assertEqual(obs.functions_md_digest,
+                         membership.functions_md_digest)
+        self.assertTrue(obs.matches_table(self.table))
+        self.assertEqual(obs.membership.toarray().tolist(),
+                         membership.membership.toarray().tolist())
+        self.assertEqual(obs.collapse(self.table),
+                         membership.collapse(self.table))
+
+
+if __name__ == "__main__":
+    main()
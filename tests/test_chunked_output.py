@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2015, The PICRUSt Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.1.4"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+__status__ = "Development"
+
+
+from cogent.util.unit_test import main, TestCase
+from os import listdir
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from biom import load_table
+from biom.parse import parse_biom_table
+from picrust.chunked_output import ChunkedTableWriter, iter_sample_chunks
+from picrust.predict_metagenomes import predict_metagenomes
+
+
+class ChunkedOutputTests(TestCase):
+    """ Tests of the picrust/chunked_output.py module """
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+        self.otu_table = parse_biom_table(otu_table1)
+        self.genome_table = parse_biom_table(genome_table1)
+        self.predicted = predict_metagenomes(self.otu_table, self.genome_table)
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def test_iter_sample_chunks(self):
+        """iter_sample_chunks splits a table into consecutive samples"""
+        chunks = list(iter_sample_chunks(self.otu_table, 3))
+        self.assertEqual([list(c.ids()) for c in chunks],
+                         [['Sample1', 'Sample2', 'Sample3'], ['Sample4']])
+        for chunk in chunks:
+            self.assertEqual(list(chunk.ids(axis='observation')),
+                             list(self.otu_table.ids(axis='observation')))
+            for sample_id in chunk.ids():
+                self.assertFloatEqual(chunk.data(sample_id),
+                                      self.otu_table.data(sample_id))
+        self.assertRaises(ValueError, list,
+                          iter_sample_chunks(self.otu_table, 0))
+
+    def test_chunked_predictions_tab_delimited(self):
+        """ChunkedTableWriter writes the same tsv as predicting all at once"""
+        output_fp = join(self.tmp_dir, 'predicted.tab')
+        writer = ChunkedTableWriter(output_fp, tab_delimited=True)
+        for chunk in iter_sample_chunks(self.otu_table, 3):
+            writer.write_chunk(predict_metagenomes(chunk, self.genome_table))
+        writer.close()
+        self.assertEqual(open(output_fp).read(), self.predicted.to_tsv())
+
+    def test_chunked_predictions_hdf5(self):
+        """ChunkedTableWriter writes the same BIOM table as predicting all at once"""
+        output_fp = join(self.tmp_dir, 'predicted.biom')
+        writer = ChunkedTableWriter(output_fp)
+        for chunk in iter_sample_chunks(self.otu_table, 1):
+            writer.write_chunk(predict_metagenomes(chunk, self.genome_table))
+        writer.close()
+        self.assertEqual(load_table(output_fp), self.predicted)
+
+    def test_chunked_predictions_hdf5_failure(self):
+        """ChunkedTableWriter leaves no partial BIOM file behind on errors"""
+        output_fp = join(self.tmp_dir, 'predicted.biom')
+        writer = ChunkedTableWriter(output_fp)
+        writer.write_chunk(self.predicted)
+
+        def fail(*args):
+            raise IOError("disk full")
+        writer._append_matrix = fail
+        self.assertRaises(IOError, writer.close)
+        self.assertEqual(listdir(self.tmp_dir), [])
+
+    def test_write_chunk_mismatched_observations(self):
+        """ChunkedTableWriter rejects chunks with different observations"""
+        writer = ChunkedTableWriter(join(self.tmp_dir, 'predicted.biom'))
+        writer.write_chunk(self.predicted)
+        self.assertRaises(ValueError, writer.write_chunk, self.otu_table)
+
+
+otu_table1 = """{"rows": [{"id": "GG_OTU_1", "metadata": null}, {"id": "GG_OTU_2", "metadata": null}, {"id": "GG_OTU_3", "metadata": null}], "format": "Biological Observation Matrix v0.9", "data": [[0, 0, 1.0], [0, 1, 2.0], [0, 2, 3.0], [0, 3, 5.0], [1, 0, 5.0], [1, 1, 1.0], [1, 3, 2.0], [2, 2, 1.0], [2, 3, 4.0]], "columns": [{"id": "Sample1", "metadata": null}, {"id": "Sample2", "metadata": null}, {"id": "Sample3", "metadata": null}, {"id": "Sample4", "metadata": null}], "generated_by": "QIIME 1.4.0-dev, svn revision 2753", "matrix_type": "sparse", "shape": [3, 4], "format_url": "http://www.qiime.org/svn_documentation/documentation/biom_format.html", "date": "2012-02-22T20:50:05.024661", "type": "Gene table", "id": null, "matrix_element_type": "float"}"""
+
+genome_table1 = """{"rows": [{"id": "f1", "metadata": null}, {"id": "f2", "metadata": null}, {"id": "f3", "metadata": null}], "format": "Biological Observation Matrix v0.9", "data": [[0, 0, 1.0], [0, 1, 2.0], [0, 2, 3.0], [1, 1, 1.0], [2, 2, 1.0]], "columns": [{"id": "GG_OTU_1", "metadata": null}, {"id": "GG_OTU_3", "metadata": null}, {"id": "GG_OTU_2", "metadata": null}], "generated_by": "QIIME 1.4.0-dev, svn revision 2753", "matrix_type": "sparse", "shape": [3, 3], "format_url": "http://www.qiime.org/svn_documentation/documentation/biom_format.html", "date": "2012-02-22T20:49:58.258296", "type": "Gene table", "id": null, "matrix_element_type": "float"}"""
+
+if __name__ == "__main__":
+    main()
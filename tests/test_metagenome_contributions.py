@@ -13,9 +13,16 @@ __status__ = "Development"
 
 
 from cogent.util.unit_test import TestCase, main
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+import gzip
+from numpy import float64
 from biom.parse import parse_biom_table
 from picrust.metagenome_contributions import partition_metagenome_contributions,\
-  make_pathway_filter_fn
+  make_pathway_filter_fn,taxonomy_by_otu,iter_metagenome_contributions,\
+  write_metagenome_contributions,write_metagenome_contributions_hdf5,\
+  load_metagenome_contributions_hdf5,write_metagenome_contributions_parallel
 from picrust.predict_metagenomes import predict_metagenomes
 
 class PartitionMetagenomeTests(TestCase):
@@ -36,6 +43,10 @@ class PartitionMetagenomeTests(TestCase):
         #metadata are defined at the bottom of this file.
         self.metadata_example = [(700.0,"Gene1",example_metadata1),\
           (250.0,"Gene2",example_metadata2),(0.0,"Gene3",example_metadata3)]
+        self.tmp_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
 
 
     def test_partition_metagenome_contributions_with_taxonomy(self):
@@ -57,6 +68,142 @@ class PartitionMetagenomeTests(TestCase):
 
         self.assertEqual(obs_text,exp_text)
 
+    def test_partition_metagenome_contributions_keep_zero_rows(self):
+        """partition_metagenome_contributions outputs every OTU/sample pair if asked"""
+        obs = partition_metagenome_contributions(self.otu_table1,
+          self.genome_table1,remove_zero_rows=False)
+        #3 genes x 4 samples x 3 OTUs
+        self.assertEqual(len(obs),37)
+        self.assertEqual(obs[1][:3],["f1","Sample1","GG_OTU_1"])
+        self.assertEqual(obs[3][:3],["f1","Sample1","GG_OTU_3"])
+        self.assertFloatEqual(obs[3][3:],[2.0,0.0,0.0,0.0,0.0])
+
+        nonzero = [row for row in obs[1:] if row[5] != 0.0]
+        exp = partition_metagenome_contributions(self.otu_table1,self.genome_table1)
+        self.assertEqual(nonzero,exp[1:])
+
+    def test_write_metagenome_contributions(self):
+        """write_metagenome_contributions matches the in-memory partition"""
+        exp = partition_metagenome_contributions(self.otu_table_with_taxonomy,
+          self.genome_table1)
+        exp_text = "\n".join(["\t".join(map(str,i)) for i in exp])
+
+        output_fp = join(self.tmp_dir,'contributions.tab')
+        n_rows = write_metagenome_contributions(iter_metagenome_contributions(
+          self.otu_table_with_taxonomy,self.genome_table1),output_fp)
+        self.assertEqual(n_rows,len(exp)-1)
+        self.assertEqual(open(output_fp).read(),exp_text)
+
+        output_fp = join(self.tmp_dir,'contributions.tab.gz')
+        write_metagenome_contributions(iter_metagenome_contributions(
+          self.otu_table_with_taxonomy,self.genome_table1),output_fp)
+        self.assertEqual(gzip.open(output_fp).read(),exp_text)
+
+    def test_write_metagenome_contributions_precision(self):
+        """write_metagenome_contributions keeps the full precision of counts"""
+        abundance = 0.1234567890123456
+        otu_table = parse_biom_table(otu_table1.replace('[0, 0, 1.0]',
+          '[0, 0, %r]' % abundance))
+        output_fp = join(self.tmp_dir,'contributions.tab')
+        write_metagenome_contributions(iter_metagenome_contributions(
+          otu_table,self.genome_table1),output_fp)
+        rows = [line.split('\t') for line in open(output_fp).read().split('\n')]
+        row = [r for r in rows if r[:3] == ['f1','Sample1','GG_OTU_1']][0]
+
+        #as formatted by the original implementation, which wrote the
+        #counts as numpy scalars and the percentages as Python floats
+        gene_count = float64(1.0)
+        exp = map(str,[gene_count,float64(abundance),\
+          gene_count*float64(abundance)])
+        self.assertEqual(row[3:6],exp)
+
+    def test_iter_metagenome_contributions_raises_on_empty_filter(self):
+        """iter_metagenome_contributions raises as soon as filtering removes all functions"""
+        self.assertRaises(ValueError,iter_metagenome_contributions,
+          self.otu_table1,self.genome_table1,limit_to_functions=["bogus"])
+
+    def test_write_metagenome_contributions_hdf5(self):
+        """write_metagenome_contributions_hdf5 round-trips the contribution rows"""
+        exp = partition_metagenome_contributions(self.otu_table_with_taxonomy,
+          self.genome_table1)
+        output_fp = join(self.tmp_dir,'contributions.h5')
+        n_rows = write_metagenome_contributions_hdf5(
+          self.otu_table_with_taxonomy,self.genome_table1,output_fp)
+        self.assertEqual(n_rows,len(exp)-1)
+
+        for gene_id in ["f1","f2","f3"]:
+            obs = load_metagenome_contributions_hdf5(output_fp,gene_id)
+            exp_rows = [row for row in exp[1:] if row[0] == gene_id]
+            self.assertEqual(len(obs),len(exp_rows))
+            for obs_row,exp_row in zip(obs,exp_rows):
+                self.assertEqual(obs_row[:3],exp_row[:3])
+                self.assertFloatEqual(obs_row[3:8],exp_row[3:8])
+                self.assertEqual(obs_row[8:],exp_row[8:])
+
+        obs = load_metagenome_contributions_hdf5(output_fp,"f1",["Sample4"])
+        self.assertEqual([row[2] for row in obs],
+          ["GG_OTU_1","GG_OTU_2","GG_OTU_3"])
+        self.assertRaises(KeyError,load_metagenome_contributions_hdf5,
+          output_fp,"bogus")
+
+    def test_partition_metagenome_contributions_top_k(self):
+        """partition_metagenome_contributions keeps only the top contributors"""
+        all_rows = partition_metagenome_contributions(self.otu_table1,
+          self.genome_table1)
+        obs = partition_metagenome_contributions(self.otu_table1,
+          self.genome_table1,top_k=1)
+        #one row per gene and sample with any contribution
+        self.assertEqual([row[:3] for row in obs[1:]],
+          [["f1","Sample1","GG_OTU_2"],["f1","Sample2","GG_OTU_2"],
+           ["f1","Sample3","GG_OTU_1"],["f1","Sample4","GG_OTU_3"],
+           ["f2","Sample3","GG_OTU_3"],["f2","Sample4","GG_OTU_3"],
+           ["f3","Sample1","GG_OTU_2"],["f3","Sample2","GG_OTU_2"],
+           ["f3","Sample4","GG_OTU_2"]])
+        #percentages are still relative to all contributors
+        for row in obs[1:]:
+            self.assertTrue(row in all_rows)
+
+        obs = partition_metagenome_contributions(self.otu_table1,
+          self.genome_table1,top_k=10)
+        self.assertEqual(obs,all_rows)
+
+    def test_partition_metagenome_contributions_min_percent(self):
+        """partition_metagenome_contributions drops small contributors"""
+        all_rows = partition_metagenome_contributions(self.otu_table1,
+          self.genome_table1)
+        obs = partition_metagenome_contributions(self.otu_table1,
+          self.genome_table1,min_percent=40)
+        self.assertEqual(obs[1:],[row for row in all_rows[1:] if row[6] >= 0.4])
+        self.assertEqual(len(obs),12)
+
+    def test_write_metagenome_contributions_parallel(self):
+        """write_metagenome_contributions_parallel matches the serial output"""
+        exp_fp = join(self.tmp_dir,'serial.tab')
+        exp_rows = write_metagenome_contributions(iter_metagenome_contributions(
+          self.otu_table_with_taxonomy,self.genome_table1),exp_fp)
+        exp_text = open(exp_fp).read()
+
+        for n_procs in [1,2,3,5]:
+            output_fp = join(self.tmp_dir,'parallel_%i.tab' %n_procs)
+            n_rows = write_metagenome_contributions_parallel(
+              self.otu_table_with_taxonomy,self.genome_table1,output_fp,n_procs)
+            self.assertEqual(n_rows,exp_rows)
+            self.assertEqual(open(output_fp).read(),exp_text)
+
+        output_fp = join(self.tmp_dir,'parallel.tab.gz')
+        write_metagenome_contributions_parallel(self.otu_table_with_taxonomy,
+          self.genome_table1,output_fp,2,top_k=1)
+        exp = partition_metagenome_contributions(self.otu_table_with_taxonomy,
+          self.genome_table1,top_k=1)
+        self.assertEqual(gzip.open(output_fp).read(),
+          "\n".join(["\t".join(map(str,i)) for i in exp]))
+
+    def test_taxonomy_by_otu(self):
+        """taxonomy_by_otu returns the taxonomy of each OTU in order"""
+        obs = taxonomy_by_otu(self.otu_table_with_taxonomy,["GG_OTU_3","GG_OTU_1"])
+        self.assertEqual([t[0] for t in obs],["k__3","k__1"])
+        self.assertEqual(taxonomy_by_otu(self.otu_table1,["GG_OTU_1"]),[[]])
+
     def test_make_pathway_filter_fn_KEGG(self):
         """make_pathway_filter_function functions with valid KEGG data"""
         filter_fn = make_pathway_filter_fn(["Phagosome"],\
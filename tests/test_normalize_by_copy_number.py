@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2015, The PICRUSt Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.1.4"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+__status__ = "Development"
+
+
+from numpy import array
+from cogent.util.unit_test import main, TestCase
+from biom.table import Table
+from picrust.normalize_by_copy_number import align_copy_numbers,\
+    normalize_by_copy_number
+
+
+class NormalizeByCopyNumberTests(TestCase):
+    """ Tests of the picrust/normalize_by_copy_number.py module """
+
+    def setUp(self):
+        self.otu_table = Table(array([[2, 0, 6], [5, 5, 0], [1, 2, 3],
+                                      [4, 4, 4]]),
+                               ['OTU_1', 'OTU_2', 'OTU_3', 'OTU_4'],
+                               ['S1', 'S2', 'S3'],
+                               [{'taxonomy': ['k__A']}, {'taxonomy': ['k__B']},
+                                {'taxonomy': ['k__C']}, {'taxonomy': ['k__D']}])
+        #OTUs are samples in count tables, as loaded with transpose=True
+        self.count_table = Table(array([[2.0, 1.0, 4.6, 3.0]]),
+                                 ['16S_rRNA_Count'],
+                                 ['OTU_4', 'OTU_3', 'OTU_2', 'bogus'])
+
+    def test_align_copy_numbers(self):
+        """align_copy_numbers finds copy numbers in OTU table order"""
+        otu_idxs, copy_numbers = align_copy_numbers(
+            self.otu_table.ids(axis='observation'), self.count_table)
+        self.assertEqual(otu_idxs.tolist(), [1, 2, 3])
+        self.assertEqual(copy_numbers.tolist(), [5, 1, 2])
+
+    def test_align_copy_numbers_invalid(self):
+        """align_copy_numbers rejects copy numbers that round below one"""
+        count_table = Table(array([[0.4, 1.0]]), ['16S_rRNA_Count'],
+                            ['OTU_1', 'OTU_2'])
+        self.assertRaises(ValueError, align_copy_numbers,
+                          self.otu_table.ids(axis='observation'), count_table)
+
+        count_table = Table(array([[1.0]]), ['16S_rRNA_Count'], ['bogus'])
+        self.assertRaises(ValueError, align_copy_numbers,
+                          self.otu_table.ids(axis='observation'), count_table)
+
+    def test_normalize_by_copy_number(self):
+        """normalize_by_copy_number divides each OTU by its copy number"""
+        obs = normalize_by_copy_number(self.otu_table, self.count_table)
+        self.assertEqual(list(obs.ids(axis='observation')),
+                         ['OTU_2', 'OTU_3', 'OTU_4'])
+        self.assertEqual(list(obs.ids()), ['S1', 'S2', 'S3'])
+        self.assertFloatEqual(obs.matrix_data.toarray(),
+                              [[1.0, 1.0, 0.0], [1.0, 2.0, 3.0],
+                               [2.0, 2.0, 2.0]])
+        self.assertEqual(obs.metadata('OTU_2', axis='observation'),
+                         {'taxonomy': ['k__B'], 'CopyNumber': 5})
+        self.assertEqual(obs.metadata('OTU_4', axis='observation'),
+                         {'taxonomy': ['k__D'], 'CopyNumber': 2})
+
+        #the input table is left untouched
+        self.assertEqual(self.otu_table.metadata('OTU_2', axis='observation'),
+                         {'taxonomy': ['k__B']})
+
+        obs = normalize_by_copy_number(self.otu_table, self.count_table,
+                                       metadata_identifier='16S')
+        self.assertEqual(obs.metadata('OTU_3', axis='observation'),
+                         {'taxonomy': ['k__C'], '16S': 1})
+
+
+if __name__ == "__main__":
+    main()
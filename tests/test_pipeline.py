@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2015, The PICRUSt Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.1.4"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+__status__ = "Development"
+
+
+from numpy import array
+from cogent.util.unit_test import main, TestCase
+from biom.table import Table
+from picrust.categorize_by_function import CategoryMembership
+from picrust.normalize_by_copy_number import normalize_by_copy_number
+from picrust.predict_metagenomes import predict_metagenomes
+from picrust.pipeline import membership_cache_fp,\
+    normalize_predict_categorize
+
+
+class PipelineTests(TestCase):
+    """ Tests of the picrust/pipeline.py module """
+
+    def setUp(self):
+        self.otu_table = Table(array([[4, 0], [3, 6], [1, 1]]),
+                               ['OTU_1', 'OTU_2', 'OTU_3'],
+                               ['Sample1', 'Sample2'])
+        self.copy_number_table = Table(array([[2.0, 3.0]]),
+                                       ['16S_rRNA_Count'],
+                                       ['OTU_1', 'OTU_2'])
+        pathways = [[['Metabolism', 'Energy Metabolism']],
+                    [['Metabolism', 'Lipid Metabolism'],
+                     ['Cellular Processes', 'Cell Motility']]]
+        self.genome_table = Table(array([[1, 2], [0, 3]]),
+                                  ['K00001', 'K00002'], ['OTU_1', 'OTU_2'],
+                                  [{'KEGG_Pathways': p} for p in pathways])
+
+    def test_normalize_predict_categorize(self):
+        """normalize_predict_categorize matches running the steps in turn"""
+        memberships = {}
+        normalized, predicted, categorized = normalize_predict_categorize(
+            self.otu_table, self.copy_number_table, self.genome_table,
+            category='KEGG_Pathways', levels=[1, 2], memberships=memberships)
+
+        exp_normalized = normalize_by_copy_number(self.otu_table,
+                                                  self.copy_number_table)
+        exp_predicted = predict_metagenomes(exp_normalized, self.genome_table)
+        self.assertEqual(normalized, exp_normalized)
+        self.assertEqual(predicted, exp_predicted)
+
+        self.assertEqual(sorted(memberships), [1, 2])
+        for level, obs in zip([1, 2], categorized):
+            exp = CategoryMembership.from_table(
+                exp_predicted, 'KEGG_Pathways', level).collapse(exp_predicted)
+            self.assertEqual(obs, exp)
+
+        #memberships passed in are reused, and must match
+        obs = normalize_predict_categorize(
+            self.otu_table, self.copy_number_table, self.genome_table,
+            category='KEGG_Pathways', levels=[2], memberships=memberships)
+        self.assertEqual(obs[2], categorized[1:])
+        self.assertRaises(ValueError, normalize_predict_categorize,
+                          self.otu_table, self.copy_number_table,
+                          self.genome_table, category='KEGG_Pathways',
+                          levels=[2], memberships={2: memberships[1]})
+
+    def test_normalize_predict_categorize_stale_membership(self):
+        """memberships built from other function metadata are rebuilt"""
+        pathways = [[['Metabolism', 'Energy Metabolism']],
+                    [['Metabolism', 'Lipid Metabolism']]]
+        old_genome_table = Table(array([[1, 2], [0, 3]]),
+                                 ['K00001', 'K00002'], ['OTU_1', 'OTU_2'],
+                                 [{'KEGG_Pathways': p} for p in pathways])
+        stale = CategoryMembership.from_table(old_genome_table,
+                                              'KEGG_Pathways', 2)
+        memberships = {2: stale}
+        normalized, predicted, categorized = normalize_predict_categorize(
+            self.otu_table, self.copy_number_table, self.genome_table,
+            category='KEGG_Pathways', levels=[2], memberships=memberships)
+
+        self.assertFalse(memberships[2] is stale)
+        exp = CategoryMembership.from_table(
+            predicted, 'KEGG_Pathways', 2).collapse(predicted)
+        self.assertEqual(categorized, [exp])
+
+        #matching memberships are kept
+        current = memberships[2]
+        normalize_predict_categorize(
+            self.otu_table, self.copy_number_table, self.genome_table,
+            category='KEGG_Pathways', levels=[2], memberships=memberships)
+        self.assertTrue(memberships[2] is current)
+
+    def test_normalize_predict_categorize_no_category(self):
+        """normalize_predict_categorize skips categorization without a category"""
+        obs = normalize_predict_categorize(self.otu_table,
+                                           self.copy_number_table,
+                                           self.genome_table, levels=[1])
+        self.assertEqual(obs[2], [])
+
+    def test_membership_cache_fp(self):
+        """membership_cache_fp names the cache after the reference table"""
+        self.assertEqual(membership_cache_fp(
+            '/tmp/cache', '/data/ko_13_5_precalculated.tab.gz',
+            'KEGG_Pathways', 3),
+            '/tmp/cache/ko_13_5_precalculated.KEGG_Pathways.L3.npz')
+        self.assertEqual(membership_cache_fp(
+            '/tmp/cache', '/data/ko_13_5_precalculated.npy',
+            'KEGG_Pathways', 2, 'unknown,unclassified'),
+            '/tmp/cache/ko_13_5_precalculated.KEGG_Pathways.L2.'
+            'ignore-unknown-unclassified.npz')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2015, The PICRUSt Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.1.4"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+__status__ = "Development"
+
+
+from cogent.util.unit_test import main, TestCase
+from os.path import exists, join
+from shutil import rmtree
+from tempfile import mkdtemp
+import gzip
+from picrust.precalc_index import (
+    find_precalc_blocks,
+    has_precalc_index,
+    index_precalc_file,
+    iter_indexed_precalc_lines,
+    open_indexed_precalc,
+    precalc_index_fp,
+)
+from picrust.util import convert_precalc_to_biom
+
+
+class PrecalcIndexTests(TestCase):
+    """ Tests of the picrust/precalc_index.py module """
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+        self.precalc_fp = join(self.tmp_dir, 'ko_13_5_precalculated.tab.gz')
+        precalc_fh = gzip.open(self.precalc_fp, 'wb')
+        precalc_fh.write(precalc_in_tab)
+        precalc_fh.close()
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def test_index_precalc_file(self):
+        """index_precalc_file writes a valid multi-block gzip file and index"""
+        # one OTU row per block
+        num_blocks = index_precalc_file(self.precalc_fp, block_size=1)
+        self.assertEqual(num_blocks, 4)
+        self.assertTrue(exists(precalc_index_fp(self.precalc_fp)))
+        self.assertTrue(has_precalc_index(self.precalc_fp))
+
+        # still readable as an ordinary gzip file
+        self.assertEqual(gzip.open(self.precalc_fp, 'rb').read(),
+                         precalc_in_tab)
+
+    def test_index_precalc_file_to_output(self):
+        """index_precalc_file can write the indexed file elsewhere"""
+        output_fp = join(self.tmp_dir, 'indexed.tab.gz')
+        num_blocks = index_precalc_file(self.precalc_fp, output_fp)
+        # all rows fit in a single default-sized block
+        self.assertEqual(num_blocks, 1)
+        self.assertTrue(has_precalc_index(output_fp))
+        self.assertFalse(has_precalc_index(self.precalc_fp))
+        self.assertEqual(gzip.open(output_fp, 'rb').read(), precalc_in_tab)
+
+    def test_has_precalc_index_stale(self):
+        """has_precalc_index ignores indices for files that have changed"""
+        index_precalc_file(self.precalc_fp, block_size=1)
+        precalc_fh = gzip.open(self.precalc_fp, 'wb')
+        precalc_fh.write(precalc_in_tab + '\nOTU_5\t1.0\t1.0\t1.0\t0.1')
+        precalc_fh.close()
+        self.assertFalse(has_precalc_index(self.precalc_fp))
+
+    def test_find_precalc_blocks(self):
+        """find_precalc_blocks returns the header block and matching blocks"""
+        index_lines = ['# PICRUSt precalc block index v1', '#size\t100',
+                       '0\t10', '10\t20\tOTU_1\tOTU_2', '30\t5\tOTU_3',
+                       '35\t5\tOTU_4']
+        self.assertEqual(find_precalc_blocks(index_lines, ['OTU_4', 'OTU_2']),
+                         [(0, 10), (10, 20), (35, 5)])
+        self.assertEqual(find_precalc_blocks(index_lines, ['bogus']),
+                         [(0, 10)])
+
+    def test_iter_indexed_precalc_lines(self):
+        """iter_indexed_precalc_lines decompresses only the needed blocks"""
+        index_precalc_file(self.precalc_fp, block_size=1)
+        obs = list(iter_indexed_precalc_lines(self.precalc_fp, ['OTU_3']))
+        exp = precalc_in_tab.splitlines(True)
+        self.assertEqual(obs, exp[:4] + [exp[6]])
+
+    def test_open_indexed_precalc(self):
+        """convert_precalc_to_biom reads the indexed subset"""
+        index_precalc_file(self.precalc_fp, block_size=1)
+        ids_to_load = ['OTU_3', 'OTU_1']
+        obs = convert_precalc_to_biom(
+            open_indexed_precalc(self.precalc_fp, ids_to_load), ids_to_load)
+        exp = convert_precalc_to_biom(precalc_in_tab, ids_to_load)
+        self.assertEqual(obs, exp)
+
+        self.assertRaises(ValueError, convert_precalc_to_biom,
+                          open_indexed_precalc(self.precalc_fp,
+                                               ['OTU_1', 'bogus']),
+                          ['OTU_1', 'bogus'])
+
+
+precalc_in_tab="""#OTU_IDs	f1	f2	f3	metadata_NSTI
+metadata_simple	f1_desc	f2_desc	f3_desc
+metadata_list	f1;l1;l2	f2;l1;l2	f3;l2;l3
+metadata_list_of_lists	f1;l1;l2	f2;l1;l2|f2;l1a;l2a	f3;l3;l2
+OTU_1	1.0	2.0	3.0	1.2
+OTU_2	0.0	0.0	0.0	2.3
+OTU_3	4.0	4.0	4.0	0.5
+OTU_4	1.0	0.0	1.0	0.1"""
+
+if __name__ == "__main__":
+    main()
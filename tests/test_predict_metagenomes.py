@@ -12,7 +12,12 @@ __email__ = "gregcaporaso@gmail.com"
 __status__ = "Development"
 
 from numpy import array
+from scipy.sparse import csr_matrix
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
 from cogent.util.unit_test import TestCase, main
+from biom.table import Table
 from biom.parse import parse_biom_table, get_axis_indices,\
   direct_slice_data
 from picrust.predict_metagenomes import predict_metagenomes,\
@@ -21,7 +26,12 @@ from picrust.predict_metagenomes import predict_metagenomes,\
   transfer_observation_metadata,transfer_metadata,\
   load_subset_from_biom_str,yield_subset_biom_str,\
   predict_metagenome_variances,variance_of_sum,variance_of_product,\
-  sum_rows_with_variance
+  sum_rows_with_variance,determine_data_table_fp,\
+  extract_otu_and_genome_matrices,align_variance_matrix,\
+  union_otu_ids,predict_metagenomes_batch,predict_metagenomes_parallel,\
+  dedup_genome_profiles,predict_metagenomes_multi,aligned_metadata,\
+  table_from_template
+from picrust.binary_precalc import write_binary_precalc
 
 class PredictMetagenomeTests(TestCase):
     """ """
@@ -59,6 +69,30 @@ class PredictMetagenomeTests(TestCase):
         self.assertEqual(str(actual),
                          str(self.predicted_metagenome_table1))
 
+    def test_extract_otu_and_genome_matrices(self):
+        """extract_otu_and_genome_matrices aligns both tables on shared OTU ids"""
+        otu_data,genome_data,overlapping_otus =\
+          extract_otu_and_genome_matrices(self.otu_table1,self.genome_table1)
+        self.assertEqual(overlapping_otus,['GG_OTU_1','GG_OTU_2','GG_OTU_3'])
+        #OTUs x samples
+        self.assertFloatEqual(otu_data.toarray(),\
+          array([[1.0,2.0,3.0,5.0],[5.0,1.0,0.0,2.0],[0.0,0.0,1.0,4.0]]))
+        #OTUs x genes
+        self.assertFloatEqual(genome_data.toarray(),\
+          array([[1.0,0.0,0.0],[3.0,0.0,1.0],[2.0,1.0,0.0]]))
+
+        self.assertRaises(ValueError,extract_otu_and_genome_matrices,\
+          self.otu_table1,self.genome_table2)
+
+    def test_predict_metagenomes_no_round(self):
+        """ predict_metagenomes can skip rounding of predictions """
+        otu_table = self.otu_table1.norm(axis='sample',inplace=False)
+        actual = predict_metagenomes(otu_table,self.genome_table1,\
+          whole_round=False)
+        #f1 in Sample1 = (1*1 + 5*3 + 0*2)/6
+        self.assertFloatEqual(actual.get_value_by_ids('f1','Sample1'),16/6)
+        self.assertFloatEqual(actual.get_value_by_ids('f3','Sample1'),5/6)
+
     def test_predict_metagenomes_value_error(self):
         """ predict_metagenomes raises ValueError when no overlapping otu ids """
         self.assertRaises(ValueError,predict_metagenomes,self.otu_table1,self.genome_table2)
@@ -130,6 +164,101 @@ class PredictMetagenomeTests(TestCase):
         self.assertEqual(str(obs_lower_CI_95),
                          str(curr_exp_lower_CI_95))
 
+    def test_align_variance_matrix(self):
+        """align_variance_matrix aligns variances to the overlapping OTUs"""
+        variance_table = self.variance_table1_one_gene_one_otu
+        obs_data,obs_idxs = align_variance_matrix(variance_table,
+          ['GG_OTU_1','GG_OTU_2','GG_OTU_3','GG_OTU_4'])
+        self.assertEqual(list(obs_idxs),[0,1,2])
+        for i,otu_id in enumerate(['GG_OTU_1','GG_OTU_2','GG_OTU_3']):
+            self.assertFloatEqual(obs_data[i].toarray()[0],
+              variance_table.data(otu_id))
+        self.assertRaises(ValueError,align_variance_matrix,variance_table,['bogus'])
+
+    def test_union_otu_ids(self):
+        """union_otu_ids returns the sorted OTU ids of several tables"""
+        self.assertEqual(union_otu_ids([self.otu_table1,self.genome_table1]),
+          ['GG_OTU_1','GG_OTU_2','GG_OTU_3','f1','f2','f3'])
+        self.assertEqual(union_otu_ids(iter([self.otu_table1])),
+          ['GG_OTU_1','GG_OTU_2','GG_OTU_3'])
+
+    def test_predict_metagenomes_batch(self):
+        """predict_metagenomes_batch predicts each table against one reference"""
+        obs = list(predict_metagenomes_batch([self.otu_table1,self.otu_table1],
+          self.genome_table1))
+        self.assertEqual(len(obs),2)
+        for table in obs:
+            self.assertEqual(str(table),str(self.predicted_metagenome_table1))
+
+        obs = list(predict_metagenomes_batch(iter([self.otu_table1]),
+          self.genome_table1,self.variance_table1_one_gene_one_otu))
+        self.assertEqual(len(obs),1)
+        exp = predict_metagenome_variances(self.otu_table1,self.genome_table1,
+          self.variance_table1_one_gene_one_otu)
+        self.assertEqual(map(str,obs[0]),map(str,exp))
+
+    def test_predict_metagenomes_parallel(self):
+        """predict_metagenomes_parallel matches the single process prediction"""
+        for n_procs in [1,2,3,8]:
+            obs = predict_metagenomes_parallel(self.otu_table1,
+              self.genome_table1,n_procs)
+            self.assertEqual(str(obs),str(self.predicted_metagenome_table1))
+
+        obs = predict_metagenomes_parallel(self.otu_table1,self.genome_table1,2,
+          gene_variances=self.variance_table1_one_gene_one_otu)
+        exp = predict_metagenome_variances(self.otu_table1,self.genome_table1,
+          self.variance_table1_one_gene_one_otu)
+        self.assertEqual(map(str,obs),map(str,exp))
+
+    def test_predict_metagenomes_multi(self):
+        """predict_metagenomes_multi matches predicting each genome table"""
+        genome_table2 = Table(array([[1.0,0.0],[0.0,4.0]]),['r1','r2'],
+          ['GG_OTU_2','GG_OTU_1'])
+        genome_tables = [self.genome_table1,genome_table2,self.genome_table1]
+        for n_threads in [None,1,2]:
+            obs = predict_metagenomes_multi(self.otu_table1,genome_tables,
+              n_threads=n_threads)
+            self.assertEqual(map(str,obs),[str(predict_metagenomes(
+              self.otu_table1,genome_table)) for genome_table in genome_tables])
+
+        obs = predict_metagenomes_multi(self.otu_table1,[genome_table2],
+          whole_round=False)
+        self.assertEqual(str(obs[0]),str(predict_metagenomes(self.otu_table1,
+          genome_table2,whole_round=False)))
+
+        genome_table3 = Table(array([[1.0]]),['r1'],['bogus'])
+        self.assertRaises(ValueError,predict_metagenomes_multi,
+          self.otu_table1,[self.genome_table1,genome_table3])
+
+    def test_dedup_genome_profiles(self):
+        """dedup_genome_profiles collapses identical genome rows"""
+        genome_data = csr_matrix(array([[1.0,0.0,2.0],[0.0,0.0,0.0],
+          [1.0,0.0,2.0],[0.0,3.0,0.0],[0.0,0.0,0.0],[2.0,0.0,1.0]]))
+        unique_data,profile_idxs = dedup_genome_profiles(genome_data)
+        self.assertEqual(unique_data.toarray().tolist(),
+          [[1.0,0.0,2.0],[0.0,0.0,0.0],[0.0,3.0,0.0],[2.0,0.0,1.0]])
+        self.assertEqual(profile_idxs.tolist(),[0,1,0,2,1,3])
+
+    def test_predict_metagenomes_duplicate_genomes(self):
+        """predict_metagenomes gives the same result when genomes are shared"""
+        genome_table = Table(array([[1.0,1.0,0.0],[2.0,2.0,1.0]]),
+          ['f1','f2'],['GG_OTU_1','GG_OTU_2','GG_OTU_3'])
+        obs = predict_metagenomes(self.otu_table1,genome_table)
+        self.assertFloatEqual(obs.data('Sample1'),[6.0,12.0])
+        self.assertFloatEqual(obs.data('Sample4'),[7.0,18.0])
+
+    def test_predict_metagenomes_duplicate_genomes_fractional(self):
+        """predict_metagenomes matches the full product for fractional counts"""
+        otu_table = Table(array([[0.1],[0.7],[0.2]]),
+          ['GG_OTU_1','GG_OTU_2','GG_OTU_3'],['Sample1'])
+        genome_table = Table(array([[3.0,3.0,3.0]]),['f1'],
+          ['GG_OTU_1','GG_OTU_2','GG_OTU_3'])
+        otu_data,genome_data,otu_ids = \
+          extract_otu_and_genome_matrices(otu_table,genome_table)
+        exp = (genome_data.T * otu_data).toarray().tolist()
+        obs = predict_metagenomes(otu_table,genome_table,whole_round=False)
+        self.assertEqual(obs.matrix_data.toarray().tolist(),exp)
+
     def test_predict_metagenomes_keeps_observation_metadata(self):
         """predict_metagenomes preserves Observation metadata in genome and otu table"""
 
@@ -221,6 +350,66 @@ class PredictMetagenomeTests(TestCase):
         for i,md in enumerate(exp_md):
             self.assertEqualItems(md,actual_md[i])
 
+    def test_aligned_metadata(self):
+        """aligned_metadata returns donor metadata in the order of ids"""
+        donor = self.genome_table1_with_metadata
+        ids = list(donor.ids(axis='observation'))
+        donor_md = donor.metadata(axis='observation')
+
+        #ids matching the donor are passed straight through
+        self.assertTrue(aligned_metadata(donor,ids) is donor_md)
+
+        obs = aligned_metadata(donor,[ids[-1],'bogus',ids[0]])
+        self.assertEqual(obs,[donor_md[-1],None,donor_md[0]])
+
+        self.assertEqual(aligned_metadata(self.genome_table1,ids,
+          axis='sample'),None)
+
+    def test_table_from_template(self):
+        """table_from_template builds the table with the donor metadata"""
+        donor = self.genome_table1_with_metadata
+        new_data = donor.matrix_data.toarray()
+        obs = table_from_template(new_data,donor.ids(),
+          donor.ids(axis='observation'),sample_metadata_source=donor,
+          observation_metadata_source=donor)
+        self.assertEqual(obs.metadata(axis='observation'),
+          donor.metadata(axis='observation'))
+        self.assertEqual(obs.metadata(),donor.metadata())
+        self.assertEqual(obs.type,'Gene table')
+
+        #metadata are aligned by id when the ids are in a different order
+        reversed_ids = list(donor.ids(axis='observation'))[::-1]
+        obs = table_from_template(new_data[::-1],donor.ids(),reversed_ids,
+          observation_metadata_source=donor)
+        for obs_id in reversed_ids:
+            self.assertEqual(obs.metadata(obs_id,axis='observation'),
+              donor.metadata(obs_id,axis='observation'))
+
+    def test_determine_data_table_fp_prefers_binary_precalc(self):
+        """determine_data_table_fp picks up a converted binary precalc file"""
+        tmp_dir = mkdtemp()
+        try:
+            obs = determine_data_table_fp(tmp_dir,'ko','13_5')
+            self.assertEqual(obs,join(tmp_dir,'ko_13_5_precalculated.tab.gz'))
+
+            binary_fp = join(tmp_dir,'ko_13_5_precalculated.npy')
+            write_binary_precalc(self.genome_table1,binary_fp)
+            obs = determine_data_table_fp(tmp_dir,'ko','13_5')
+            self.assertEqual(obs,binary_fp)
+
+            #variance tables are named separately
+            obs = determine_data_table_fp(tmp_dir,'ko','13_5',\
+              precalc_file_suffix='precalculated_variances.tab.gz')
+            self.assertEqual(obs,\
+              join(tmp_dir,'ko_13_5_precalculated_variances.tab.gz'))
+
+            #user-specified tables are always used as given
+            obs = determine_data_table_fp(tmp_dir,'ko','13_5',\
+              user_specified_table='custom.tab')
+            self.assertEqual(obs,'custom.tab')
+        finally:
+            rmtree(tmp_dir)
+
     def test_load_subset_from_biom_str_loads_a_subset_of_observations(self):
         """load_subset_from_biom_str loads a subset of observations from a valid BIOM format JSON string"""
         biom_str = otu_table1_with_metadata
@@ -10,14 +10,16 @@ __email__ = "zaneveld@gmail.com"
 __status__ = "Development"
 
 from math import e,sqrt
+from gzip import GzipFile
 from cogent.util.unit_test import main,TestCase
-from numpy import array,arange,array_equal,around
+from numpy import array,arange,array_equal,around,float32
 from cogent import LoadTree
 from cogent.parse.tree import DndParser
+from cogent.core.tree import PhyloNode
 from cogent.app.util import get_tmp_filename
 from cogent.util.misc import remove_files
 from cogent.maths.stats.special import ndtri
-from warnings import catch_warnings
+from warnings import catch_warnings, simplefilter
 from picrust.predict_traits  import assign_traits_to_tree,\
   predict_traits_from_ancestors, get_most_recent_ancestral_states,\
   fill_unknown_traits, equal_weight,linear_weight,\
@@ -30,7 +32,12 @@ from picrust.predict_traits  import assign_traits_to_tree,\
   variance_of_weighted_mean,fit_normal_to_confidence_interval,\
   get_most_recent_reconstructed_ancestor,\
   normal_product_monte_carlo, get_bounds_from_histogram,\
-  get_nn_by_tree_descent,get_brownian_motion_param_from_confidence_intervals
+  get_nn_by_tree_descent,get_brownian_motion_param_from_confidence_intervals,\
+  weighted_average_variance_prediction, calc_confidence_interval_95,\
+  trait_store_from_file, TraitStore, get_nearest_annotated_neighbors,\
+  asr_confidence_stores_from_file
+from picrust.parse import parse_asr_confidence_output
+from picrust.util import PicrustNode
 
 
 """
@@ -48,6 +55,13 @@ in_trait2="""tips	trait1	trait2	trait3
 2	0	3	2
 3	2	3	3"""
 
+asr_confidence_output=[\
+"nodes\ttrait1\ttrait2",\
+"I3\t0.5|1.5\t1.0|3.0",\
+"I1\t-0.25|0.75\t2.0|4.0",\
+"sigma\t0.12|0.34",\
+"loglik\t-12.5"]
+
 in_bad_trait="""tips	not_trait1	trait2	trait3
 1	1	3	1
 2	0	3	2
@@ -190,6 +204,15 @@ class TestPredictTraits(TestCase):
         self.assertFloatEqual(obs_nsti,exp)
         self.assertFloatEqual(obs_distances["B"],0.03)
         self.assertFloatEqual(obs_distances["C"],0.02)
+
+        #Without using annotated tips as their own nearest neighbor
+        # A --> D 0.13
+        # D --> A 0.13
+        obs_nsti,obs_distances = calc_nearest_sequenced_taxon_index(tree,\
+          limit_to_tips = ["A","B","D"],include_self=False,verbose=False)
+        self.assertFloatEqual(obs_nsti,(0.13+0.03+0.13)/3.0)
+        self.assertFloatEqual(obs_distances["A"],0.13)
+        self.assertFloatEqual(obs_distances["D"],0.13)
     
     def test_get_nn_by_tree_descent(self):
         """calc_nearest_sequenced_taxon_index calculates the NSTI measure"""
@@ -292,6 +315,37 @@ class TestPredictTraits(TestCase):
 
 
 
+    def test_get_nearest_annotated_neighbors(self):
+        """get_nearest_annotated_neighbors matches get_nearest_annotated_neighbor for each node"""
+        traits = self.PartialReconstructionTraits
+        tree = assign_traits_to_tree(traits,self.BetweenI3AndI1Tree)
+        node_names = ['A','B','C','D','I1','I2','I3']
+        for tips_only in [True,False]:
+            for include_self in [True,False]:
+                obs = get_nearest_annotated_neighbors(tree,node_names,\
+                  tips_only=tips_only,include_self=include_self)
+                self.assertEqualItems(obs.keys(),node_names)
+                for node_name in node_names:
+                    node = tree.getNodeMatchingName(node_name)
+                    #compare distances, since ties may be broken differently
+                    candidates = [n for n in tree.preorder() if \
+                      n.Reconstruction is not None and \
+                      (n.isTip() or not tips_only) and \
+                      (include_self or n is not node)]
+                    exp = min(node.distance(n) for n in candidates)
+                    self.assertFloatEqual(node.distance(obs[node_name]),exp)
+
+        obs = get_nearest_annotated_neighbors(tree,['C','I3'],\
+          tips_only=False,include_self=False)
+        self.assertEqual(obs['C'].Name,'I3')
+        self.assertEqual(obs['I3'].Name,'B')
+
+        tree = assign_traits_to_tree({},self.SimpleTree)
+        self.assertEqual(get_nearest_annotated_neighbors(tree,['A']),\
+          {'A':None})
+        self.assertRaises(KeyError,get_nearest_annotated_neighbors,\
+          tree,['not_a_node'])
+
     def test_get_nearest_annotated_neightbor(self):
         """get_nearest_annotated_neighbor finds nearest relative with traits"""
         traits = self.SimpleTreeTraits
@@ -496,6 +550,7 @@ class TestPredictTraits(TestCase):
 
         #test that we get a warning when header from other trait table doesn't match perfectly.
         with catch_warnings(record=True) as w:
+            simplefilter('always')
             header2,traits2=update_trait_dict_from_file(self.in_trait2_fp,header)
             self.assertEqual(header2,["trait2","trait1"])
             self.assertEqual(traits2,{1:[3,1], 2:[3,0], 3:[3,2]})
@@ -507,6 +562,102 @@ class TestPredictTraits(TestCase):
         #try giving a trait table with a trait that doesn't match our header
         self.assertRaises(RuntimeError,update_trait_dict_from_file,self.in_bad_trait_fp,header)
 
+    def test_trait_store_from_file(self):
+        """trait_store_from_file should load trait tables into a TraitStore"""
+        header,traits=trait_store_from_file(self.in_trait1_fp)
+        self.assertEqual(header,["trait2","trait1"])
+        self.assertEqual(traits.data.dtype,float32)
+        self.assertEqualItems(traits.keys(),[3,'A','D'])
+        self.assertFloatEqual(traits['A'],[5,2.5])
+        self.assertFloatEqual(traits.rows(['D',3]),[[5,2],[3,1]])
+
+        with catch_warnings(record=True) as w:
+            simplefilter('always')
+            header2,traits2=trait_store_from_file(self.in_trait2_fp,header)
+            self.assertEqual(header2,["trait2","trait1"])
+            self.assertFloatEqual(traits2[2],[3,0])
+            self.assertEqual(len(w),1)
+            self.assertTrue("Missing" in str(w[-1].message))
+
+        self.assertRaises(RuntimeError,trait_store_from_file,self.in_bad_trait_fp,header)
+
+        #ids and values match those loaded through cogent's LoadTable
+        for fp in [self.in_trait1_fp,self.in_trait2_fp]:
+            exp_header,exp_traits = update_trait_dict_from_file(fp)
+            obs_header,obs_traits = trait_store_from_file(fp)
+            self.assertEqual(obs_header,exp_header)
+            self.assertEqualItems(obs_traits.keys(),exp_traits.keys())
+            for node_id in exp_traits:
+                self.assertFloatEqual(obs_traits[node_id],exp_traits[node_id])
+
+        #gzipped tables are read too
+        gz_fp = get_tmp_filename(prefix='Predict_Traits_Tests',suffix='.tsv.gz')
+        self.files_to_remove.append(gz_fp)
+        gz_file = GzipFile(gz_fp,'wb')
+        gz_file.write(in_trait1)
+        gz_file.close()
+        obs_header,obs_traits = trait_store_from_file(gz_fp)
+        self.assertEqual(obs_header,["trait2","trait1"])
+        self.assertFloatEqual(obs_traits.rows([3,'A','D']),\
+          traits.rows([3,'A','D']))
+
+    def test_asr_confidence_stores_from_file(self):
+        """asr_confidence_stores_from_file matches parse_asr_confidence_output"""
+        confidence_fp = get_tmp_filename(prefix='Predict_Traits_Tests',\
+          suffix='.tsv')
+        self.files_to_remove.append(confidence_fp)
+        confidence_file = open(confidence_fp,'w')
+        confidence_file.write("\n".join(asr_confidence_output))
+        confidence_file.close()
+
+        exp_min,exp_max,exp_params,exp_mapping =\
+          parse_asr_confidence_output(open(confidence_fp))
+        obs_min,obs_max,obs_params,obs_mapping =\
+          asr_confidence_stores_from_file(confidence_fp)
+        self.assertEqual(obs_min.data.dtype,float32)
+        self.assertEqual(obs_params,exp_params)
+        self.assertEqual(obs_mapping,exp_mapping)
+        for obs,exp in [(obs_min,exp_min),(obs_max,exp_max)]:
+            self.assertEqualItems(obs.keys(),exp.keys())
+            for node_id in exp:
+                self.assertFloatEqual(obs[node_id],exp[node_id])
+
+    def test_trait_store(self):
+        """TraitStore should behave like a dict of trait arrays"""
+        traits = TraitStore.from_dict(self.SimpleTreeTraits)
+        self.assertEqual(len(traits),4)
+        self.assertTrue('E' in traits)
+        self.assertFalse('B' in traits)
+        self.assertEqual(traits.get('B'),None)
+        self.assertFloatEqual(traits['F'],[0.0,1.0])
+
+        traits.update(TraitStore.from_dict({"F":[2.0,2.0],"B":[3.0,1.0]}))
+        self.assertEqual(len(traits),5)
+        self.assertFloatEqual(traits['F'],[2.0,2.0])
+        self.assertFloatEqual(traits['B'],[3.0,1.0])
+        self.assertFloatEqual(traits['A'],[1.0,1.0])
+
+        self.assertRaises(ValueError,traits.update,\
+          TraitStore.from_dict({"C":[1.0]}))
+        self.assertRaises(ValueError,TraitStore.from_dict,\
+          {"A":[1.0,1.0],"B":[1.0]})
+
+    def test_predict_traits_from_ancestors_trait_store(self):
+        """predict_traits_from_ancestors gives the same results from a TraitStore"""
+        tree = assign_traits_to_tree(self.GeneCountTraits,\
+          self.BetweenI3AndI1Tree)
+        exp = predict_traits_from_ancestors(tree,['A','B','D'])
+
+        store = TraitStore.from_dict(self.GeneCountTraits)
+        tree = assign_traits_to_tree(store,self.BetweenI3AndI1Tree)
+        #nodes hold views of the store's rows rather than copies
+        self.assertTrue(tree.getNodeMatchingName('I3').Reconstruction.base\
+          is store.data)
+        obs = predict_traits_from_ancestors(tree,['A','B','D'])
+        self.assertEqualItems(obs.keys(),exp.keys())
+        for node_label in exp:
+            self.assertFloatEqual(obs[node_label],exp[node_label])
+
     def test_predict_traits_from_ancestors(self):
         """predict_traits_from_ancestors should propagate ancestral states"""
         # Testing the point predictions first (since these are easiest) 
@@ -558,6 +709,110 @@ class TestPredictTraits(TestCase):
             
     
     
+    def test_predict_traits_from_ancestors_matches_per_tip_prediction(self):
+        """predict_traits_from_ancestors matches weighted_average_tip_prediction for each tip"""
+        weight_fn = make_neg_exponential_weight_fn(exp_base=e)
+        for traits,tree in [(self.SimpleTreeTraits,self.SimpleTree),\
+          (self.SimpleTreeTraits,self.SimplePolytomyTree),\
+          (self.GeneCountTraits,self.BetweenI3AndI1Tree),\
+          (self.PartialReconstructionTraits,self.CloseToI1Tree)]:
+            tree = assign_traits_to_tree(traits,tree,trait_label="Traits")
+            nodes_to_predict = [n.Name for n in tree.tips()]
+            obs = predict_traits_from_ancestors(tree,nodes_to_predict,\
+              trait_label="Traits",weight_fn=weight_fn,round_predictions=False)
+            self.assertEqualItems(obs.keys(),nodes_to_predict)
+            for node in tree.tips():
+                if node.Name in traits:
+                    self.assertEqual(obs[node.Name],traits[node.Name])
+                    continue
+                exp = weighted_average_tip_prediction(tree,node,\
+                  get_most_recent_reconstructed_ancestor(node,"Traits"),\
+                  trait_label="Traits",weight_fn=weight_fn)
+                self.assertFloatEqual(obs[node.Name],exp)
+
+    def test_predict_traits_from_ancestors_variance_matches_per_tip(self):
+        """predict_traits_from_ancestors variances match weighted_average_variance_prediction"""
+        tree = self.SimpleUnequalVarianceTree
+        bm = [1.0,10.0,100.0]
+        prediction,variances,confidence_intervals =\
+          predict_traits_from_ancestors(tree,['B','D'],\
+          calc_confidence_intervals=True,lower_bound_trait_label='lower_bound',\
+          upper_bound_trait_label='upper_bound',brownian_motion_parameter=bm)
+        for node_label in ['B','D']:
+            node = tree.getNodeMatchingName(node_label)
+            ancestor = get_most_recent_reconstructed_ancestor(node)
+            ancestral_states,ancestral_variance =\
+              get_most_recent_ancestral_states(node,"Reconstruction",\
+              upper_bound_trait_label='upper_bound',\
+              lower_bound_trait_label='lower_bound')
+            exp = weighted_average_variance_prediction(tree,node,\
+              most_recent_reconstructed_ancestor=ancestor,\
+              ancestral_variance=ancestral_variance,\
+              brownian_motion_parameter=bm)
+            self.assertFloatEqual(variances[node_label]['variance'],exp)
+            exp_lower,exp_upper = calc_confidence_interval_95(\
+              prediction[node_label],exp)
+            self.assertFloatEqual(\
+              confidence_intervals[node_label]['lower_CI'],exp_lower)
+            self.assertFloatEqual(\
+              confidence_intervals[node_label]['upper_CI'],exp_upper)
+
+    def test_predict_traits_from_ancestors_bad_traits(self):
+        """predict_traits_from_ancestors raises errors on malformed traits"""
+        traits = {"A":[1.0,1.0],"E":[1.0,1.0,1.0],"F":[0.0,1.0]}
+        tree = assign_traits_to_tree(traits,self.SimpleTree)
+        self.assertRaises(ValueError,predict_traits_from_ancestors,\
+          tree,['B','C'])
+
+        traits = {"A":1.0,"E":[1.0,1.0],"F":[0.0,1.0]}
+        tree = assign_traits_to_tree(traits,self.SimpleTree)
+        self.assertRaises(TypeError,predict_traits_from_ancestors,\
+          tree,['B','C'])
+
+    def test_indexed_tree_distances(self):
+        """per-node prediction methods use the distance index of a PicrustNode tree"""
+        newick = "((((B:0.01,C:0.1)I3:0.02,A:0.01)I2:0.02,D:0.05)I1:0.02)root;"
+        traits = self.GeneCountTraits
+        bm = [1.0,10.0]
+        ancestral_variance = array([0.5,0.25])
+        weight_fn = make_neg_exponential_weight_fn(exp_base=e)
+
+        def run_callers(tree):
+            node = tree.getNodeMatchingName('A')
+            ancestor = get_most_recent_reconstructed_ancestor(node)
+            prediction = weighted_average_tip_prediction(tree,node,ancestor,\
+              weight_fn=weight_fn)
+            variance = weighted_average_variance_prediction(tree,node,\
+              most_recent_reconstructed_ancestor=ancestor,\
+              ancestral_variance=ancestral_variance,\
+              brownian_motion_parameter=bm,weight_fn=weight_fn)
+            nn,distance = get_nn_by_tree_descent(tree,'B',\
+              filter_by_property=False)
+            return prediction,variance,nn.Name,distance
+
+        exp = run_callers(assign_traits_to_tree(traits,\
+          DndParser(newick,constructor=PicrustNode)))
+
+        tree = assign_traits_to_tree(traits,\
+          DndParser(newick,constructor=PicrustNode))
+        tree.buildDistanceIndex()
+        #With the index built, no distance should walk the tree
+        walking_distance = PhyloNode.distance
+        def fail_distance(self,other):
+            raise AssertionError("distance walked the tree")
+        PhyloNode.distance = fail_distance
+        try:
+            obs = run_callers(tree)
+        finally:
+            PhyloNode.distance = walking_distance
+
+        self.assertFloatEqual(obs[0],exp[0])
+        self.assertFloatEqual(obs[1],exp[1])
+        self.assertEqual(obs[2],exp[2])
+        self.assertFloatEqual(obs[3],exp[3])
+        self.assertEqual(obs[2],'A')
+        self.assertFloatEqual(obs[3],0.04)
+
     def test_fill_unknown_traits(self):
         """fill_unknown_traits should propagate only known characters"""
 
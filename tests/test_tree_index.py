@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# File created on 18 Oct 2026
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2015, The PICRUSt Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.1.4"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+__status__ = "Development"
+
+
+from numpy import array
+from cogent.parse.tree import DndParser
+from cogent.util.unit_test import main, TestCase
+from picrust.tree_index import TreeIndex
+
+
+class TreeIndexTests(TestCase):
+    """ Tests of the picrust/tree_index.py module """
+
+    def setUp(self):
+        self.tree = DndParser(
+            "((((B:0.01,C:0.95)I3:0.01,A:0.01)I2:0.95,D:0.05)I1:0.95)root;")
+        self.tree_index = TreeIndex(self.tree)
+
+    def test_init(self):
+        """TreeIndex records the tree's structure in preorder"""
+        ti = self.tree_index
+        self.assertEqual(ti.names,
+                         ['root', 'I1', 'I2', 'I3', 'B', 'C', 'A', 'D'])
+        self.assertEqual(ti.parents.tolist(), [-1, 0, 1, 2, 3, 3, 2, 1])
+        self.assertFloatEqual(ti.lengths,
+                              [0.0, 0.95, 0.95, 0.01, 0.01, 0.95, 0.01, 0.05])
+        self.assertEqual(ti.is_tip.tolist(),
+                         [False, False, False, False, True, True, True, True])
+        self.assertEqual(len(ti), 8)
+
+    def test_children(self):
+        """children are listed in the order of node.Children"""
+        ti = self.tree_index
+        self.assertEqual([ti.names[i] for i in ti.children(2)], ['I3', 'A'])
+        self.assertEqual([ti.names[i] for i in ti.children(1)], ['I2', 'D'])
+        self.assertEqual(ti.children(4).tolist(), [])
+
+    def test_depths_root_distances(self):
+        """depths and root_distances are measured from the root"""
+        ti = self.tree_index
+        self.assertEqual(ti.depths.tolist(), [0, 1, 2, 3, 4, 4, 3, 2])
+        self.assertFloatEqual(ti.root_distances,
+                              [0.0, 0.95, 1.9, 1.91, 1.92, 2.86, 1.91, 1.0])
+
+    def test_lowest_common_ancestors(self):
+        """lowest_common_ancestors matches the ancestors of each node"""
+        ti = self.tree_index
+        nodes = ti.nodes
+        for i, n1 in enumerate(nodes):
+            for j, n2 in enumerate(nodes):
+                exp = n1.lastCommonAncestor(n2)
+                self.assertTrue(nodes[ti.lowest_common_ancestors(i, j)] is exp)
+        self.assertEqual(ti.lowest_common_ancestors([4, 4, 6, 7], [5, 4, 5, 0])
+                         .tolist(), [3, 4, 2, 0])
+
+    def test_distances(self):
+        """distance and distances match PhyloNode.distance"""
+        ti = self.tree_index
+        nodes = ti.nodes
+        a = []
+        b = []
+        exp = []
+        for i, n1 in enumerate(nodes):
+            for j, n2 in enumerate(nodes):
+                self.assertFloatEqual(ti.distance(i, j), n1.distance(n2))
+                a.append(i)
+                b.append(j)
+                exp.append(n1.distance(n2))
+        self.assertFloatEqual(ti.distances(array(a), array(b)), exp)
+
+    def test_tip_index(self):
+        """tip_index looks up tips by name"""
+        self.assertEqual(self.tree_index.tip_index('A'), 6)
+        self.assertRaises(KeyError, self.tree_index.tip_index, 'I3')
+
+    def test_nearest_annotated_ancestors(self):
+        """nearest_annotated_ancestors matches walking node.ancestors()"""
+        annotated = array([False, True, False, True, True, False, False,
+                           False])
+        ancestors, distances =\
+            self.tree_index.nearest_annotated_ancestors(annotated)
+        self.assertEqual(ancestors.tolist(), [-1, 1, 1, 3, 4, 3, 1, 1])
+        nodes = self.tree_index.nodes
+        for i in [2, 5, 6, 7]:
+            self.assertFloatEqual(distances[i],
+                                  nodes[i].distance(nodes[ancestors[i]]))
+        self.assertFloatEqual(distances[[1, 3, 4]], [0.0, 0.0, 0.0])
+
+    def test_nearest_annotated_nodes(self):
+        """nearest_annotated_nodes matches a search over all annotated tips"""
+        nodes = self.tree_index.nodes
+        annotated = array([False, True, False, False, True, True, False,
+                           True])
+        annotated_tips = [4, 5, 7]
+        for include_self in [True, False]:
+            tips, distances = self.tree_index.nearest_annotated_nodes(
+                annotated, include_self=include_self)
+            for i, node in enumerate(nodes):
+                candidates = [t for t in annotated_tips
+                              if include_self or t != i]
+                exp = min(node.distance(nodes[t]) for t in candidates)
+                self.assertFloatEqual(distances[i], exp)
+                self.assertFloatEqual(node.distance(nodes[tips[i]]), exp)
+        #B is its own nearest annotated tip unless it is excluded
+        tips, distances = self.tree_index.nearest_annotated_nodes(annotated)
+        self.assertEqual(tips[4], 4)
+        tips, distances = self.tree_index.nearest_annotated_nodes(
+            annotated, include_self=False)
+        self.assertEqual(tips[4], 5)
+
+    def test_nearest_annotated_nodes_internal(self):
+        """nearest_annotated_nodes can use annotated internal nodes"""
+        nodes = self.tree_index.nodes
+        annotated = array([False, True, False, True, True, False, False,
+                           False])
+        for include_self in [True, False]:
+            neighbors, distances = self.tree_index.nearest_annotated_nodes(
+                annotated, include_self=include_self, tips_only=False)
+            for i, node in enumerate(nodes):
+                candidates = [t for t in [1, 3, 4] if include_self or t != i]
+                exp = min(node.distance(nodes[t]) for t in candidates)
+                self.assertFloatEqual(distances[i], exp)
+                self.assertFloatEqual(node.distance(nodes[neighbors[i]]),
+                                      exp)
+        #I3's nearest other annotated node is its child B
+        self.assertEqual(neighbors[3], 4)
+
+    def test_nearest_annotated_nodes_none_annotated(self):
+        """nearest_annotated_nodes returns -1 when there are no annotated tips"""
+        annotated = array([False, True, True, True, False, False, False,
+                           False])
+        tips, distances = self.tree_index.nearest_annotated_nodes(annotated)
+        self.assertEqual(tips.tolist(), [-1] * 8)
+        self.assertEqual(distances.tolist(), [float('inf')] * 8)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,7 @@ __status__ = "Development"
 
 
 from biom.parse import parse_biom_table
+from cogent.core.tree import PhyloNode
 from cogent.parse.tree import DndParser
 from cogent.util.unit_test import main, TestCase
 import os
@@ -85,6 +86,34 @@ class PicrustNodeTests(TestCase):
         exp_str = "((a:1.0,(b:2.0,c:3.0):0.0)d:4.0,((e:5.0,(f:6.0,g:7.0):0.0)h:8.0,(i:9.0,(j:10.0,k:11.0):0.0)l:12.0):0.0)m:14.0;"
         obs = t.bifurcating()
 
+    def test_distance_index(self):
+        """distance uses the distance index, and matches PhyloNode.distance"""
+        t_str = "((a:1,b:2,c:3)d:4,(e:5,f:6,g:7)h:8,(i:9,j:10,k:11)l:12)m:14;"
+        tree = DndParser(t_str, constructor=PicrustNode)
+        nodes = list(tree.preorder())
+        exp = [[PhyloNode.distance(n1, n2) for n2 in nodes] for n1 in nodes]
+
+        tree_index = tree.buildDistanceIndex()
+        self.assertTrue(tree.getNodeMatchingName('a')._tree_index
+                        is tree_index)
+        for n1, row in zip(nodes, exp):
+            self.assertFloatEqual([n1.distance(n2) for n2 in nodes], row)
+            self.assertFloatEqual(n1.distances(nodes), row)
+
+        #copies of the tree don't use the original tree's index
+        tree_copy = tree.deepcopy()
+        a = tree_copy.getNodeMatchingName('a')
+        k = tree_copy.getNodeMatchingName('k')
+        self.assertFloatEqual(a.distance(k), 1 + 4 + 12 + 11)
+
+        #the index must be rebuilt after changing branch lengths
+        tree.getNodeMatchingName('a').Length = 100.0
+        tree.clearDistanceIndex()
+        self.assertFloatEqual(tree.getNodeMatchingName('a').distance(
+            tree.getNodeMatchingName('b')), 102.0)
+        tree.buildDistanceIndex()
+        self.assertFloatEqual(tree.getNodeMatchingName('a').distance(
+            tree.getNodeMatchingName('b')), 102.0)
 
 
 class UtilTests(TestCase):
@@ -110,6 +139,22 @@ class UtilTests(TestCase):
         two_taxon_table = convert_precalc_to_biom(StringIO.StringIO(precalc_in_tab),ids_to_load)
         self.assertEqualItems(two_taxon_table.ids(), ids_to_load)
 
+    def test_convert_precalc_to_biom_subset_values(self):
+        """ convert_precalc_to_biom loads the values and metadata of only the requested rows """
+        # duplicated ids are loaded once
+        result_table = convert_precalc_to_biom(precalc_in_tab,
+                                               ['OTU_3','OTU_1','OTU_3'])
+        # rows come back in file order
+        self.assertEqual(list(result_table.ids()), ['OTU_1','OTU_3'])
+        self.assertFloatEqual(result_table.data('OTU_1'), [1.0,2.0,3.0])
+        self.assertFloatEqual(result_table.data('OTU_3'), [4.0,4.0,4.0])
+        self.assertEqual(result_table.metadata()[1]['NSTI'], '0.5')
+        self.assertEqual(result_table.metadata(axis='observation'),
+                         self.precalc_in_biom.metadata(axis='observation'))
+
+        exp = self.precalc_in_biom.filter(['OTU_1','OTU_3'], inplace=False)
+        self.assertEqual(result_table, exp)
+
     def test_convert_precalc_to_biom_value_error(self):
         """ convert_precalc_to_biom raises ValueError when no overlapping otu ids or additional ids """
         self.assertRaises(ValueError,convert_precalc_to_biom,precalc_in_tab,['bogus_id1','bogus_id2'])